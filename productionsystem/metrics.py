@@ -0,0 +1,103 @@
+"""
+Generic metric primitives.
+
+A fixed bucket histogram and an HTTP server exposing metrics registries in the
+Prometheus text exposition format. A registry is any object with a render
+method returning its metrics in that format.
+
+This module must not depend on anything outside the standard library and
+future as it is imported by the DIRAC RPC server.
+"""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed bucket upper bounds."""
+
+    def __init__(self, buckets):
+        """Initialise."""
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Record a value."""
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def render(self, name, labels):
+        """Return the histogram's sample lines in the text exposition format."""
+        lines = ['%s_bucket{%s,le="%s"} %d' % (name, labels, bound, count)
+                 for bound, count in zip(self.buckets, self.counts)]
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count))
+        lines.append('%s_sum{%s} %s' % (name, labels, self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+        return lines
+
+
+class MetricsServer(object):
+    """
+    HTTP server exposing metrics in the Prometheus text exposition format.
+
+    Any path returns the metrics, served from a background thread.
+
+    Args:
+        address (tuple): The (hostname, port) to listen on
+        registries (Iterable): The metrics registries to expose
+    """
+
+    def __init__(self, address, registries):
+        """Initialise."""
+        registries = tuple(registries)
+
+        class Handler(BaseHTTPRequestHandler):
+            """Metrics request handler."""
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Return the metrics."""
+                body = ''.join(registry.render() for registry in registries).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                """Log the requests at debug level rather than to stderr."""
+                logger.debug("Metrics request from %s: %s", self.client_address[0],
+                             format % args)
+
+        self.server = HTTPServer(address, Handler)
+        self._thread = None
+
+    @property
+    def port(self):
+        """Return the port being listened on."""
+        return self.server.server_address[1]
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Serving metrics on %s:%d", *self.server.server_address[:2])
+
+    def close(self):
+        """Stop serving."""
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+        self.server.server_close()
@@ -3,33 +3,231 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+from future.utils import viewitems, viewvalues
 
 import logging
 import time
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
+from operator import attrgetter
+from multiprocessing.pool import Pool, ThreadPool
 
 import requests
 from daemonize import Daemonize
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from productionsystem.sql.registry import SessionRegistry, managed_session
-from productionsystem.sql.models import Requests, Services
+from productionsystem.sql.registry import (POOL_METRICS, SessionRegistry, managed_session,
+                                           unit_of_work)
+from productionsystem.sql.models import (Requests, ParametricJobs, Services, MonitoringEvents,
+                                         MonitoringSchedule, LogEntries)
 from productionsystem.sql.enums import LocalStatus, ServiceStatus
+from productionsystem.monitoring.diracrpc.DiracRPCClient import close_pools
+from productionsystem.metrics import MetricsServer
+from productionsystem.monitoring.diracrpc.metrics import CLIENT_METRICS
 
 MINS = 60
+# Allowance for clock skew between us and DIRAC when asking for jobs changed since last poll
+INCREMENTAL_OVERLAP = timedelta(minutes=5)
+POOL_TYPES = {'thread': ThreadPool, 'process': Pool}
+# Requests in these states are monitored every cycle regardless of their schedule
+ALWAYS_DUE_STATUSES = frozenset((LocalStatus.APPROVED, LocalStatus.SUBMITTING, LocalStatus.REMOVING))
+# Fraction of a parametric job's DIRAC jobs finished for it to count as near completion
+NEAR_COMPLETION = 0.9
+# How often the log retention policy is applied
+LOG_COMPACTION_INTERVAL = timedelta(hours=1)
+MonitorResult = namedtuple('MonitorResult', ('request_id', 'wall_time', 'success',
+                                             'rows_updated', 'status', 'near_completion'))
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def _init_worker():
+    """
+    Initialise a monitoring pool process.
+
+    Forked processes inherit the parent's DB engine, including any open connections
+    in its pool. These must not be shared so we drop them and let the worker open its own.
+    """
+    SessionRegistry.get_instance().dispose()  # pylint: disable=no-member
+
+
+def near_completion(request):
+    """
+    Check if a request has running jobs and is close to finishing.
+
+    Args:
+        request (Requests): The request to check
+
+    Returns:
+        bool: True if any of its parametric jobs are still running but nearly finished
+    """
+    for job in request.parametric_jobs:
+        if job.num_running and job.num_jobs \
+                and job.num_completed + job.num_failed >= NEAR_COMPLETION * job.num_jobs:
+            return True
+    return False
+
+
+def monitor_request(request, dirac_statuses=None, dirac_jobs=None):
+    """
+    Monitor a single request.
+
+    This is the unit of work handed out to the monitoring pool. It submits APPROVED
+    requests, removes those marked REMOVING and otherwise monitors them. Exceptions
+    are caught and logged here so that one bad request can't affect any of the others.
+    Monitoring is done within a DB unit of work, so the request stays attached
+    throughout and its changes are written back in a single flush.
+
+    Args:
+        request (Requests): The request to process
+        dirac_statuses (dict): The DiracStatus of this request's jobs already
+                               gathered this cycle, keyed by job id
+        dirac_jobs (dict): The ParametricJobs.dirac_job_rollups of this request
+                           already gathered this cycle
+
+    Returns:
+        MonitorResult: The request id, the wall time taken (in seconds), whether the
+                       request was processed without error, the number of DIRAC
+                       job rows updated, the request's final status and whether
+                       it is near completion.
+    """
+    start = time.time()
+    success = True
+    rows_updated = 0
+    nearly_complete = False
+    try:
+        if request.status == LocalStatus.APPROVED:
+            request.status = LocalStatus.SUBMITTING
+            request.update()
+            request.submit()
+            request.update()
+        if request.status == LocalStatus.REMOVING:
+            request.remove()
+        else:
+            with unit_of_work() as session:
+                session.add(request)
+                request.monitor(dirac_statuses, dirac_jobs)
+                rows_updated = request.update(session=session)
+            nearly_complete = near_completion(request)
+    except BaseException:
+        logger.exception("Unhandled exception while monitoring request %d", request.id)
+        success = False
+    return MonitorResult(request.id, time.time() - start, success,
+                         rows_updated, request.status, nearly_complete)
+
+
+def remove_request(request):
+    """
+    Remove a single request.
+
+    This is the unit of work handed out to the removal queue.
+
+    Args:
+        request (Requests): The request to remove
+
+    Returns:
+        tuple: The request id, the wall time taken (in seconds) and whether
+               the request was removed.
+    """
+    start = time.time()
+    removed = False
+    try:
+        removed = request.remove()
+    except BaseException:
+        logger.exception("Unhandled exception while removing request %d", request.id)
+    wall_time = time.time() - start
+    if removed:
+        outcome = ''
+    elif request.status == LocalStatus.FAILED:
+        outcome = ' (gave up)'
+    else:
+        outcome = ' (will retry)'
+    logger.info("Removal of request %d finished in %.1fs%s", request.id, wall_time, outcome)
+    return request.id, wall_time, removed
+
+
+def submit_request(request, interrupted=False):
+    """
+    Submit a single request.
+
+    This is the unit of work handed out to the submission queue. The parametric
+    jobs are recorded as they are submitted and those already submitted are
+    skipped, so an interrupted submission can be picked up where it left off.
+
+    Args:
+        request (Requests): The request to submit
+        interrupted (bool): The request's submission was interrupted by a restart
+
+    Returns:
+        tuple: The request id, the wall time taken (in seconds) and whether
+               the request was submitted without error.
+    """
+    start = time.time()
+    success = True
+    try:
+        request.submit(resume=True, interrupted=interrupted)
+        request.update()
+    except BaseException:
+        logger.exception("Unhandled exception while submitting request %d", request.id)
+        success = False
+    wall_time = time.time() - start
+    logger.info("Submission of request %d finished in %.1fs%s",
+                request.id, wall_time, '' if success else ' (FAILED)')
+    return request.id, wall_time, success
+
+
+def _monitor_request_args(args):
+    """Unpack the arguments for monitor_request when mapping over the pool."""
+    return monitor_request(*args)
 
 
 class MonitoringDaemon(Daemonize):
-    """Monitoring Daemon."""
+    """
+    Monitoring Daemon.
 
-    def __init__(self, dburl, delay, cert, verify=False, **kwargs):
+    If metrics_port is given the DIRAC RPC client call metrics and DB pool
+    metrics of the daemon process are served over HTTP on that port. With
+    process workers the requests are monitored in the pool's child processes,
+    whose metrics are not aggregated, so only the calls made by the daemon
+    process itself (e.g. gathering the statuses in bulk) are served.
+    """
+
+    def __init__(self, dburl, delay, cert, verify=False, workers=1, worker_type='thread',
+                 incremental=False, full_poll_interval=60, wakeup_interval=5,
+                 adaptive=False, max_poll_interval=60, submit_workers=0, removal_workers=0,
+                 metrics_host='localhost', metrics_port=0, slow_call_threshold=10,
+                 log_retention=0, log_max_entries=0, **kwargs):
         """Initialise."""
         super(MonitoringDaemon, self).__init__(action=self.main, **kwargs)
         self._dburl = dburl
         self._delay = delay
         self.cert = cert
         self.verify = verify
+        if worker_type not in POOL_TYPES:
+            raise ValueError("Worker type %r should be one of: %s"
+                             % (worker_type, list(POOL_TYPES)))
+        self._workers = workers
+        self._worker_type = worker_type
+        self._pool = None
+        self._incremental = incremental
+        self._full_poll_interval = timedelta(minutes=full_poll_interval)
+        self._last_poll = {}
+        self._last_full_poll = None
+        self._wakeup_interval = wakeup_interval
+        self._adaptive = adaptive
+        self._max_poll_interval = int(max(max_poll_interval, delay) * MINS)
+        self._submit_workers = submit_workers
+        self._submit_pool = None
+        self._submitting = {}
+        self._resume_submissions = True
+        self._removal_workers = removal_workers
+        self._removal_pool = None
+        self._removing = {}
+        self._metrics_address = (metrics_host, metrics_port)
+        self._slow_call_threshold = slow_call_threshold
+        self._log_retention = log_retention
+        self._log_max_entries = log_max_entries
+        self._last_log_compaction = None
 
     def exit(self):
         """Update the monitoringd status on exit."""
@@ -54,17 +252,52 @@ class MonitoringDaemon(Daemonize):
 
     def main(self):
         """Daemon main function."""
-        SessionRegistry.setup(self._dburl)  # pylint: disable=no-member
+        SessionRegistry.setup(self._dburl, profile='monitoring')  # pylint: disable=no-member
+        # Set before the pool is created so that forked workers inherit it.
+        CLIENT_METRICS.slow_call_threshold = self._slow_call_threshold
+        if self._workers > 1:
+            self.logger.info("Monitoring requests using a pool of %d %s workers.",
+                             self._workers, self._worker_type)
+            if self._worker_type == 'process' and self._metrics_address[1]:
+                self.logger.warning("The DIRAC RPC calls made by the monitoring process "
+                                    "workers are not included in the served metrics.")
+            self._pool = POOL_TYPES[self._worker_type](self._workers, initializer=_init_worker)
+        if self._submit_workers > 0:
+            self.logger.info("Submitting requests using a queue with %d workers.",
+                             self._submit_workers)
+            self._submit_pool = ThreadPool(self._submit_workers)
+        if self._removal_workers > 0:
+            self.logger.info("Removing requests in the background with %d workers.",
+                             self._removal_workers)
+            self._removal_pool = ThreadPool(self._removal_workers)
+        metrics_server = None
+        if self._metrics_address[1]:
+            metrics_server = MetricsServer(self._metrics_address, [CLIENT_METRICS, POOL_METRICS])
+            metrics_server.start()
 
         try:
             while True:
                 self.check_services()
                 self.monitor_requests()
-                time.sleep(self._delay * MINS)
+                self.compact_logs()
+                self.wait_for_wakeups(self._delay * MINS)
         except KeyboardInterrupt:
             self.logger.warning("keyboard interrupt!")  # match the dirac-daemon rpyc SIGINT handler
         except Exception:
             self.logger.exception("Unhandled exception while running daemon.")
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+            if self._submit_pool is not None:
+                self._submit_pool.terminate()
+                self._submit_pool.join()
+            if self._removal_pool is not None:
+                self._removal_pool.terminate()
+                self._removal_pool.join()
+            if metrics_server is not None:
+                metrics_server.close()
+            close_pools()
 
     def check_services(self):
         """
@@ -114,32 +347,331 @@ class MonitoringDaemon(Daemonize):
             except SQLAlchemyError as err:
                 self.logger.exception("Error adding new monitoringd service: %s", err)
 
-    def monitor_requests(self):
+    def compact_logs(self):
+        """Apply the request log retention policy, at most once every LOG_COMPACTION_INTERVAL."""
+        if not (self._log_retention or self._log_max_entries):
+            return
+        now = datetime.utcnow()
+        if self._last_log_compaction is not None \
+                and now - self._last_log_compaction < LOG_COMPACTION_INTERVAL:
+            return
+        self._last_log_compaction = now
+        try:
+            LogEntries.compact(max_age=self._log_retention, max_entries=self._log_max_entries)
+        except SQLAlchemyError:
+            self.logger.exception("Error compacting the request logs.")
+
+    def wait_for_wakeups(self, timeout):
+        """
+        Wait for the next full monitoring cycle.
+
+        While waiting, the wake-up events signalled by the web app are polled
+        for every wakeup_interval seconds and a targeted monitoring cycle is run
+        straight away for just the affected requests.
+
+        Args:
+            timeout (float): How long to wait (in seconds)
+        """
+        end = time.time() + timeout
+        while True:
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            if not self._wakeup_interval:
+                time.sleep(remaining)
+                return
+            time.sleep(min(self._wakeup_interval, remaining))
+            try:
+                request_ids = MonitoringEvents.consume()
+            except SQLAlchemyError as err:
+                self.logger.exception("Error checking for monitoring wake-up events: %s", err)
+                continue
+            if request_ids:
+                self.logger.info("Woken up to monitor request(s): %s", sorted(request_ids))
+                self.monitor_requests(request_ids=request_ids)
+
+    def monitor_requests(self, request_ids=None):
         """
         Monitor the DB requests.
 
         Check the status of ongoing DB requests and either update them or
-        create new Ganga tasks for new requests.
+        create new Ganga tasks for new requests. If a worker pool has been
+        configured then independent requests are processed concurrently.
+
+        Args:
+            request_ids (Iterable): Only monitor these requests (a targeted cycle).
+                                    The job statuses are then queried per request
+                                    rather than gathered in bulk.
         """
-        monitored_requests = Requests.get(status=(LocalStatus.APPROVED,
+        if request_ids is not None:
+            request_ids = sorted(request_ids)
+        monitored_requests = Requests.get(request_id=request_ids,
+                                          status=(LocalStatus.APPROVED,
                                                   LocalStatus.SUBMITTING,
                                                   LocalStatus.SUBMITTED,
                                                   LocalStatus.RUNNING,
                                                   LocalStatus.REMOVING),
                                           load_parametricjobs=True)
-        monitored_requests.extend(Requests.get_reschedules())
+        monitored_requests.extend(Requests.get_reschedules(request_id=request_ids))
+        if self._submit_pool is not None:
+            monitored_requests = self.queue_submissions(monitored_requests)
+        if self._removal_pool is not None:
+            monitored_requests = self.queue_removals(monitored_requests)
+
+        start = time.time()
+        now = datetime.utcnow()
+        schedules = {}
+        if self._adaptive:
+            schedules = MonitoringSchedule.get(request.id for request in monitored_requests)
+            if request_ids is None:
+                MonitoringSchedule.prune(schedules)
+                monitored_requests = self.due_requests(monitored_requests, schedules, now)
+        previous_statuses = {request.id: request.status for request in monitored_requests}
+
+        # Targeted cycles don't gather statuses in bulk as this would move on the
+        # incremental poll time without having polled the other requests' jobs.
+        dirac_statuses = {}
+        if request_ids is None:
+            dirac_statuses = self.gather_dirac_statuses(monitored_requests)
+        dirac_jobs = self.gather_dirac_jobs(monitored_requests)
+        work = [(request, dirac_statuses.get(request.id), dirac_jobs.get(request.id))
+                for request in monitored_requests]
+        if self._pool is not None and len(work) > 1:
+            results = self._pool.map(_monitor_request_args, work, chunksize=1)
+        else:
+            results = [monitor_request(*args) for args in work]
+        if self._adaptive:
+            self.reschedule_requests(results, previous_statuses, schedules, now)
+        self._log_cycle_summary(results, time.time() - start)
+
+    def gather_dirac_jobs(self, monitored_requests):
+        """
+        Gather the DIRAC job counts and states of the requests to monitor in bulk.
+
+        This is a couple of queries for the whole cycle rather than a couple per
+        parametric job. Requests that are submitted or removed this cycle are left
+        out as their DIRAC jobs will have changed by the time they are monitored.
+
+        Args:
+            monitored_requests (list): The requests to monitor this cycle
+
+        Returns:
+            dict: The ParametricJobs.dirac_job_rollups of each request keyed by request id
+        """
+        requests = [request for request in monitored_requests
+                    if request.status not in (LocalStatus.APPROVED, LocalStatus.REMOVING)]
+        try:
+            rollups = ParametricJobs.dirac_job_rollups(job for request in requests
+                                                       for job in request.parametric_jobs)
+        except SQLAlchemyError as err:
+            self.logger.exception("Error gathering the DIRAC jobs to monitor: %s", err)
+            return {}
+        dirac_jobs = {request.id: {} for request in requests}
+        for (request_id, parametricjob_id), rollup in viewitems(rollups):
+            dirac_jobs[request_id][(request_id, parametricjob_id)] = rollup
+        return dirac_jobs
+
+    def queue_submissions(self, monitored_requests):
+        """
+        Hand the requests to submit over to the submission queue.
+
+        APPROVED requests are moved to SUBMITTING and queued. On the first cycle
+        after a (re)start, SUBMITTING requests with parametric jobs still awaiting
+        submission are queued again to resume their submission. Requests are not
+        monitored while they are queued or being submitted.
+
+        Args:
+            monitored_requests (list): The active requests
 
+        Returns:
+            list: The requests to monitor this cycle
+        """
+        for request_id, result in list(viewitems(self._submitting)):
+            if result.ready():
+                del self._submitting[request_id]
+
+        remaining = []
         for request in monitored_requests:
-            try:
-                if request.status == LocalStatus.APPROVED:
-                    request.status = LocalStatus.SUBMITTING
+            if request.id in self._submitting:
+                continue
+            interrupted = request.status == LocalStatus.SUBMITTING
+            if request.status == LocalStatus.APPROVED:
+                request.status = LocalStatus.SUBMITTING
+                try:
                     request.update()
-                    request.submit()
-                    request.update()
-                if request.status == LocalStatus.REMOVING:
-                    request.remove()
+                except SQLAlchemyError as err:
+                    self.logger.exception("Error marking request %d as submitting: %s",
+                                          request.id, err)
                     continue
-                request.monitor()
-                request.update()
-            except BaseException:
-                self.logger.exception("Unhandled exception while monitoring request %d", request.id)
+                self.logger.info("Queueing request %d for submission.", request.id)
+            elif self._resume_submissions and request.status == LocalStatus.SUBMITTING \
+                    and any(job.awaiting_submission for job in request.parametric_jobs):
+                self.logger.info("Queueing request %d to resume its submission.", request.id)
+            else:
+                remaining.append(request)
+                continue
+            self._submitting[request.id] = self._submit_pool.apply_async(submit_request,
+                                                                         (request, interrupted))
+        self._resume_submissions = False
+        if self._submitting:
+            self.logger.info("%d request(s) queued or being submitted.", len(self._submitting))
+        return remaining
+
+    def queue_removals(self, monitored_requests):
+        """
+        Hand the requests marked REMOVING over to the removal queue.
+
+        Requests whose removal failed are queued again on a later cycle.
+
+        Args:
+            monitored_requests (list): The active requests
+
+        Returns:
+            list: The requests to monitor this cycle
+        """
+        for request_id, result in list(viewitems(self._removing)):
+            if result.ready():
+                del self._removing[request_id]
+
+        remaining = []
+        for request in monitored_requests:
+            if request.status != LocalStatus.REMOVING:
+                remaining.append(request)
+                continue
+            if request.id not in self._removing:
+                self.logger.info("Queueing request %d for removal.", request.id)
+                self._removing[request.id] = self._removal_pool.apply_async(remove_request,
+                                                                            (request,))
+        return remaining
+
+    def due_requests(self, monitored_requests, schedules, now):
+        """
+        Get the requests that are due to be monitored.
+
+        Requests that are new, have reached their next due time, are in one of
+        the ALWAYS_DUE_STATUSES or have parametric jobs to reschedule are due.
+
+        Args:
+            monitored_requests (list): The active requests
+            schedules (dict): The requests' MonitoringSchedule keyed by request id
+            now (datetime): The (UTC) time of this cycle
+
+        Returns:
+            list: The requests due to be monitored
+        """
+        due = []
+        for request in monitored_requests:
+            schedule = schedules.get(request.id)
+            if schedule is None or schedule.next_due <= now \
+                    or request.status in ALWAYS_DUE_STATUSES \
+                    or any(job.reschedule for job in request.parametric_jobs):
+                due.append(request)
+        if len(due) < len(monitored_requests):
+            self.logger.info("Skipping %d stable request(s) not yet due to be monitored.",
+                             len(monitored_requests) - len(due))
+        return due
+
+    def reschedule_requests(self, results, previous_statuses, schedules, now):
+        """
+        Schedule when the monitored requests are next due.
+
+        Hot requests (those that changed, failed to be monitored, are near
+        completion or in one of the ALWAYS_DUE_STATUSES) are next due after the
+        daemon's delay. The interval of stable requests doubles each time up to
+        max_poll_interval minutes. The schedules are persisted so that they
+        survive a daemon restart.
+
+        Args:
+            results (list): The MonitorResult of each request monitored
+            previous_statuses (dict): The requests' status before monitoring keyed by request id
+            schedules (dict): The requests' current MonitoringSchedule keyed by request id
+            now (datetime): The (UTC) time of this cycle
+        """
+        min_interval = int(self._delay * MINS)
+        updated = []
+        for result in results:
+            schedule = schedules.get(result.request_id)
+            if schedule is None:
+                schedule = MonitoringSchedule(request_id=result.request_id,
+                                              interval=min_interval,
+                                              last_change=now)
+            changed = result.rows_updated or result.status != previous_statuses[result.request_id]
+            if changed:
+                schedule.last_change = now
+            if changed or not result.success or result.near_completion \
+                    or result.status in ALWAYS_DUE_STATUSES:
+                schedule.interval = min_interval
+            else:
+                schedule.interval = min(2 * schedule.interval, self._max_poll_interval)
+            schedule.next_due = now + timedelta(seconds=schedule.interval)
+            updated.append(schedule)
+
+        try:
+            MonitoringSchedule.update_all(updated)
+        except SQLAlchemyError as err:
+            self.logger.exception("Error updating the monitoring schedule: %s", err)
+
+    def gather_dirac_statuses(self, monitored_requests):
+        """
+        Gather the DIRAC status of the active jobs of all monitored requests.
+
+        Rather than each parametric job querying DIRAC for its own jobs, the
+        ids from every request are gathered and queried together in large chunks.
+        In incremental mode only the status of jobs that have changed since the
+        last successful poll is asked for, with a full reconciliation of every
+        job's status every full_poll_interval minutes.
+
+        Args:
+            monitored_requests (list): The requests being monitored this cycle
+
+        Returns:
+            dict: The DiracStatus of each request's jobs keyed by request id
+        """
+        request_ids = [request.id for request in monitored_requests
+                       if request.status not in (LocalStatus.APPROVED, LocalStatus.REMOVING)]
+        request_dirac_ids = ParametricJobs.monitored_dirac_ids(request_ids)
+
+        dirac_ids = set().union(*viewvalues(request_dirac_ids))
+        if not dirac_ids:
+            return {}
+
+        now = datetime.utcnow()
+        since = None
+        if self._incremental and self._last_full_poll is not None \
+                and now - self._last_full_poll < self._full_poll_interval:
+            # Requests can be polled at different times so go back to the oldest of their polls.
+            last_polls = [self._last_poll.get(request_id) for request_id in request_dirac_ids]
+            if None not in last_polls:
+                since = min(last_polls) - INCREMENTAL_OVERLAP
+
+        self.logger.info("Gathering the DIRAC status of %d job(s) from %d request(s)%s.",
+                         len(dirac_ids), len(request_ids),
+                         '' if since is None else ' changed since %s' % since)
+        statuses, failed_ids = ParametricJobs.get_dirac_statuses(dirac_ids, since=since)
+        if failed_ids:
+            self.logger.warning("Couldn't check the status of %d DIRAC job(s).", len(failed_ids))
+        else:
+            # Only move the high-water mark on if nothing could have been missed.
+            self._last_poll.update((request_id, now) for request_id in request_dirac_ids)
+            if since is None:
+                self._last_full_poll = now
+        return {request_id: {dirac_id: statuses[dirac_id]
+                             for dirac_id in request_dirac_ids.get(request_id, ())
+                             if dirac_id in statuses}
+                for request_id in request_ids}
+
+    def _log_cycle_summary(self, results, wall_time):
+        """Log the wall time spent on each request in the monitoring cycle."""
+        if not results:
+            self.logger.info("Monitoring cycle found no requests to process.")
+            return
+
+        failed = sum(1 for result in results if not result.success)
+        rows_updated = sum(result.rows_updated for result in results)
+        lines = ["request %d: %.1fs, %d DIRAC job(s) updated%s"
+                 % (result.request_id, result.wall_time, result.rows_updated,
+                    '' if result.success else ' (FAILED)')
+                 for result in sorted(results, key=attrgetter('wall_time'), reverse=True)]
+        self.logger.info("Monitoring cycle processed %d request(s) (%d failed) updating %d "
+                         "DIRAC job(s) in %.1fs:\n    %s",
+                         len(results), failed, rows_updated, wall_time, '\n    '.join(lines))
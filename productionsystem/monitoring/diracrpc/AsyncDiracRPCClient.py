@@ -0,0 +1,227 @@
+"""
+Asyncio DIRAC RPC client.
+
+Coroutine versions of the bulk DIRAC RPC client calls. Requests are pipelined
+over a small pool of connections, each with a background thread serving the
+replies, so that many calls can be in flight at once without a thread per call.
+The number of calls in flight is bounded by a semaphore and each call has a
+timeout. Calls are recorded in metrics.CLIENT_METRICS.
+
+Unlike the rest of the package this module is Python 3 only. It supports
+Python 3.6, so sticks to the asyncio API available there.
+"""
+import asyncio
+import logging
+
+import rpyc
+from rpyc.core import consts
+
+from .DiracRPCClient import CONNECTION_CONFIG, CONNECTION_ERRORS, status_result
+from .encoding import decode_result
+from .metrics import CLIENT_METRICS
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class AsyncConnection(object):
+    """An RPC connection with a background thread serving the replies."""
+
+    def __init__(self, host, port):
+        """Connect (blocking)."""
+        self.conn = rpyc.connect(host, port, config=CONNECTION_CONFIG)
+        CLIENT_METRICS.connection_opened()
+        self.root = self.conn.root
+        self.in_flight = 0
+        # Block waiting for replies rather than the default of polling with sleeps
+        self._server = rpyc.BgServingThread(self.conn, serve_interval=0.1, sleep_interval=0)
+
+    @property
+    def closed(self):
+        """Return whether the underlying connection is closed."""
+        return self.conn.closed
+
+    def call(self, name, *args):
+        """
+        Call a method of the remote service without waiting for the reply.
+
+        Returns:
+            asyncio.Future: The future result of the call
+        """
+        loop = asyncio.get_event_loop()  # The running loop, as called from a coroutine
+        future = loop.create_future()
+
+        def set_result(result):
+            """Copy the result of the call to the future (in the event loop)."""
+            if future.done():
+                return
+            try:
+                future.set_result(result.value)
+            except Exception as err:  # pylint: disable=broad-except
+                future.set_exception(err)
+
+        def on_reply(result):
+            """Hand the reply over to the event loop (in the serving thread)."""
+            loop.call_soon_threadsafe(set_result, result)
+
+        result = self.conn.async_request(consts.HANDLE_CALLATTR, self.root, name, args, ())
+        result.add_callback(on_reply)
+        if result.ready:  # The reply may have arrived before the callback was added
+            on_reply(result)
+        return future
+
+    def close(self):
+        """Close the connection and stop the serving thread."""
+        if self._server is None:
+            return
+        CLIENT_METRICS.connection_closed()
+        try:
+            server, self._server = self._server, None
+            server.stop()
+            self.conn.close()
+        except Exception:  # pylint: disable=broad-except
+            logger.debug("Error closing async RPC connection.", exc_info=True)
+
+
+class AsyncDiracClient(object):
+    """
+    Asyncio client for the DIRAC RPC server (or gateway).
+
+    The client must be used and closed within a single event loop, preferably
+    as an async context manager. Its asyncio primitives are only created on
+    first use, so that they belong to that loop rather than whichever loop was
+    current when the client was created. Calls are spread over up to
+    max_connections connections, opening new ones as long as all the
+    existing ones are busy.
+
+    Args:
+        host (str): The DIRAC RPC server host
+        port (int): The DIRAC RPC server port
+        max_connections (int): The maximum number of connections to open
+        max_in_flight (int): The maximum number of calls in flight at once
+        timeout (float): The default per call timeout (in seconds)
+    """
+
+    def __init__(self, host="localhost", port=18861, max_connections=10, max_in_flight=100,
+                 timeout=600):
+        """Initialise."""
+        self._address = (host, port)
+        self._max_connections = max_connections
+        self._max_in_flight = max_in_flight
+        self._timeout = timeout
+        self._semaphore = None
+        self._connecting = None
+        self._connections = []
+
+    async def __aenter__(self):
+        """Enter the context."""
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """Close the connections on leaving the context."""
+        self.close()
+
+    async def _connection(self):
+        """Return the least busy connection, opening a new one if all are busy."""
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+        async with self._connecting:
+            self._connections = [conn for conn in self._connections if not conn.closed]
+            conn = min(self._connections, key=lambda conn: conn.in_flight, default=None)
+            if conn is None or (conn.in_flight and len(self._connections) < self._max_connections):
+                logger.debug("Opening new async RPC connection to %s:%d", *self._address)
+                conn = await asyncio.get_event_loop().run_in_executor(None, AsyncConnection,
+                                                                      *self._address)
+                self._connections.append(conn)
+            return conn
+
+    async def call(self, name, *args, timeout=None):
+        """
+        Call a method of the DIRAC RPC service.
+
+        Args:
+            name (str): The name of the (exposed) service method
+            *args: The arguments to call it with
+            timeout (float): The timeout for this call, defaults to the client's timeout
+
+        Raises:
+            asyncio.TimeoutError: If there was no reply in time
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_in_flight)
+        async with self._semaphore:
+            conn = await self._connection()
+            conn.in_flight += 1
+            try:
+                with CLIENT_METRICS.timed(name) as call:
+                    result = await asyncio.wait_for(conn.call(name, *args),
+                                                    self._timeout if timeout is None else timeout)
+                    if isinstance(result, bytes):
+                        call.size = len(result)
+                return result
+            except CONNECTION_ERRORS:
+                conn.close()
+                raise
+            finally:
+                conn.in_flight -= 1
+
+    async def bulk_status(self, ids, since=None, timeout=None):
+        """
+        Get the status of many DIRAC jobs in a single server side call.
+
+        Args:
+            ids (Iterable): The DIRAC job ids
+            since (str): If given, only get the status of the jobs that have changed
+                         since this UTC time ('YYYY-MM-DD HH:MM:SS')
+            timeout (float): The timeout for this call, defaults to the client's timeout
+
+        Returns:
+            dict: The DIRAC result, with the DiracStatus of each job keyed by job id
+        """
+        return status_result(await self.call('bulk_status', tuple(ids), since, timeout=timeout))
+
+    async def bulk_reschedule(self, ids, timeout=None):
+        """Reschedule many DIRAC jobs in a single server side call."""
+        return decode_result(await self.call('bulk_reschedule', tuple(ids), timeout=timeout))
+
+    async def bulk_kill_delete(self, ids, timeout=None):
+        """Kill and delete many DIRAC jobs in a single server side call."""
+        return decode_result(await self.call('bulk_kill_delete', tuple(ids), timeout=timeout))
+
+    async def submit_jdl(self, jdl, timeout=None):
+        """Submit a DIRAC job given as JDL."""
+        return decode_result(await self.call('submit_jdl', jdl, timeout=timeout))
+
+    def close(self):
+        """Close all the connections."""
+        connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+
+def run_bulk_status(chunks, since=None, host="localhost", port=18861, **kwargs):
+    """
+    Get the status of many chunks of DIRAC jobs concurrently.
+
+    Runs its own event loop so can be called from synchronous code, in any thread.
+
+    Args:
+        chunks (list): The lists of DIRAC job ids to query, one call per chunk
+        since (str): If given, only get the status of the jobs that have changed
+                     since this UTC time ('YYYY-MM-DD HH:MM:SS')
+        host (str): The DIRAC RPC server host
+        port (int): The DIRAC RPC server port
+        **kwargs: Passed on to the AsyncDiracClient
+
+    Returns:
+        list: For each chunk, in order, either the DIRAC result or the exception raised
+    """
+    async def gather():
+        """Query all the chunks."""
+        async with AsyncDiracClient(host, port, **kwargs) as client:
+            return await asyncio.gather(*(client.bulk_status(chunk, since) for chunk in chunks),
+                                        return_exceptions=True)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather())
+    finally:
+        loop.close()
@@ -5,12 +5,28 @@ from __future__ import (absolute_import, division,
 from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
 from future.utils import native_str
 
+import os
+import time
 import logging
+import threading
+from collections import deque
 from contextlib import contextmanager
 import copy
 import rpyc
+from rpyc.core.async_ import AsyncResultTimeout
+
+from productionsystem.config import getConfig
+from productionsystem.sql.enums import DiracStatus
+from .encoding import decode_result, decode_statuses
+from .metrics import CLIENT_METRICS, TimedProxy
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+CONNECTION_CONFIG = {"allow_public_attrs": True,
+                     "sync_request_timeout": 600}  # 10 mins
+# Errors after which a connection can no longer be trusted and so is not returned to the pool
+CONNECTION_ERRORS = (EOFError, IOError, AsyncResultTimeout)
+# Errors after which an idempotent call is retried once on a fresh connection
+RETRY_ERRORS = (EOFError, IOError)
 
 # This is not strictly necessary as all works without it when deep copying
 # However it bypasses the standard deepcopy implementation
@@ -30,35 +46,348 @@ netref_tuple = netref_cache[native_str('.'.join((tuple.__module__, 'tuple')))]
 copy._deepcopy_dispatch[netref_tuple] = copy._deepcopy_tuple
 
 
+class PooledConnection(object):
+    """
+    A pooled RPC connection.
+
+    Wraps the rpyc connection to cache the server side DIRAC API object so that
+    it is only constructed once per connection rather than on every use. The
+    opening and closing of the connection is counted in metrics.CLIENT_METRICS.
+    """
+
+    def __init__(self, conn):
+        """Initialise."""
+        self.conn = conn
+        self.last_used = time.time()
+        self._dirac = None
+        self._counted_open = True
+        CLIENT_METRICS.connection_opened()
+
+    @property
+    def root(self):
+        """Return the root of the remote service."""
+        return self.conn.root
+
+    @property
+    def dirac(self):
+        """Return the (cached) remote DIRAC API object."""
+        if self._dirac is None:
+            self._dirac = self.conn.root.Dirac()
+        return self._dirac
+
+    @property
+    def closed(self):
+        """Return whether the underlying connection is closed."""
+        return self.conn.closed
+
+    def close(self):
+        """Close the underlying connection."""
+        if self._counted_open:
+            self._counted_open = False
+            CLIENT_METRICS.connection_closed()
+        try:
+            self.conn.close()
+        except Exception:  # pylint: disable=broad-except
+            logger.debug("Error closing RPC connection.", exc_info=True)
+
+
+class RPCConnectionPool(object):
+    """
+    Thread-safe pool of persistent RPC connections to a DIRAC RPC server.
+
+    Connections are pinged before being handed out, replacing any that fail,
+    and those left idle for longer than idle_timeout are closed. At most
+    max_size idle connections are kept, surplus ones are closed when returned.
+    The pool never blocks, new connections are opened whenever none are idle.
+    Idempotent calls made through call are retried once on a fresh connection
+    if the connection drops.
+    """
+
+    def __init__(self, host="localhost", port=18861, max_size=10, idle_timeout=300,
+                 ping_timeout=10):
+        """Initialise."""
+        self._address = (host, port)
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._ping_timeout = ping_timeout
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        """Open a new connection."""
+        logger.debug("Opening new RPC connection to %s:%d", *self._address)
+        return PooledConnection(rpyc.connect(*self._address, config=CONNECTION_CONFIG))
+
+    def _is_healthy(self, conn):
+        """Check the connection is still alive."""
+        if conn.closed:
+            return False
+        try:
+            conn.conn.ping(timeout=self._ping_timeout)
+        except Exception:  # pylint: disable=broad-except
+            logger.debug("Dropping RPC connection that failed ping.", exc_info=True)
+            return False
+        return True
+
+    def _pop_idle(self):
+        """Pop the most recently used idle connection, evicting any that have expired."""
+        expired = []
+        conn = None
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked, the inherited connections belong to the parent process.
+                self._idle.clear()
+                self._pid = os.getpid()
+            cutoff = time.time() - self._idle_timeout
+            while self._idle and self._idle[0].last_used < cutoff:
+                expired.append(self._idle.popleft())
+            if self._idle:
+                conn = self._idle.pop()
+        for expired_conn in expired:
+            expired_conn.close()
+        if expired:
+            logger.debug("Evicted %d idle RPC connection(s).", len(expired))
+        return conn
+
+    def acquire(self):
+        """Borrow a healthy connection from the pool, connecting if necessary."""
+        conn = self._pop_idle()
+        while conn is not None:
+            if self._is_healthy(conn):
+                return conn
+            conn.close()
+            conn = self._pop_idle()
+        return self._connect()
+
+    def release(self, conn, discard=False):
+        """Return a borrowed connection to the pool."""
+        if not discard and not conn.closed:
+            conn.last_used = time.time()
+            with self._lock:
+                if len(self._idle) < self._max_size and self._pid == os.getpid():
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    @contextmanager
+    def connection(self, fresh=False):
+        """Borrowed connection context, with a newly opened connection if fresh."""
+        conn = self._connect() if fresh else self.acquire()
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        self.release(conn)
+
+    def call(self, func):
+        """
+        Call func with a borrowed connection, retrying once on a fresh one if it drops.
+
+        A pooled connection can pass its ping and still be dropped before the
+        call completes, e.g. by a restarting server. Only use this for idempotent
+        calls, such as status queries, as the dropped call may still have been
+        carried out server side.
+
+        Args:
+            func (callable): Called with the PooledConnection to make the call
+
+        Returns:
+            The result of func
+        """
+        try:
+            with self.connection() as conn:
+                return func(conn)
+        except RETRY_ERRORS as err:
+            logger.warning("Retrying RPC call on a fresh connection after: %r", err)
+        with self.connection(fresh=True) as conn:
+            return func(conn)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(host="localhost", port=18861):
+    """
+    Get the connection pool for a given server.
+
+    The pool is configured from the diracrpc config section options
+    pool_size, pool_idle_timeout and pool_ping_timeout.
+    """
+    with _POOLS_LOCK:
+        pool = _POOLS.get((host, port))
+        if pool is None:
+            config = getConfig("diracrpc")
+            pool = RPCConnectionPool(host, port,
+                                     max_size=config.get("pool_size", 10),
+                                     idle_timeout=config.get("pool_idle_timeout", 300),
+                                     ping_timeout=config.get("pool_ping_timeout", 10))
+            _POOLS[(host, port)] = pool
+        return pool
+
+
+def close_pools():
+    """Close the idle connections in all pools."""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    for pool in pools:
+        pool.close()
+
+
 # Used in Solid to list the DIRAC file catalogue
 @contextmanager
 def dirac_rpc_client(rpc_endpoint, host="localhost", port=18861):
-    """RPC DIRAC RPC client context."""
-    conn = rpyc.connect(host, port, config={"allow_public_attrs": True,
-                                            "sync_request_timeout": 600})  # 10 mins
-    try:
-        yield conn.root.RPCClient(rpc_endpoint)
-    finally:
-        conn.close()
+    """RPC DIRAC RPC client context, its calls are timed."""
+    with get_pool(host, port).connection() as conn:
+        yield TimedProxy(conn.root.RPCClient(rpc_endpoint), CLIENT_METRICS, 'RPCClient')
 
 
 @contextmanager
 def dirac_api_client(host="localhost", port=18861):
-    """RPC DIRAC API client context."""
-    conn = rpyc.connect(host, port, config={"allow_public_attrs": True,
-                                            "sync_request_timeout": 600})
-    try:
-        yield conn.root.Dirac()
-    finally:
-        conn.close()
+    """RPC DIRAC API client context, its calls are timed."""
+    with get_pool(host, port).connection() as conn:
+        yield TimedProxy(conn.dirac, CLIENT_METRICS, 'Dirac')
 
 
 @contextmanager
 def dirac_api_job_client(host="localhost", port=18861):
-    """RPC DIRAC API client and DIRAC job handle context."""
-    conn = rpyc.connect(host, port, config={"allow_public_attrs": True,
-                                            "sync_request_timeout": 600})
+    """RPC DIRAC API client (timed) and DIRAC job handle context."""
+    with get_pool(host, port).connection() as conn:
+        yield TimedProxy(conn.dirac, CLIENT_METRICS, 'Dirac'), conn.root.Job
+
+
+def _dirac_status(name):
+    """Convert a DIRAC status name to a DiracStatus."""
     try:
-        yield conn.root.Dirac(), conn.root.Job
-    finally:
-        conn.close()
+        return DiracStatus[name.upper()]  # pylint: disable=unsubscriptable-object
+    except KeyError:
+        logger.warning("Unknown DiracStatus: %s. Setting to UNKNOWN", name.upper())
+        return DiracStatus.UNKNOWN
+
+
+def status_result(payload):
+    """
+    Decode the payload returned by the bulk_status server method.
+
+    Returns:
+        dict: The DIRAC result, with the DiracStatus of each job keyed by job id
+    """
+    header, job_ids, indices = decode_statuses(payload)
+    if not header['OK']:
+        return {'OK': False, 'Message': header['Message']}
+    statuses = [_dirac_status(name) for name in header['Statuses']]
+    return {'OK': True, 'Value': dict(zip(job_ids, (statuses[index] for index in indices)))}
+
+
+def bulk_status(ids, since=None, host="localhost", port=18861):
+    """
+    Get the status of many DIRAC jobs in a single server side call.
+
+    The statuses come back as a single compact payload rather than as a netref.
+
+    Args:
+        ids (Iterable): The DIRAC job ids
+        since (str): If given, only get the status of the jobs that have changed
+                     since this UTC time ('YYYY-MM-DD HH:MM:SS')
+
+    Returns:
+        dict: The DIRAC result, with the DiracStatus of each job keyed by job id
+    """
+    ids = tuple(ids)
+
+    def fetch(conn):
+        """Fetch the statuses over a pooled connection."""
+        with CLIENT_METRICS.timed('bulk_status') as call:
+            payload = conn.root.bulk_status(ids, since)
+            call.size = len(payload)
+        return payload
+    return status_result(get_pool(host, port).call(fetch))
+
+
+def bulk_reschedule(ids, host="localhost", port=18861):
+    """Reschedule many DIRAC jobs in a single server side call."""
+    with get_pool(host, port).connection() as conn, \
+            CLIENT_METRICS.timed('bulk_reschedule') as call:
+        payload = conn.root.bulk_reschedule(tuple(ids))
+        call.size = len(payload)
+    return decode_result(payload)
+
+
+def bulk_kill_delete(ids, host="localhost", port=18861):
+    """Kill and delete many DIRAC jobs in a single server side call."""
+    with get_pool(host, port).connection() as conn, \
+            CLIENT_METRICS.timed('bulk_kill_delete') as call:
+        payload = conn.root.bulk_kill_delete(tuple(ids))
+        call.size = len(payload)
+    return decode_result(payload)
+
+
+def submit_jdls(jdls, host="localhost", port=18861):
+    """
+    Submit many DIRAC jobs given as JDL, one after the other.
+
+    This is a generator yielding the DIRAC result of each submission as soon
+    as it is known. Each result is fetched as a separate call so the RPC
+    timeout applies to each submission rather than to them all.
+    """
+    with get_pool(host, port).connection() as conn:
+        for payload in CLIENT_METRICS.timed_iter('submit_jdls', conn.root.submit_jdls(tuple(jdls))):
+            yield decode_result(payload)
+
+
+def list_directories(paths, depth=0, page_size=1000, batch_size=100,
+                     rpc_endpoint='DataManagement/FileCatalog', host="localhost", port=18861):
+    """
+    List many DIRAC file catalogue directories and their subdirectories.
+
+    The listing is done server side in batches and cached there. This is a
+    generator yielding the DIRAC result of each page of listings as it arrives,
+    each holding the listings of up to page_size directories. If the connection
+    drops before the first page arrives the listing is retried once on a fresh
+    connection.
+
+    Args:
+        paths (Iterable): The directories to list
+        depth (int): How many levels of subdirectories to list, None for all
+        page_size (int): The maximum number of directories per page
+        batch_size (int): The maximum number of directories listed per DIRAC call
+        rpc_endpoint (str): The DIRAC file catalogue service
+
+    Yields:
+        dict: The DIRAC result of each page, with Successful and Failed dicts keyed by path
+    """
+    paths = tuple(paths)
+    pool = get_pool(host, port)
+    for fresh in (False, True):
+        started = False
+        try:
+            with pool.connection(fresh=fresh) as conn:
+                pages = conn.root.list_directories(paths, depth, page_size, batch_size,
+                                                   rpc_endpoint)
+                for payload in CLIENT_METRICS.timed_iter('list_directories', pages):
+                    started = True
+                    yield decode_result(payload)
+            return
+        except RETRY_ERRORS as err:
+            if fresh or started:
+                raise
+            logger.warning("Retrying RPC listing on a fresh connection after: %r", err)
+
+
+def status_cache_stats(host="localhost", port=18861):
+    """Return the DIRAC RPC server's status cache hit, miss and eviction counts."""
+    with get_pool(host, port).connection() as conn:
+        return decode_result(conn.root.status_cache_stats())
@@ -6,14 +6,17 @@ from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-impor
 from future.utils import text_to_native_str
 
 import logging
+import threading
+from functools import partial
 # from types import FunctionType
-import rpyc
-from rpyc.utils.server import ThreadedServer
-from daemonize import Daemonize
 # pylint: disable=import-error
 from DIRAC.Interfaces.API.Job import Job
 from DIRAC.Interfaces.API.Dirac import Dirac
 from DIRAC.Core.DISET.RPCClient import RPCClient
+from DIRAC.Core.Security.ProxyInfo import getProxyInfo
+# pylint: enable=import-error
+from .cache import TTLCache
+from .service import BaseDiracDaemon, BaseDiracService, init_dirac_worker
 
 # logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -45,10 +48,23 @@ class FixedJob(Job):
         """Set the job Priority."""
         super(FixedJob, self)._setParamValue(text_to_native_str("Priority"), priority)
 
+    def toJDL(self):  # pylint: disable=invalid-name
+        """
+        Return the job's JDL.
+
+        The private _toJDL is not accessible over RPC. The JDL string can be
+        submitted over a different connection to the one the job was created on.
+        """
+        return self._toJDL()
+
 
 class FixedDirac(Dirac):
     """Fixed DIRAC Dirac class."""
 
+    # The ids of the jobs changed since a given time, keyed by that time, for all connections.
+    changed_since_cache = TTLCache(ttl=10, max_entries=10)
+    _changed_since_lock = threading.Lock()
+
     def getJobStatus(self, jobid):
         """
         Return the status of DIRAC jobs.
@@ -73,6 +89,51 @@ class FixedDirac(Dirac):
             jobid = list(jobid)
         return super(FixedDirac, self).rescheduleJob(jobid)
 
+    def _changed_since(self, since):
+        """
+        Return the ids of the jobs owned by us that have changed since a given time.
+
+        The JobMonitoring getJobs selection is scoped to the owner and group of
+        our proxy. The chunks of one incremental poll all ask for the same since
+        so the result is cached briefly, and the query made once, for them all.
+        """
+        with self._changed_since_lock:
+            cached, _ = self.changed_since_cache.get_many([since])
+            if cached:
+                return {'OK': True, 'Value': cached[since]}
+            result = getProxyInfo(disableVOMS=True)
+            if not result['OK']:
+                return result
+            selection = {text_to_native_str('Owner'): result['Value']['username'],
+                         text_to_native_str('OwnerGroup'): result['Value']['group']}
+            result = RPCClient(text_to_native_str('WorkloadManagement/JobMonitoring'))\
+                .getJobs(selection, text_to_native_str(since))
+            if not result['OK']:
+                return result
+            changed_ids = frozenset(int(i) for i in result['Value'])
+            self.changed_since_cache.update({since: changed_ids})
+            return {'OK': True, 'Value': changed_ids}
+
+    def getJobStatusChangedSince(self, jobid, since):
+        """
+        Return the status of those DIRAC jobs that have changed since a given time.
+
+        The jobs with a LastUpdateTime later than since are found with
+        _changed_since. Only the status of those among the given jobs is then
+        looked up.
+
+        Args:
+            jobid (list): The DIRAC job ids of interest
+            since (str): The UTC cut off time as 'YYYY-MM-DD HH:MM:SS'
+        """
+        result = self._changed_since(since)
+        if not result['OK']:
+            return result
+        changed_ids = result['Value'].intersection(jobid)
+        if not changed_ids:
+            return {'OK': True, 'Value': {}}
+        return super(FixedDirac, self).getJobStatus(list(changed_ids))
+
 
 # Switched from inheritance to composition as the DIRAC _MagicMethods were
 # not playing nicely with RPyC. using composition as a wrapper is better as
@@ -89,31 +150,19 @@ class RPCClientWrapper(object):
         return self._wrapped.listDirectory(*args)
 
 
-class DiracService(rpyc.Service):
-    """DIRAC RPyC Service."""
+class DiracService(BaseDiracService):
+    """DIRAC RPyC Service exposing the (fixed) DIRAC API classes."""
 
     exposed_Job = FixedJob
     exposed_Dirac = FixedDirac
     exposed_RPCClient = RPCClientWrapper
 
 
-class DiracDaemon(Daemonize):
-    """DIRAC daemon to host the server."""
+class DiracDaemon(BaseDiracDaemon):
+    """DIRAC daemon to host the DIRAC RPC service."""
 
-    def __init__(self, address, **kwargs):
-        """Initialise."""
-        self._address = address
-        super(DiracDaemon, self).__init__(action=self.main, **kwargs)
-
-    def main(self):
-        """Daemon main."""
-        # Set up the threaded server in the daemon main
-        # else the file descriptors will be closed when daemon starts.
-        hostname, port = self._address
-        ThreadedServer(DiracService,
-                       hostname=hostname,
-                       port=port,
-                       logger=self.logger,
-                       protocol_config={"allow_public_attrs": True,
-                                        "sync_request_timeout": 600,  # 10 mins
-                                        "allow_pickle": True}).start()
+    service = DiracService
+
+    def worker_initializer(self):
+        """Return the picklable callable initialising DIRAC in each gateway worker."""
+        return partial(init_dirac_worker, super(DiracDaemon, self).worker_initializer())
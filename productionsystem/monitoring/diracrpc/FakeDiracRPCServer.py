@@ -0,0 +1,424 @@
+"""
+Local DIRAC stand-in RPC Server.
+
+Serves the same RPC surface as DiracRPCServer but with the DIRAC API replaced
+by an in-memory fake, so that job submission and monitoring can be exercised
+and load tested without a DIRAC install. The fake can be set up with a per call
+latency, a rate of failed calls, the schedule of statuses the jobs go through
+and a number of existing jobs to start with. Given a seed, which jobs fail is
+reproducible.
+
+The fake jobs live in the memory of the serving process. When run behind a
+gateway each worker process sets up its own backend with the initial jobs but
+jobs submitted or changed through one worker are not seen by the others.
+"""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+from future.utils import viewitems
+
+import time
+import random
+import calendar
+import threading
+from functools import partial
+from collections import OrderedDict
+
+from .jdl import PARAMETERS_REGEX, job_count
+from .service import BaseDiracDaemon, BaseDiracService
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# The statuses a job goes through and how long it spends in each (in seconds).
+# The last is final, unless the job fails in which case it ends up Failed instead.
+DEFAULT_SCHEDULE = (('Received', 1), ('Waiting', 5), ('Running', 30), ('Done', None))
+MINOR_STATUSES = {'Received': 'Job accepted',
+                  'Waiting': 'Pilot Agent Submission',
+                  'Running': 'Application',
+                  'Done': 'Execution Complete',
+                  'Failed': 'Application Finished With Errors',
+                  'Killed': 'Marked for termination',
+                  'Deleted': 'Checking accounting'}
+
+
+def parse_schedule(schedule):
+    """
+    Parse a status schedule given as a string.
+
+    Args:
+        schedule (str): Comma separated status:seconds pairs followed by the
+                        final status, e.g. 'Received:1,Waiting:5,Running:30,Done'
+
+    Returns:
+        tuple: The (status, seconds) pairs, the last with seconds None
+    """
+    steps = [step.strip() for step in schedule.split(',')]
+    final = steps.pop()
+    parsed = []
+    for step in steps:
+        status, _, duration = step.partition(':')
+        parsed.append((status.strip(), float(duration)))
+    parsed.append((final.partition(':')[0], None))
+    return tuple(parsed)
+
+
+def _format_time(timestamp):
+    """Return a UTC timestamp formatted the way DIRAC does."""
+    return time.strftime(TIME_FORMAT, time.gmtime(timestamp))
+
+
+def _jdl_value(value):
+    """Return a parameter value formatted as JDL."""
+    if isinstance(value, (list, tuple)):
+        return '{%s}' % ', '.join(_jdl_value(item) for item in value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return '"%s"' % value
+
+
+class _FakeJobRecord(object):
+    """The state of a single fake DIRAC job."""
+
+    __slots__ = ('submitted', 'failed', 'override')
+
+    def __init__(self, submitted, failed):
+        """Initialise."""
+        self.submitted = submitted
+        self.failed = failed
+        self.override = None  # (status, time) once killed or deleted
+
+
+class FakeDiracBackend(object):
+    """
+    Thread-safe in-memory store of fake DIRAC jobs.
+
+    The status of a job is worked out from how long ago it was (re)submitted
+    and the schedule, so jobs progress without any background activity.
+
+    Args:
+        latency (float): How long each call takes (in seconds)
+        job_latency (float): How much longer each call takes per job (in seconds)
+        failure_rate (float): The fraction of calls that fail
+        job_failure_rate (float): The fraction of jobs that end up Failed
+        schedule (tuple): The (status, seconds) pairs jobs go through, see parse_schedule
+        jobs (int): The number of jobs to start with, submitted at random over the
+                    length of the schedule so that they are spread over its statuses
+        seed (int): Seed for the random choice of failed calls and jobs
+        catalogue_depth (int): How many levels of subdirectories the file catalogue has
+        catalogue_fanout (int): The number of subdirectories in each catalogue directory
+        catalogue_files (int): The number of files in each catalogue directory
+    """
+
+    def __init__(self, latency=0., job_latency=0., failure_rate=0., job_failure_rate=0.,
+                 schedule=DEFAULT_SCHEDULE, jobs=0, seed=None, catalogue_depth=0,
+                 catalogue_fanout=0, catalogue_files=0):
+        """Initialise."""
+        self.latency = latency
+        self.job_latency = job_latency
+        self.failure_rate = failure_rate
+        self.job_failure_rate = job_failure_rate
+        self.schedule = parse_schedule(schedule) if isinstance(schedule, str) else schedule
+        self.catalogue_depth = catalogue_depth
+        self.catalogue_fanout = catalogue_fanout
+        self.catalogue_files = catalogue_files
+        self.calls = 0
+        self.failed_calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._next_id = 1
+        if jobs:
+            span = sum(duration for _, duration in self.schedule[:-1])
+            now = time.time()
+            self.add_jobs(jobs, submitted=lambda: now - self._random.random() * span)
+
+    def call(self, jobs=1):
+        """
+        Account for a DIRAC API call, sleeping for its latency.
+
+        Args:
+            jobs (int): The number of jobs the call is about
+
+        Returns:
+            dict: The DIRAC error result if the call fails, otherwise None
+        """
+        delay = self.latency + jobs * self.job_latency
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            self.calls += 1
+            if self._random.random() >= self.failure_rate:
+                return None
+            self.failed_calls += 1
+        return {'OK': False, 'Message': 'Fake DIRAC failure'}
+
+    def add_jobs(self, count, submitted=None):
+        """
+        Create new jobs.
+
+        Args:
+            count (int): The number of jobs
+            submitted (callable): Returns the submission time of each job, defaults to now
+
+        Returns:
+            list: The new job ids
+        """
+        if submitted is None:
+            now = time.time()
+            submitted = lambda: now  # pylint: disable=unnecessary-lambda-assignment
+        with self._lock:
+            ids = list(range(self._next_id, self._next_id + count))
+            self._next_id += count
+            for job_id in ids:
+                self._jobs[job_id] = _FakeJobRecord(submitted(),
+                                                    self._random.random() < self.job_failure_rate)
+        return ids
+
+    def _state(self, job, now):
+        """Return the status of a job and when it last changed."""
+        if job.override is not None:
+            return job.override
+        elapsed = now - job.submitted
+        changed = job.submitted
+        for status, duration in self.schedule[:-1]:
+            if elapsed < duration:
+                return status, changed
+            elapsed -= duration
+            changed += duration
+        return 'Failed' if job.failed else self.schedule[-1][0], changed
+
+    def statuses(self, ids, since=None):
+        """
+        Return the DIRAC status information of the known jobs among ids.
+
+        Args:
+            ids (Iterable): The DIRAC job ids
+            since (float): If given, only include the jobs that changed after this time
+        """
+        now = time.time()
+        statuses = {}
+        with self._lock:
+            for job_id in ids:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    continue
+                status, changed = self._state(job, now)
+                if since is not None and changed <= since:
+                    continue
+                statuses[job_id] = {'Status': status,
+                                    'MinorStatus': MINOR_STATUSES.get(status, ''),
+                                    'LastUpdateTime': _format_time(changed),
+                                    'Site': 'ANY'}
+        return statuses
+
+    def reschedule(self, ids):
+        """Resubmit the known, not deleted, jobs among ids and return their ids."""
+        now = time.time()
+        rescheduled = []
+        with self._lock:
+            for job_id in ids:
+                job = self._jobs.get(job_id)
+                if job is None or (job.override and job.override[0] == 'Deleted'):
+                    continue
+                job.submitted = now
+                job.failed = self._random.random() < self.job_failure_rate
+                job.override = None
+                rescheduled.append(job_id)
+        return rescheduled
+
+    def set_status(self, ids, status):
+        """Force the known jobs among ids into the given (final) status."""
+        now = time.time()
+        with self._lock:
+            for job_id in ids:
+                job = self._jobs.get(job_id)
+                if job is not None and (job.override is None or job.override[0] != 'Deleted'):
+                    job.override = (status, now)
+
+    def listing(self, path):
+        """
+        Return the file catalogue listing of a directory.
+
+        Every directory less than catalogue_depth levels deep has the same
+        number of subdirectories and files.
+        """
+        path = path.rstrip('/')
+        level = len([part for part in path.split('/') if part])
+        subdirs = self.catalogue_fanout if level < self.catalogue_depth else 0
+        return {'Files': {'%s/file%d' % (path, index): {'MetaData': {'Size': 1024}}
+                          for index in range(self.catalogue_files)},
+                'SubDirs': {'%s/dir%d' % (path, index): {} for index in range(subdirs)},
+                'Links': {}}
+
+    def __len__(self):
+        """Return the number of jobs."""
+        return len(self._jobs)
+
+
+def _as_ids(jobid):
+    """Return a DIRAC API job id argument as a list of ints."""
+    if isinstance(jobid, (int, str)):
+        return [int(jobid)]
+    return [int(job_id) for job_id in jobid]
+
+
+class FakeJob(object):
+    """
+    Stand-in for the DIRAC Job class.
+
+    Any setXxx method records the Xxx parameter, which is enough to build the
+    JDL. setParameterSequence makes it a parametric job.
+    """
+
+    def __init__(self):
+        """Initialise."""
+        self._parameters = OrderedDict()
+
+    def _setParamValue(self, name, value):  # pylint: disable=invalid-name
+        """Set a JDL parameter."""
+        self._parameters[name] = value
+
+    def setParameterSequence(self, name, values, addToWorkflow=False):  # pylint: disable=invalid-name, unused-argument
+        """Make this a parametric job, one per value."""
+        values = list(values)
+        self._parameters['Parameters'] = len(values)
+        self._parameters['Parameters.%s' % name] = values
+
+    def setInputSandbox(self, files):  # pylint: disable=invalid-name
+        """Set the input sandbox."""
+        self._parameters['InputSandbox'] = [files] if isinstance(files, str) else list(files)
+
+    def __getattr__(self, name):
+        """Return a setter recording the parameter for any other setXxx method."""
+        if not name.startswith('set') or name.startswith('set_'):
+            raise AttributeError(name)
+
+        def setter(*args, **kwargs):  # pylint: disable=unused-argument
+            """Record the parameter."""
+            self._setParamValue(name[3:], args[0] if len(args) == 1 else list(args))
+        return setter
+
+    def toJDL(self):  # pylint: disable=invalid-name
+        """Return the job's JDL."""
+        return '[\n%s]' % ''.join('    %s = %s;\n' % (name, _jdl_value(value))
+                                  for name, value in viewitems(self._parameters))
+
+
+class FakeDirac(object):
+    """
+    Stand-in for the DIRAC Dirac API class.
+
+    All instances share the jobs of the class level backend unless given their own.
+    """
+
+    backend = FakeDiracBackend()
+
+    def __init__(self, backend=None):
+        """Initialise."""
+        if backend is not None:
+            self.backend = backend
+
+    def submitJob(self, job):  # pylint: disable=invalid-name
+        """Submit a job given as a Job or JDL, returning the list of ids if parametric."""
+        jdl = job if isinstance(job, str) else job.toJDL()
+        count = job_count(jdl)
+        error = self.backend.call(count)
+        if error is not None:
+            return error
+        ids = self.backend.add_jobs(count)
+        if PARAMETERS_REGEX.search(jdl) is None:
+            return {'OK': True, 'Value': ids[0]}
+        return {'OK': True, 'Value': ids}
+
+    def getJobStatus(self, jobid):  # pylint: disable=invalid-name
+        """Return the status of DIRAC jobs."""
+        ids = _as_ids(jobid)
+        return self.backend.call(len(ids)) or {'OK': True, 'Value': self.backend.statuses(ids)}
+
+    def getJobStatusChangedSince(self, jobid, since):  # pylint: disable=invalid-name
+        """Return the status of those DIRAC jobs that have changed since a given UTC time."""
+        ids = _as_ids(jobid)
+        since = calendar.timegm(time.strptime(since, TIME_FORMAT))
+        return self.backend.call(len(ids)) or {'OK': True,
+                                               'Value': self.backend.statuses(ids, since)}
+
+    def rescheduleJob(self, jobid):  # pylint: disable=invalid-name
+        """Reschedule the given jobs."""
+        ids = _as_ids(jobid)
+        return self.backend.call(len(ids)) or {'OK': True, 'Value': self.backend.reschedule(ids)}
+
+    def killJob(self, jobid):  # pylint: disable=invalid-name
+        """Kill the given jobs."""
+        ids = _as_ids(jobid)
+        error = self.backend.call(len(ids))
+        if error is not None:
+            return error
+        self.backend.set_status(ids, 'Killed')
+        return {'OK': True, 'Value': ids}
+
+    def deleteJob(self, jobid):  # pylint: disable=invalid-name
+        """Delete the given jobs."""
+        ids = _as_ids(jobid)
+        error = self.backend.call(len(ids))
+        if error is not None:
+            return error
+        self.backend.set_status(ids, 'Deleted')
+        return {'OK': True, 'Value': ids}
+
+
+class FakeRPCClient(object):
+    """Stand-in for the DIRAC RPC Client, listing the backend's file catalogue."""
+
+    def __init__(self, *args, **kwargs):  # pylint: disable=unused-argument
+        """Initialise."""
+
+    def listDirectory(self, paths, *args):  # pylint: disable=invalid-name, no-self-use, unused-argument
+        """List one or more directories."""
+        paths = [paths] if isinstance(paths, str) else list(paths)
+        backend = FakeDirac.backend
+        return backend.call(len(paths)) or {'OK': True,
+                                            'Value': {'Successful': {path: backend.listing(path)
+                                                                     for path in paths},
+                                                      'Failed': {}}}
+
+
+class FakeDiracService(BaseDiracService):
+    """DIRAC RPyC Service exposing the stand-in DIRAC API classes."""
+
+    exposed_Job = FakeJob
+    exposed_Dirac = FakeDirac
+    exposed_RPCClient = FakeRPCClient
+
+
+def init_fake_worker(backend_kwargs, configure):
+    """Set up the DIRAC stand-in backend and service in a gateway worker process."""
+    FakeDirac.backend = FakeDiracBackend(**backend_kwargs)
+    configure()
+
+
+class FakeDiracDaemon(BaseDiracDaemon):
+    """
+    Daemon to host the DIRAC stand-in server.
+
+    The backend arguments (see FakeDiracBackend) are taken as keyword
+    arguments prefixed with fake_, e.g. fake_latency.
+    """
+
+    service = FakeDiracService
+
+    def __init__(self, address, **kwargs):
+        """Initialise."""
+        self._backend_kwargs = {key[len('fake_'):]: kwargs.pop(key)
+                                for key in list(kwargs) if key.startswith('fake_')}
+        super(FakeDiracDaemon, self).__init__(address, **kwargs)
+
+    def worker_initializer(self):
+        """Return the picklable callable setting up the backend in each gateway worker."""
+        return partial(init_fake_worker, self._backend_kwargs,
+                       super(FakeDiracDaemon, self).worker_initializer())
+
+    def main(self):
+        """Daemon main."""
+        FakeDirac.backend = FakeDiracBackend(**self._backend_kwargs)
+        self.logger.info("Starting DIRAC stand-in with %d existing jobs", len(FakeDirac.backend))
+        super(FakeDiracDaemon, self).main()
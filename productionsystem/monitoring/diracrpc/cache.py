@@ -0,0 +1,118 @@
+"""
+Server side caches of DIRAC job statuses and file catalogue listings.
+
+This module must not depend on anything outside the standard library and
+future as it is imported by the server.
+"""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+from future.utils import viewitems
+
+import time
+import threading
+from collections import OrderedDict
+
+# The parts of the DIRAC job status information that are cached
+CACHED_FIELDS = ('Status', 'MinorStatus', 'LastUpdateTime')
+
+
+class TTLCache(object):
+    """
+    Thread-safe TTL and LRU cache of DIRAC results.
+
+    Values are served from the cache for up to ttl seconds after they were
+    fetched from DIRAC. Once more than max_entries are cached the least
+    recently used are evicted. A ttl of 0 disables the cache.
+
+    Args:
+        ttl (float): How long a value is valid for (in seconds)
+        max_entries (int): The maximum number of values to cache
+    """
+
+    def __init__(self, ttl=10, max_entries=100000):
+        """Initialise."""
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached_value(self, value):  # pylint: disable=no-self-use
+        """Return the part of a value that is cached."""
+        return value
+
+    def get_many(self, keys):
+        """
+        Look up many values.
+
+        Args:
+            keys (Iterable): The keys, e.g. DIRAC job ids
+
+        Returns:
+            tuple: The cached values keyed by key and the list of
+                   keys that were not found or had expired
+        """
+        found = {}
+        missing = []
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None or entry[0] < now:
+                    missing.append(key)
+                    continue
+                self._entries.pop(key)
+                self._entries[key] = entry  # move to most recently used
+                found[key] = entry[1]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def update(self, values):
+        """
+        Cache freshly fetched values.
+
+        Args:
+            values (dict): The values keyed by key
+        """
+        if not self.ttl:
+            return
+        expiry = time.time() + self.ttl
+        with self._lock:
+            for key, value in viewitems(values):
+                self._entries.pop(key, None)
+                self._entries[key] = (expiry, self._cached_value(value))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        """
+        Remove values from the cache, e.g. after jobs have been rescheduled.
+
+        Args:
+            keys (Iterable): The keys
+        """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        """Return the hit, miss and eviction counts along with the number of cached values."""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries)}
+
+
+class StatusCache(TTLCache):
+    """TTL and LRU cache of DIRAC job status information keyed by job id."""
+
+    def _cached_value(self, value):
+        """Return the status fields of the job's status information."""
+        return {field: value[field] for field in CACHED_FIELDS if field in value}
@@ -0,0 +1,92 @@
+"""
+Wire encoding of the DIRAC results returned by the bulk RPC methods.
+
+The results are returned as bytes, which are passed by value over RPC rather
+than as a netref, so the client gets the whole result in a single round trip.
+Most are simply JSON encoded. The status of many jobs is sent as a compact
+payload laid out as:
+
+    * the length of the header as a little-endian uint32
+    * a JSON header {"OK": ..., "Message": ..., "Statuses": [...], "Count": n}
+    * n little-endian int64 job ids
+    * n uint8 indices into the header's list of distinct status names
+
+Error results are just the header with no job data. This module must not
+depend on anything outside the standard library and future as it is imported
+by the server.
+"""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+from future.utils import text_to_native_str, viewitems
+
+import json
+import struct
+
+HEADER_LENGTH = struct.Struct(text_to_native_str('<I'))
+
+
+def _format(code, count):
+    """Return the struct format of count little-endian values of the given type code."""
+    return text_to_native_str('<%d%s' % (count, code))
+
+
+def encode_result(result):
+    """Serialise a DIRAC result to JSON bytes."""
+    return json.dumps(result, default=str).encode('utf-8')
+
+
+def decode_result(payload):
+    """Deserialise a DIRAC result made by encode_result."""
+    return json.loads(payload.decode('utf-8'))
+
+
+def encode_statuses(result):
+    """
+    Encode a DIRAC getJobStatus result.
+
+    Args:
+        result (dict): The DIRAC result with the status information keyed by job id
+
+    Returns:
+        bytes: The encoded payload
+    """
+    if not result['OK']:
+        header = json.dumps({'OK': False, 'Message': result['Message']}, default=str)
+        header = header.encode('utf-8')
+        return HEADER_LENGTH.pack(len(header)) + header
+
+    statuses = sorted(viewitems(result['Value']))
+    names = sorted({info['Status'] for _, info in statuses})
+    if len(names) > 255:
+        raise ValueError("Too many distinct statuses to encode: %d" % len(names))
+    indices = {name: index for index, name in enumerate(names)}
+    header = json.dumps({'OK': True, 'Statuses': names, 'Count': len(statuses)}).encode('utf-8')
+    return b''.join((HEADER_LENGTH.pack(len(header)),
+                     header,
+                     struct.pack(_format('q', len(statuses)),
+                                 *(int(job_id) for job_id, _ in statuses)),
+                     struct.pack(_format('B', len(statuses)),
+                                 *(indices[info['Status']] for _, info in statuses))))
+
+
+def decode_statuses(payload):
+    """
+    Decode a payload made by encode_statuses.
+
+    Returns:
+        tuple: The decoded header dict, the job ids and for each job the
+               index of its status in the header's Statuses list
+    """
+    header_length, = HEADER_LENGTH.unpack_from(payload)
+    offset = HEADER_LENGTH.size
+    header = json.loads(payload[offset:offset + header_length].decode('utf-8'))
+    if not header['OK']:
+        return header, (), ()
+
+    count = header['Count']
+    offset += header_length
+    job_ids = struct.unpack_from(_format('q', count), payload, offset)
+    indices = struct.unpack_from(_format('B', count), payload, offset + 8 * count)
+    return header, job_ids, indices
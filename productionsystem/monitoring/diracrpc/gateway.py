@@ -0,0 +1,580 @@
+"""
+Multi-process DIRAC RPC gateway.
+
+A single listening rpyc endpoint in front of a pool of worker processes, each
+running its own DIRAC RPC service. This spreads the DIRAC client work over
+several processes rather than serialising it all behind one GIL.
+
+The coarse grained bulk calls are routed to an idle worker, waiting for one to
+become free if need be. Once queue_depth calls are already waiting, further
+calls are rejected straight away with a DIRAC style error result rather than
+piling up. Access to the raw DIRAC API classes (Job, Dirac, RPCClient) is pinned
+per client connection to a single worker so that objects created through it can
+be used together. Jobs changed through one worker are dropped from the status
+caches of all the others. Workers are recycled after serving max_calls bulk calls or
+once their peak memory has grown by more than max_memory_growth MB.
+
+Workers are only ever started, checked and stopped from the pool's supervisor
+thread, never from the threads serving the calls. They are started with the
+forkserver (or spawn) multiprocessing start method rather than forked from the
+multi-threaded gateway process. The service class is only imported in a worker
+after its initializer has run, so that the initializer can set up the environment
+(e.g. DIRAC) as well as the service's class level state. Python 2 only has fork.
+
+This module must not depend on DIRAC as it is imported by the server.
+"""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+from future.utils import text_to_native_str, viewitems
+
+import os
+import time
+import shutil
+import logging
+import resource
+import tempfile
+import importlib
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+import rpyc
+from rpyc.utils.factory import unix_connect
+from rpyc.utils.helpers import classpartial
+from rpyc.utils.server import ThreadedServer
+
+from .encoding import decode_result, encode_result, encode_statuses
+from .metrics import SERVER_METRICS
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+PROTOCOL_CONFIG = {"allow_public_attrs": True,
+                   "sync_request_timeout": 600,  # 10 mins
+                   "allow_pickle": True}
+
+
+class GatewayBusy(Exception):
+    """Raised when no worker became free in time or the queue is full."""
+
+
+# How long to wait before trying to start a worker again after one failed to start (in seconds)
+RESPAWN_DELAY = 5
+
+
+class _WorkerMixin(object):
+    """Extra methods exposed by the gateway worker services."""
+
+    def exposed_memory_usage(self):  # pylint: disable=no-self-use
+        """Return the peak memory usage of the worker process (in MB)."""
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage / 1024.  # kB on Linux
+
+
+def _worker_main(service_name, socket_path, initializer=None):
+    """Serve the named service on a unix socket (worker process entry point)."""
+    if initializer is not None:
+        initializer()
+    module_name, class_name = service_name
+    service = getattr(importlib.import_module(module_name), class_name)
+    worker_service = type(text_to_native_str('Worker%s' % service.__name__),
+                          (_WorkerMixin, service), {})
+    ThreadedServer(worker_service,
+                   socket_path=socket_path,
+                   protocol_config=PROTOCOL_CONFIG).start()
+
+
+def _mp_context(start_method):
+    """Return the multiprocessing context of a start method, Python 2 only forks."""
+    if start_method is None or not hasattr(multiprocessing, 'get_context'):
+        return multiprocessing
+    return multiprocessing.get_context(start_method)
+
+
+class Worker(object):
+    """
+    A DIRAC RPC service worker process and the gateway's connection to it.
+
+    Args:
+        service (type): The rpyc service class run by the worker
+        socket_path (str): The unix socket the worker serves on
+        context: The multiprocessing context to start the process with
+        initializer (callable): Called in the worker process before serving,
+                                must be picklable unless the process is forked
+        startup_timeout (float): How long to wait for the worker to serve (in seconds)
+    """
+
+    def __init__(self, service, socket_path, context=multiprocessing, initializer=None,
+                 startup_timeout=30):
+        """Start the worker process and connect to it."""
+        self.calls = 0
+        self.pins = 0
+        self.retiring = False
+        self.socket_path = socket_path
+        self.process = context.Process(target=_worker_main,
+                                       args=((service.__module__, service.__name__),
+                                             socket_path, initializer))
+        self.process.daemon = True
+        self.process.start()
+
+        deadline = time.time() + startup_timeout
+        while True:
+            try:
+                self.conn = unix_connect(socket_path, config=PROTOCOL_CONFIG)
+                break
+            except (IOError, OSError):
+                if not self.process.is_alive() or time.time() > deadline:
+                    self.process.terminate()
+                    raise RuntimeError("DIRAC RPC worker failed to start on %s" % socket_path)
+                time.sleep(0.05)
+        self.base_memory = self.conn.root.memory_usage()
+
+    @property
+    def pid(self):
+        """Return the worker process id."""
+        return self.process.pid
+
+    @property
+    def root(self):
+        """Return the root of the worker's service."""
+        return self.conn.root
+
+    def memory_growth(self):
+        """Return how much the worker's peak memory has grown since it started (in MB)."""
+        return self.conn.root.memory_usage() - self.base_memory
+
+    def stop(self):
+        """Close the connection and stop the worker process."""
+        try:
+            self.conn.close()
+        except Exception:  # pylint: disable=broad-except
+            logger.debug("Error closing connection to DIRAC RPC worker %d", self.pid, exc_info=True)
+        self.process.terminate()
+        self.process.join(5)
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+
+
+class WorkerPool(object):
+    """
+    Thread-safe pool of DIRAC RPC service worker processes.
+
+    Args:
+        service (type): The rpyc service class run by the workers
+        size (int): The number of worker processes
+        queue_depth (int): The number of calls that may wait for a free worker
+                           before new ones are rejected
+        queue_timeout (float): How long a call may wait for a free worker (in seconds)
+        max_calls (int): Recycle a worker after it has served this many calls
+                         (0 for never)
+        max_memory_growth (float): Recycle a worker once its peak memory has
+                                   grown by this much (in MB, 0 for never)
+        memory_check_interval (float): How often the memory of the idle workers
+                                       is checked (in seconds)
+        start_method (str): The multiprocessing start method of the workers
+        initializer (callable): Called in each worker process before serving
+    """
+
+    def __init__(self, service, size=4, queue_depth=100, queue_timeout=60,
+                 max_calls=1000, max_memory_growth=500, memory_check_interval=60,
+                 start_method='forkserver', initializer=None):
+        """Initialise."""
+        if size < 1:
+            raise ValueError("A worker pool needs at least one worker, not %d" % size)
+        self._service = service
+        self._size = size
+        self._queue_depth = queue_depth
+        self._queue_timeout = queue_timeout
+        self._max_calls = max_calls
+        self._max_memory_growth = max_memory_growth
+        self._memory_check_interval = memory_check_interval
+        self._context = _mp_context(start_method)
+        self._initializer = initializer
+        self._socket_dir = tempfile.mkdtemp(prefix='dirac-gateway-')
+        self._socket_count = 0
+        self._cond = threading.Condition()
+        self._workers = []
+        self._idle = []
+        self._waiting = 0
+        self._closed = False
+        # The workers to be replaced by the supervisor, and its wake up call.
+        self._replace = []
+        self._wakeup = threading.Event()
+        self._supervisor = None
+
+    def _spawn(self):
+        """Start a new worker and make it available."""
+        with self._cond:
+            self._socket_count += 1
+            socket_path = os.path.join(self._socket_dir, 'worker-%d.sock' % self._socket_count)
+        worker = Worker(self._service, socket_path, self._context, self._initializer)
+        logger.info("Started DIRAC RPC worker %d", worker.pid)
+        with self._cond:
+            if self._closed:
+                worker.stop()
+                return
+            self._workers.append(worker)
+            self._idle.append(worker)
+            self._cond.notify()
+
+    def start(self):
+        """Start the workers and their supervisor."""
+        for _ in range(self._size):
+            self._spawn()
+        self._supervisor = threading.Thread(target=self._supervise,
+                                            name='dirac-gateway-supervisor')
+        self._supervisor.daemon = True
+        self._supervisor.start()
+
+    def close(self):
+        """Stop all the workers."""
+        with self._cond:
+            self._closed = True
+            workers, self._workers, self._idle = self._workers, [], []
+            self._replace = []
+            self._cond.notify_all()
+        self._wakeup.set()
+        for worker in workers:
+            worker.stop()
+        shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+    def _supervise(self):
+        """
+        Replace the workers handed back by lease and those grown too large.
+
+        Runs in the supervisor thread until the pool is closed. A worker that
+        fails to start is tried again after RESPAWN_DELAY seconds.
+        """
+        next_check = time.time() + self._memory_check_interval
+        full = True
+        while True:
+            timeout = None
+            if self._max_memory_growth:
+                timeout = max(next_check - time.time(), 0)
+            if not full:
+                timeout = RESPAWN_DELAY if timeout is None else min(timeout, RESPAWN_DELAY)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            with self._cond:
+                if self._closed:
+                    return
+                replace, self._replace = self._replace, []
+            for worker in replace:
+                self._retire(worker)
+            if self._max_memory_growth and time.time() >= next_check:
+                self._check_memory()
+                next_check = time.time() + self._memory_check_interval
+            full = self._fill()
+
+    def _check_memory(self):
+        """Retire the idle workers whose peak memory has grown too much."""
+        with self._cond:
+            workers = list(self._idle)
+        for worker in workers:
+            with self._cond:
+                if worker not in self._idle:  # Leased in the meantime, checked next time
+                    continue
+                self._idle.remove(worker)
+            try:
+                growth = worker.memory_growth()
+            except Exception:  # pylint: disable=broad-except
+                logger.warning("Recycling unresponsive DIRAC RPC worker %d", worker.pid,
+                               exc_info=True)
+                self._retire(worker)
+                continue
+            if growth > self._max_memory_growth:
+                logger.info("Recycling DIRAC RPC worker %d after its memory grew by %.0fMB",
+                            worker.pid, growth)
+                self._retire(worker)
+                continue
+            with self._cond:
+                if not self._closed:
+                    self._idle.append(worker)
+                    self._cond.notify()
+
+    def _fill(self):
+        """Start workers until the pool is back to its size, returning whether it is."""
+        while True:
+            with self._cond:
+                if self._closed or len(self._workers) >= self._size:
+                    return True
+            try:
+                self._spawn()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to start a DIRAC RPC worker, retrying in %ds",
+                                 RESPAWN_DELAY)
+                return False
+
+    def _retire(self, worker):
+        """Stop routing to a worker, stopping it once no client is pinned to it."""
+        with self._cond:
+            worker.retiring = True
+            if worker in self._workers:
+                self._workers.remove(worker)
+            stop = not worker.pins
+        if stop:
+            worker.stop()
+
+    @contextmanager
+    def lease(self):
+        """
+        Lease an idle worker for the duration of a call.
+
+        Raises:
+            GatewayBusy: If the queue is full or no worker became free in time
+        """
+        with self._cond:
+            if self._closed:
+                raise GatewayBusy("DIRAC RPC gateway is shutting down")
+            if not self._idle and self._waiting >= self._queue_depth:
+                raise GatewayBusy("DIRAC RPC gateway queue is full (%d calls waiting)"
+                                  % self._waiting)
+            self._waiting += 1
+            try:
+                deadline = time.time() + self._queue_timeout
+                while not self._idle:
+                    remaining = deadline - time.time()
+                    if self._closed or remaining <= 0:
+                        raise GatewayBusy("No DIRAC RPC worker became free within %ss"
+                                          % self._queue_timeout)
+                    self._cond.wait(remaining)
+                worker = self._idle.pop()
+            finally:
+                self._waiting -= 1
+
+        failed = False
+        try:
+            yield worker
+        except (EOFError, IOError):
+            failed = True
+            raise
+        finally:
+            worker.calls += 1
+            if failed or not worker.process.is_alive():
+                logger.warning("Recycling failed DIRAC RPC worker %d", worker.pid)
+                self._hand_back(worker)
+            elif self._max_calls and worker.calls >= self._max_calls:
+                logger.info("Recycling DIRAC RPC worker %d after %d calls",
+                            worker.pid, worker.calls)
+                self._hand_back(worker)
+            else:
+                with self._cond:
+                    if not self._closed:
+                        self._idle.append(worker)
+                        self._cond.notify()
+
+    def _hand_back(self, worker):
+        """Hand a worker over to the supervisor to be replaced."""
+        with self._cond:
+            self._replace.append(worker)
+        self._wakeup.set()
+
+    def pin(self):
+        """Return the least pinned worker, pinning a client connection to it."""
+        with self._cond:
+            if not self._workers:
+                raise GatewayBusy("DIRAC RPC gateway has no workers")
+            worker = min(self._workers, key=lambda worker: worker.pins)
+            worker.pins += 1
+            return worker
+
+    def unpin(self, worker):
+        """Release a client connection's pin on a worker."""
+        with self._cond:
+            worker.pins -= 1
+            stop = worker.retiring and not worker.pins
+        if stop:
+            worker.stop()
+
+    def invalidate_statuses(self, ids, exclude=None):
+        """Drop jobs from the status cache of every worker (other than exclude)."""
+        with self._cond:
+            workers = [worker for worker in self._workers if worker is not exclude]
+        for worker in workers:
+            try:
+                worker.root.invalidate_statuses(ids)
+            except Exception:  # pylint: disable=broad-except
+                logger.warning("Failed to invalidate the status cache of DIRAC RPC worker %d",
+                               worker.pid, exc_info=True)
+
+    def status_cache_stats(self):
+        """Return the status cache counts summed over all the workers."""
+        with self._cond:
+            workers = list(self._workers)
+        totals = {}
+        for worker in workers:
+            for key, value in viewitems(decode_result(worker.root.status_cache_stats())):
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def stats(self):
+        """Return the number of workers, idle workers and waiting calls."""
+        with self._cond:
+            return {'workers': len(self._workers),
+                    'idle': len(self._idle),
+                    'waiting': self._waiting}
+
+
+class GatewayService(rpyc.Service):
+    """
+    DIRAC RPyC gateway service.
+
+    Exposes the same interface as DiracService but forwards everything to
+    the workers in the pool. The forwarded bulk calls, including any time spent
+    waiting for a worker, are recorded in metrics.SERVER_METRICS of the
+    gateway process.
+    """
+
+    def __init__(self, pool):
+        """Initialise."""
+        super(GatewayService, self).__init__()
+        self._pool = pool
+        self._pinned = None
+        self._lock = threading.Lock()
+
+    def on_connect(self, conn):
+        """Count the connection."""
+        SERVER_METRICS.connection_opened()
+
+    def on_disconnect(self, conn):
+        """Release the pinned worker, if any."""
+        SERVER_METRICS.connection_closed()
+        with self._lock:
+            worker, self._pinned = self._pinned, None
+        if worker is not None:
+            self._pool.unpin(worker)
+
+    def _pinned_root(self):
+        """Return the root of the worker this client connection is pinned to."""
+        with self._lock:
+            if self._pinned is None:
+                self._pinned = self._pool.pin()
+            return self._pinned.root
+
+    @property
+    def exposed_Job(self):  # pylint: disable=invalid-name
+        """Return the DIRAC Job class of the pinned worker."""
+        return self._pinned_root().Job
+
+    @property
+    def exposed_Dirac(self):  # pylint: disable=invalid-name
+        """Return the DIRAC API class of the pinned worker."""
+        return self._pinned_root().Dirac
+
+    @property
+    def exposed_RPCClient(self):  # pylint: disable=invalid-name
+        """Return the DIRAC RPCClient class of the pinned worker."""
+        return self._pinned_root().RPCClient
+
+    def exposed_gateway_stats(self):
+        """Return the number of workers, idle workers and waiting calls."""
+        return tuple(sorted(self._pool.stats().items()))
+
+    @SERVER_METRICS.instrument
+    def exposed_bulk_status(self, ids, since=None):
+        """Route a bulk status call to an idle worker."""
+        try:
+            with self._pool.lease() as worker:
+                return worker.root.bulk_status(ids, since)
+        except GatewayBusy as err:
+            return encode_statuses({'OK': False, 'Message': str(err)})
+
+    @SERVER_METRICS.instrument
+    def exposed_bulk_reschedule(self, ids):
+        """Route a bulk reschedule call to an idle worker."""
+        return self._forward_update('bulk_reschedule', ids)
+
+    @SERVER_METRICS.instrument
+    def exposed_bulk_kill_delete(self, ids):
+        """Route a bulk kill/delete call to an idle worker."""
+        return self._forward_update('bulk_kill_delete', ids)
+
+    @SERVER_METRICS.instrument
+    def exposed_submit_jdl(self, jdl):
+        """Route a JDL submission to an idle worker."""
+        try:
+            with self._pool.lease() as worker:
+                return worker.root.submit_jdl(jdl)
+        except GatewayBusy as err:
+            return encode_result({'OK': False, 'Message': str(err)})
+
+    @SERVER_METRICS.instrument
+    def exposed_submit_jdls(self, jdls):
+        """Stream JDL submissions through an idle worker, leased until the stream ends."""
+        try:
+            with self._pool.lease() as worker:
+                for payload in worker.root.submit_jdls(tuple(jdls)):
+                    yield payload
+        except GatewayBusy as err:
+            yield encode_result({'OK': False, 'Message': str(err)})
+
+    @SERVER_METRICS.instrument
+    def exposed_list_directories(self, paths, depth=0, page_size=1000, batch_size=100,
+                                 endpoint='DataManagement/FileCatalog'):
+        """Stream file catalogue listing pages through an idle worker, leased until the end."""
+        try:
+            with self._pool.lease() as worker:
+                for payload in worker.root.list_directories(tuple(paths), depth, page_size,
+                                                            batch_size, endpoint):
+                    yield payload
+        except GatewayBusy as err:
+            yield encode_result({'OK': False, 'Message': str(err)})
+
+    def exposed_status_cache_stats(self):
+        """Return the JSON encoded status cache counts summed over all the workers."""
+        return encode_result(self._pool.status_cache_stats())
+
+    def _forward_update(self, name, ids):
+        """
+        Route a call that changes jobs to an idle worker.
+
+        The worker drops the jobs from its own status cache, the others are
+        then told to do the same.
+        """
+        try:
+            with self._pool.lease() as worker:
+                result = getattr(worker.root, name)(ids)
+                self._pool.invalidate_statuses(ids, exclude=worker)
+                return result
+        except GatewayBusy as err:
+            return encode_result({'OK': False, 'Message': str(err)})
+
+
+class DiracGateway(object):
+    """
+    The listening DIRAC RPC gateway and its pool of workers.
+
+    Args:
+        service (type): The rpyc service class run by the workers
+        address (tuple): The (hostname, port) to listen on
+        logger (logging.Logger): The logger for the listening server
+        **pool_kwargs: Passed on to the WorkerPool
+    """
+
+    def __init__(self, service, address, logger=None, **pool_kwargs):  # pylint: disable=redefined-outer-name
+        """Initialise."""
+        self.pool = WorkerPool(service, **pool_kwargs)
+        self._address = address
+        self._logger = logger
+        self.server = None
+
+    def start(self):
+        """Start the workers and serve until closed."""
+        hostname, port = self._address
+        self.pool.start()
+        try:
+            self.server = ThreadedServer(classpartial(GatewayService, self.pool),
+                                         hostname=hostname,
+                                         port=port,
+                                         logger=self._logger,
+                                         protocol_config=PROTOCOL_CONFIG)
+            self.server.start()
+        finally:
+            self.pool.close()
+
+    def close(self):
+        """Stop serving."""
+        if self.server is not None:
+            self.server.close()
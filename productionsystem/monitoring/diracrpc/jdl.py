@@ -0,0 +1,102 @@
+"""
+Parametric DIRAC job JDL handling.
+
+This module must not depend on anything outside the standard library and
+future as it is imported by the server.
+"""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+
+import re
+
+PARAMETERS_REGEX = re.compile(r'\bParameters\s*=\s*(\d+|\{.*?\})\s*;', re.DOTALL)
+SEQUENCE_REGEX = re.compile(r'\bParameters\.\w+\s*=\s*(\{.*?\})\s*;', re.DOTALL)
+START_REGEX = re.compile(r'\bParameterStart\s*=\s*([-+.\w]+)\s*;')
+STEP_REGEX = re.compile(r'\bParameterStep\s*=\s*([-+.\w]+)\s*;')
+FACTOR_REGEX = re.compile(r'\bParameterFactor\s*=\s*([-+.\w]+)\s*;')
+LIST_ITEM_REGEX = re.compile(r'"(?:[^"\\]|\\.)*"|[^\s,{}]+')
+
+
+def _list_items(value):
+    """Return the items of a JDL list, e.g. {"a", "b"}, as JDL."""
+    return LIST_ITEM_REGEX.findall(value[1:-1])
+
+
+def _number(jdl, regex, default):
+    """Return the value of a numeric JDL attribute."""
+    match = regex.search(jdl)
+    if match is None:
+        return default
+    value = match.group(1)
+    return int(value) if value.lstrip('+-').isdigit() else float(value)
+
+
+def _replace(jdl, match, value):
+    """Return the JDL with the value matched by the first group of match replaced."""
+    return jdl[:match.start(1)] + value + jdl[match.end(1):]
+
+
+def job_count(jdl):
+    """Return the number of jobs a (possibly parametric) JDL describes."""
+    match = PARAMETERS_REGEX.search(jdl)
+    if match is None:
+        return 1
+    parameters = match.group(1)
+    if parameters.isdigit():
+        return int(parameters)
+    return len(_list_items(parameters))
+
+
+def split_parametric_jdl(jdl, max_parameters):
+    """
+    Split a parametric JDL into parts of at most max_parameters parameters each.
+
+    Both a Parameters list and a Parameters count, with Parameters.<name>
+    sequences or ParameterStart, ParameterStep and ParameterFactor, are split.
+    The parameter values of each part follow on from those of the part before,
+    so the jobs are those of the whole JDL. Only their parameter index (%n)
+    would restart from 0 in each part, so JDLs using it are not split.
+
+    Args:
+        jdl (str): The JDL of the DIRAC job
+        max_parameters (int): The most parameters per part, 0 for no limit
+
+    Returns:
+        list: The JDL of each part, just the JDL itself if it isn't split
+    """
+    count = job_count(jdl)
+    if not max_parameters or count <= max_parameters or '%n' in jdl:
+        return [jdl]
+
+    parameters = PARAMETERS_REGEX.search(jdl)
+    if not parameters.group(1).isdigit():
+        items = _list_items(parameters.group(1))
+        return [_replace(jdl, parameters, '{%s}' % ', '.join(items[i:i + max_parameters]))
+                for i in range(0, count, max_parameters)]
+
+    sequences = [(match, _list_items(match.group(1))) for match in SEQUENCE_REGEX.finditer(jdl)]
+    numeric = any(regex.search(jdl) for regex in (START_REGEX, STEP_REGEX, FACTOR_REGEX))
+    start = _number(jdl, START_REGEX, 0)
+    step = _number(jdl, STEP_REGEX, 0)
+    factor = _number(jdl, FACTOR_REGEX, 1)
+    parts = []
+    for i in range(0, count, max_parameters):
+        replacements = [(match, '{%s}' % ', '.join(items[i:i + max_parameters]))
+                        for match, items in sequences]
+        replacements.append((parameters, str(min(max_parameters, count - i))))
+        part = jdl
+        # Replaced from the end so that the positions of the earlier matches still hold.
+        for match, value in sorted(replacements, key=lambda item: item[0].start(), reverse=True):
+            part = _replace(part, match, value)
+        if numeric:
+            match = START_REGEX.search(part)
+            if match is None:
+                part = part.rstrip()[:-1] + '    ParameterStart = %s;\n]' % start
+            else:
+                part = _replace(part, match, str(start))
+            for _ in range(max_parameters):
+                start = start * factor + step
+        parts.append(part)
+    return parts
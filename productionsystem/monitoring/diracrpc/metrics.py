@@ -0,0 +1,254 @@
+"""
+DIRAC RPC call metrics.
+
+Per method call counts, latency and payload size histograms and connection
+open/close counts, kept separately for the client and server sides of the RPC
+layer. Calls slower than a threshold are logged along with the call context
+(e.g. the request and parametric job being worked on). The metrics can be
+served over HTTP in the Prometheus text exposition format, see
+productionsystem.metrics for the generic metric primitives.
+
+This module must not depend on anything outside the standard library, future
+and productionsystem.metrics as it is imported by the server. The metrics are
+those of the process they are recorded in, e.g. the calls made by monitoring
+daemon process workers or recorded in DIRAC RPC gateway workers are not
+included in the metrics served by the parent process.
+"""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+from future.utils import viewitems
+
+import time
+import inspect
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+from productionsystem.metrics import Histogram
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = tuple(4 ** power for power in range(4, 14))  # 256B to 64MB
+_CONTEXT = threading.local()
+
+
+@contextmanager
+def call_context(**labels):
+    """
+    Label the RPC calls made by this thread within the context.
+
+    The labels are included when logging slow calls. Nested contexts add to
+    the labels of the outer ones.
+    """
+    previous = getattr(_CONTEXT, 'labels', {})
+    _CONTEXT.labels = dict(previous, **labels)
+    try:
+        yield
+    finally:
+        _CONTEXT.labels = previous
+
+
+def current_context():
+    """Return the labels of the current call context, e.g. to pass on to another thread."""
+    return dict(getattr(_CONTEXT, 'labels', {}))
+
+
+class _Call(object):
+    """The details of a timed call that are filled in by the caller."""
+
+    __slots__ = ('size',)
+
+    def __init__(self):
+        """Initialise."""
+        self.size = None
+
+
+class MetricsRegistry(object):
+    """
+    Thread-safe registry of RPC call metrics.
+
+    Args:
+        prefix (str): The prefix of the metric names, e.g. diracrpc_client
+        slow_call_threshold (float): Log calls taking longer than this (in seconds,
+                                     0 to disable)
+    """
+
+    def __init__(self, prefix, slow_call_threshold=10):
+        """Initialise."""
+        self.prefix = prefix
+        self.slow_call_threshold = slow_call_threshold
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._errors = {}
+        self._latency = {}
+        self._sizes = {}
+        self._opened = 0
+        self._closed = 0
+
+    def observe(self, method, seconds, size=None, error=False):
+        """
+        Record a call.
+
+        Args:
+            method (str): The name of the method called
+            seconds (float): How long the call took
+            size (int): The size of the payload sent and/or received (in bytes), if known
+            error (bool): Whether the call raised an exception
+        """
+        with self._lock:
+            self._calls[method] = self._calls.get(method, 0) + 1
+            if error:
+                self._errors[method] = self._errors.get(method, 0) + 1
+            self._latency.setdefault(method, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            if size is not None:
+                self._sizes.setdefault(method, Histogram(SIZE_BUCKETS)).observe(size)
+
+        if self.slow_call_threshold and seconds > self.slow_call_threshold:
+            details = ['%s=%s' % item for item in sorted(viewitems(current_context()))]
+            if size is not None:
+                details.append('payload=%dB' % size)
+            logger.warning("Slow DIRAC RPC call %s took %.2fs%s", method, seconds,
+                           ' (%s)' % ', '.join(details) if details else '')
+
+    @contextmanager
+    def timed(self, method):
+        """
+        Time a call made within the context.
+
+        Yields an object whose size attribute may be set to the payload size.
+        """
+        call = _Call()
+        start = time.time()
+        try:
+            yield call
+        except BaseException:
+            self.observe(method, time.time() - start, call.size, error=True)
+            raise
+        self.observe(method, time.time() - start, call.size)
+
+    def timed_iter(self, method, items):
+        """
+        Time the production of each item of an iterable, e.g. a streamed RPC result.
+
+        The size of bytes items is recorded as the payload size.
+        """
+        items = iter(items)
+        while True:
+            start = time.time()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            except BaseException:
+                self.observe(method, time.time() - start, error=True)
+                raise
+            self.observe(method, time.time() - start,
+                         len(item) if isinstance(item, bytes) else None)
+            yield item
+
+    def instrument(self, func):
+        """
+        Decorate an exposed service method so that its calls are timed.
+
+        The size of bytes results is recorded as the payload size. Generator
+        methods have the production of each item timed separately.
+        """
+        method = func.__name__[len('exposed_'):] if func.__name__.startswith('exposed_') \
+            else func.__name__
+
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                """Time the production of each item."""
+                return self.timed_iter(method, func(*args, **kwargs))
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            """Time the call."""
+            with self.timed(method) as call:
+                result = func(*args, **kwargs)
+                if isinstance(result, bytes):
+                    call.size = len(result)
+                return result
+        return wrapper
+
+    def connection_opened(self):
+        """Count an opened connection."""
+        with self._lock:
+            self._opened += 1
+
+    def connection_closed(self):
+        """Count a closed connection."""
+        with self._lock:
+            self._closed += 1
+
+    def calls(self, method):
+        """Return the number of calls of a method."""
+        with self._lock:
+            return self._calls.get(method, 0)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        prefix = self.prefix
+        with self._lock:
+            lines = ['# HELP %s_calls_total RPC calls, by method.' % prefix,
+                     '# TYPE %s_calls_total counter' % prefix]
+            lines.extend('%s_calls_total{method="%s"} %d' % (prefix, method, count)
+                         for method, count in sorted(viewitems(self._calls)))
+            lines.extend(['# HELP %s_call_errors_total RPC calls that raised, by method.' % prefix,
+                          '# TYPE %s_call_errors_total counter' % prefix])
+            lines.extend('%s_call_errors_total{method="%s"} %d' % (prefix, method, count)
+                         for method, count in sorted(viewitems(self._errors)))
+            for name, description, histograms in (
+                    ('call_seconds', 'RPC call latency in seconds', self._latency),
+                    ('payload_bytes', 'RPC call payload size in bytes', self._sizes)):
+                lines.extend(['# HELP %s_%s %s, by method.' % (prefix, name, description),
+                              '# TYPE %s_%s histogram' % (prefix, name)])
+                for method, histogram in sorted(viewitems(histograms)):
+                    lines.extend(histogram.render('%s_%s' % (prefix, name),
+                                                  'method="%s"' % method))
+            for name, count in (('opened', self._opened), ('closed', self._closed)):
+                lines.extend(['# HELP %s_connections_%s_total RPC connections %s.'
+                              % (prefix, name, name),
+                              '# TYPE %s_connections_%s_total counter' % (prefix, name),
+                              '%s_connections_%s_total %d' % (prefix, name, count)])
+        return '\n'.join(lines) + '\n'
+
+
+class TimedProxy(object):
+    """
+    Proxy to an object, e.g. the DIRAC API or a netref to it, timing its method calls.
+
+    Args:
+        target (object): The object to proxy
+        registry (MetricsRegistry): Where to record the calls
+        name (str): The name to prefix the method names with, e.g. Dirac
+    """
+
+    def __init__(self, target, registry, name):
+        """Initialise."""
+        self._target = target
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, name):
+        """Return the target's attribute, timing it if it is a method."""
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        method = '%s.%s' % (self._name, name)
+
+        def timed_call(*args, **kwargs):
+            """Time the call."""
+            with self._registry.timed(method):
+                return attr(*args, **kwargs)
+        return timed_call
+
+
+# The metrics of this process' calls as an RPC client and as an RPC server.
+CLIENT_METRICS = MetricsRegistry('diracrpc_client')
+SERVER_METRICS = MetricsRegistry('diracrpc_server')
@@ -0,0 +1,343 @@
+"""
+DIRAC RPC service base and daemon.
+
+The coarse grained bulk methods and the daemon hosting them only use the
+exposed DIRAC API classes, so they are shared by the real DIRAC service and the
+local stand-in. This module must not depend on DIRAC as it is imported by the
+stand-in server.
+"""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+from future.utils import viewitems
+
+import sys
+import importlib
+from functools import partial
+
+import rpyc
+from rpyc.utils.server import ThreadedServer
+from daemonize import Daemonize
+
+from productionsystem.metrics import MetricsServer
+from .cache import StatusCache, TTLCache
+from .encoding import encode_result, encode_statuses
+from .gateway import PROTOCOL_CONFIG, DiracGateway
+from .jdl import split_parametric_jdl
+from .metrics import SERVER_METRICS, TimedProxy
+
+FILE_CATALOGUE = 'DataManagement/FileCatalog'
+
+
+class BaseDiracService(rpyc.Service):
+    """
+    Base DIRAC RPyC Service.
+
+    Subclasses expose the DIRAC API classes as exposed_Job, exposed_Dirac and
+    exposed_RPCClient. As well as these, coarse grained bulk methods are
+    exposed. These run entirely server side and return bytes.
+
+    Job statuses are cached in status_cache, which is shared by all the
+    connections to this process, so that several consumers polling the same
+    jobs don't each go to DIRAC. Jobs rescheduled, killed or deleted through
+    the service are dropped from the cache. File catalogue directory listings
+    are likewise cached in listing_cache. Parametric JDLs with more than
+    max_jdl_parameters parameters are submitted in parts.
+
+    The calls to the bulk methods and to the DIRAC API are recorded in
+    metrics.SERVER_METRICS.
+    """
+
+    exposed_Job = None
+    exposed_Dirac = None
+    exposed_RPCClient = None
+    status_cache = StatusCache()
+    listing_cache = TTLCache(ttl=300, max_entries=10000)
+    max_jdl_parameters = 1000
+
+    def __init__(self):
+        """Initialise."""
+        super(BaseDiracService, self).__init__()
+        self._dirac = None
+
+    def on_connect(self, conn):
+        """Count the connection."""
+        SERVER_METRICS.connection_opened()
+
+    def on_disconnect(self, conn):
+        """Count the disconnection."""
+        SERVER_METRICS.connection_closed()
+
+    @property
+    def dirac(self):
+        """Return the (timed) DIRAC API object, created on first use."""
+        if self._dirac is None:
+            self._dirac = TimedProxy(self.exposed_Dirac(),  # pylint: disable=not-callable
+                                     SERVER_METRICS, 'Dirac')
+        return self._dirac
+
+    @SERVER_METRICS.instrument
+    def exposed_bulk_status(self, ids, since=None):
+        """
+        Return the status of many DIRAC jobs.
+
+        The result is compactly encoded with encoding.encode_statuses.
+
+        Args:
+            ids (tuple): The DIRAC job ids
+            since (str): If given, only return the status of the jobs that have
+                         changed since this UTC time ('YYYY-MM-DD HH:MM:SS')
+        """
+        ids = [int(job_id) for job_id in ids]
+        if since is not None:
+            result = self.dirac.getJobStatusChangedSince(ids, since)
+            if result['OK']:
+                self.status_cache.update(result['Value'])
+            return encode_statuses(result)
+
+        statuses, missing = self.status_cache.get_many(ids)
+        if missing:
+            result = self.dirac.getJobStatus(missing)
+            if not result['OK']:
+                return encode_statuses(result)
+            self.status_cache.update(result['Value'])
+            statuses.update(result['Value'])
+        return encode_statuses({'OK': True, 'Value': statuses})
+
+    @SERVER_METRICS.instrument
+    def exposed_bulk_reschedule(self, ids):
+        """Reschedule many DIRAC jobs."""
+        ids = list(ids)
+        self.status_cache.invalidate(ids)
+        return encode_result(self.dirac.rescheduleJob(ids))
+
+    @SERVER_METRICS.instrument
+    def exposed_bulk_kill_delete(self, ids):
+        """Kill and then delete many DIRAC jobs."""
+        ids = list(ids)
+        self.status_cache.invalidate(ids)
+        kill_result = self.dirac.killJob(ids)
+        delete_result = self.dirac.deleteJob(ids)
+        messages = [result['Message'] for result in (kill_result, delete_result)
+                    if not result['OK']]
+        if messages:
+            return encode_result({'OK': False, 'Message': '; '.join(messages)})
+        return encode_result({'OK': True, 'Value': ids})
+
+    @SERVER_METRICS.instrument
+    def exposed_submit_jdl(self, jdl):
+        """
+        Submit a DIRAC job given as JDL.
+
+        Unlike submitting a Job object over a netref, this needs no
+        further round trips from the server back to the client.
+        """
+        return encode_result(self.dirac.submitJob(jdl))
+
+    @SERVER_METRICS.instrument
+    def exposed_submit_jdls(self, jdls):
+        """
+        Submit many DIRAC jobs given as JDL, one after the other.
+
+        This is a generator, so the client gets the JSON encoded result of
+        each submission as soon as it is known. It stops after the first failure.
+
+        DIRAC creates all the jobs of a parametric JDL in the one call, which
+        can take longer than the RPC timeout for a big one. Those with more
+        than max_jdl_parameters parameters are therefore split with
+        jdl.split_parametric_jdl and submitted part by part, with a result
+        yielded for each part. Those it can't split are submitted whole.
+        """
+        for jdl in tuple(jdls):
+            for part in split_parametric_jdl(jdl, self.max_jdl_parameters):
+                result = self.dirac.submitJob(part)
+                yield encode_result(result)
+                if not result['OK']:
+                    return
+
+    @SERVER_METRICS.instrument
+    def exposed_list_directories(self, paths, depth=0, page_size=1000, batch_size=100,
+                                 endpoint=FILE_CATALOGUE):
+        """
+        List many DIRAC file catalogue directories, recursing into their subdirectories.
+
+        The directories are listed level by level, batch_size at a time in a
+        single DIRAC call. This is a generator yielding the JSON encoded
+        listings in pages of up to page_size directories as
+        {'OK': True, 'Value': {'Successful': {path: listing}, 'Failed': {path: error}}}.
+        If a DIRAC call fails its error result is yielded and listing stops.
+
+        Args:
+            paths (tuple): The directories to list
+            depth (int): How many levels of subdirectories to list, None for all
+            page_size (int): The maximum number of directories per page
+            batch_size (int): The maximum number of directories per DIRAC call
+            endpoint (str): The DIRAC file catalogue service
+        """
+        client = TimedProxy(self.exposed_RPCClient(endpoint),  # pylint: disable=not-callable
+                            SERVER_METRICS, 'RPCClient')
+        seen = set()
+        level = []
+        for path in tuple(paths):
+            if path not in seen:
+                seen.add(path)
+                level.append(path)
+        page = {'Successful': {}, 'Failed': {}}
+        pages = 0
+        current_depth = 0
+        while level:
+            next_level = []
+            for start in range(0, len(level), batch_size):
+                batch = level[start:start + batch_size]
+                listings, missing = self.listing_cache.get_many((endpoint, path) for path in batch)
+                if missing:
+                    result = client.listDirectory([path for _, path in missing], False)
+                    if not result['OK']:
+                        yield encode_result(result)
+                        return
+                    fresh = {(endpoint, path): listing
+                             for path, listing in viewitems(result['Value']['Successful'])}
+                    self.listing_cache.update(fresh)
+                    listings.update(fresh)
+                    page['Failed'].update(result['Value']['Failed'])
+
+                for (_, path), listing in sorted(viewitems(listings)):
+                    page['Successful'][path] = listing
+                    if depth is None or current_depth < depth:
+                        for subdir in listing.get('SubDirs', {}):
+                            if subdir not in seen:
+                                seen.add(subdir)
+                                next_level.append(subdir)
+                    if len(page['Successful']) + len(page['Failed']) >= page_size:
+                        yield encode_result({'OK': True, 'Value': page})
+                        pages += 1
+                        page = {'Successful': {}, 'Failed': {}}
+            level = next_level
+            current_depth += 1
+
+        if page['Successful'] or page['Failed'] or not pages:
+            yield encode_result({'OK': True, 'Value': page})
+
+    def exposed_invalidate_statuses(self, ids):
+        """Drop jobs from the status cache."""
+        self.status_cache.invalidate(list(ids))
+
+    def exposed_status_cache_stats(self):
+        """Return the JSON encoded status cache hit, miss and eviction counts."""
+        return encode_result(self.status_cache.stats())
+
+
+def configure_service(service, status_cache_ttl=10, status_cache_size=100000,
+                      listing_cache_ttl=300, listing_cache_size=10000, max_jdl_parameters=1000):
+    """
+    Set up the class level caches and limits of a DIRAC RPC service.
+
+    Args:
+        service (type or tuple): The service class or its (module, class) names, the
+                                 latter so that it is only imported when called
+        status_cache_ttl (float): How long job statuses are cached for (in seconds)
+        status_cache_size (int): The maximum number of job statuses to cache
+        listing_cache_ttl (float): How long directory listings are cached for (in seconds)
+        listing_cache_size (int): The maximum number of directory listings to cache
+        max_jdl_parameters (int): Submit parametric JDLs with more parameters in parts
+    """
+    if isinstance(service, tuple):
+        module_name, class_name = service
+        service = getattr(importlib.import_module(module_name), class_name)
+    service.status_cache = StatusCache(ttl=status_cache_ttl, max_entries=status_cache_size)
+    service.listing_cache = TTLCache(ttl=listing_cache_ttl, max_entries=listing_cache_size)
+    service.max_jdl_parameters = max_jdl_parameters
+
+
+def init_dirac_worker(configure):
+    """
+    Initialise DIRAC in a gateway worker process, then set up its service.
+
+    Runs before the DIRAC API is imported in the worker, as in the daemon process.
+    """
+    # DIRAC will parse our command line args unless we remove them
+    sys.argv = sys.argv[:1]
+    importlib.import_module('DIRAC.Core.Base.Script').parseCommandLine(ignoreErrors=True)
+    configure()
+
+
+class BaseDiracDaemon(Daemonize):
+    """
+    DIRAC daemon to host the server.
+
+    If workers is given then a DiracGateway is run in front of that many
+    worker processes, otherwise the service is served directly from the
+    daemon process. Subclasses set the service class to host. If
+    metrics_port is given the server side call metrics of the daemon process
+    are served over HTTP on that port.
+
+    Gateway workers are started with the worker_start_method multiprocessing
+    start method and set up by worker_initializer. Only the calls forwarded by
+    the gateway are recorded in the metrics served by the daemon process, those
+    recorded in the workers themselves are not aggregated.
+    """
+
+    service = BaseDiracService
+
+    def __init__(self, address, workers=0, queue_depth=100, queue_timeout=60,
+                 max_worker_calls=1000, max_worker_memory_growth=500,
+                 worker_start_method='forkserver', status_cache_ttl=10, status_cache_size=100000,
+                 listing_cache_ttl=300, listing_cache_size=10000, max_jdl_parameters=1000,
+                 metrics_port=0, slow_call_threshold=10, **kwargs):
+        """Initialise."""
+        self._address = address
+        self._service_config = dict(status_cache_ttl=status_cache_ttl,
+                                    status_cache_size=status_cache_size,
+                                    listing_cache_ttl=listing_cache_ttl,
+                                    listing_cache_size=listing_cache_size,
+                                    max_jdl_parameters=max_jdl_parameters)
+        self._workers = workers
+        self._queue_depth = queue_depth
+        self._queue_timeout = queue_timeout
+        self._max_worker_calls = max_worker_calls
+        self._max_worker_memory_growth = max_worker_memory_growth
+        self._worker_start_method = worker_start_method
+        self._metrics_port = metrics_port
+        self._slow_call_threshold = slow_call_threshold
+        super(BaseDiracDaemon, self).__init__(action=self.main, **kwargs)
+
+    def worker_initializer(self):
+        """Return the picklable callable setting up the service in each gateway worker."""
+        return partial(configure_service, (self.service.__module__, self.service.__name__),
+                       **self._service_config)
+
+    def main(self):
+        """Daemon main."""
+        # Set up the threaded server in the daemon main
+        # else the file descriptors will be closed when daemon starts.
+        configure_service(self.service, **self._service_config)
+        SERVER_METRICS.slow_call_threshold = self._slow_call_threshold
+        hostname, port = self._address
+        metrics_server = None
+        if self._metrics_port:
+            metrics_server = MetricsServer((hostname, self._metrics_port), [SERVER_METRICS])
+            metrics_server.start()
+        try:
+            if self._workers:
+                self.logger.info("Starting DIRAC RPC gateway with %d workers", self._workers)
+                DiracGateway(self.service,
+                             self._address,
+                             logger=self.logger,
+                             size=self._workers,
+                             queue_depth=self._queue_depth,
+                             queue_timeout=self._queue_timeout,
+                             max_calls=self._max_worker_calls,
+                             max_memory_growth=self._max_worker_memory_growth,
+                             start_method=self._worker_start_method,
+                             initializer=self.worker_initializer()).start()
+                return
+
+            ThreadedServer(self.service,
+                           hostname=hostname,
+                           port=port,
+                           logger=self.logger,
+                           protocol_config=PROTOCOL_CONFIG).start()
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
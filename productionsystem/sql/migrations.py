@@ -0,0 +1,341 @@
+"""
+DB schema migrations.
+
+The schema version of a DB is the highest version recorded in its
+schemaversion table, 0 if there is none. upgrade first creates any missing
+tables, complete, from the models and then applies the migrations above the
+current version in order, recording each one as it is applied. It runs when
+the daemons set up the SessionRegistry (unless the database auto_migrate
+config option is False) and from scripts/db-migrate.py.
+
+Migrations are functions decorated with migration and given a
+SchemaOperations object. Its operations only make online-safe changes (on
+MySQL, in place and without locking the table against writes) and skip
+changes that are already there. This means that a migration can be re-run
+after being interrupted, as DDL isn't transactional on MySQL, and that
+migrations are no-ops for tables just created from the models. Data
+migrations should likewise be written to be re-runnable. Only one process
+migrates a MySQL DB at a time.
+"""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+
+import re
+import time
+import logging
+from datetime import datetime
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import (Column, Integer, String, TIMESTAMP, MetaData, Table, Index, inspect, func,
+                        null, select, text)
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from .SQLTableBase import SQLTableBase
+
+LOCK_NAME = 'productionsystem_migrations'
+LOCK_TIMEOUT = 600  # seconds
+BATCH_SIZE = 500  # rows per data migration insert
+# Options making DDL online on MySQL: rebuilt in place without blocking writes.
+MYSQL_ONLINE_DDL = ('ALGORITHM=INPLACE', 'LOCK=NONE')
+MIGRATIONS = []
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+schema_version = Table('schemaversion', MetaData(),  # pylint: disable=invalid-name
+                       Column('version', Integer, primary_key=True, autoincrement=False),
+                       Column('description', String(255), nullable=False),
+                       Column('applied', TIMESTAMP, nullable=False))
+
+Migration = namedtuple('Migration', ('version', 'description', 'upgrade'))
+
+
+class MigrationError(RuntimeError):
+    """Migration exception."""
+
+
+def migration(version, description):
+    """
+    Register a migration.
+
+    Args:
+        version (int): The schema version the migration upgrades to
+        description (str): What the migration changes
+    """
+    def register(func):
+        """Register the decorated function as the migration's upgrade."""
+        if any(existing.version == version for existing in MIGRATIONS):
+            raise MigrationError("Duplicate migration version %d" % version)
+        MIGRATIONS.append(Migration(version, description, func))
+        MIGRATIONS.sort(key=lambda item: item.version)
+        return func
+    return register
+
+
+def head():
+    """Return the latest schema version."""
+    return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+
+class SchemaOperations(object):
+    """
+    Online-safe, idempotent schema changes made through a connection.
+
+    Args:
+        connection (Connection): The connection to make the changes through
+    """
+
+    def __init__(self, connection):
+        """Initialise."""
+        self.connection = connection
+        self.dialect = connection.dialect
+
+    @property
+    def _inspector(self):
+        # Not cached as it caches what it reflects, which the changes make stale.
+        return inspect(self.connection)
+
+    def has_table(self, table_name):
+        """Return whether the table exists."""
+        return self._inspector.has_table(table_name)
+
+    def has_column(self, table_name, column_name):
+        """Return whether the table has the column."""
+        return any(column['name'] == column_name
+                   for column in self._inspector.get_columns(table_name))
+
+    def has_index(self, table_name, index_name):
+        """Return whether the table has the index."""
+        return any(index['name'] == index_name
+                   for index in self._inspector.get_indexes(table_name))
+
+    def _execute_ddl(self, ddl, online_options=True):
+        statement = ddl if isinstance(ddl, str) else str(ddl.compile(dialect=self.dialect))
+        if online_options and self.dialect.name == 'mysql':
+            # CREATE INDEX takes its options space separated, ALTER TABLE comma separated.
+            separator = ' ' if statement.startswith('CREATE') else ', '
+            statement += separator + separator.join(MYSQL_ONLINE_DDL)
+        logger.debug("Executing DDL: %s", statement)
+        self.connection.exec_driver_sql(statement)
+
+    def add_index(self, table_name, index_name, *column_names, **kwargs):
+        """
+        Add an index unless the table doesn't exist or already has it.
+
+        Args:
+            table_name (str): The table to index
+            index_name (str): The name of the index
+            column_names (tuple): The indexed columns, in order
+            kwargs (dict): Options for sqlalchemy.Index, e.g. unique
+        """
+        if not self.has_table(table_name) or self.has_index(table_name, index_name):
+            return False
+        # Only the column names are needed to compile the DDL.
+        table = Table(table_name, MetaData(), *(Column(name) for name in column_names))
+        index = Index(index_name, *table.c, **kwargs)
+        logger.info("Adding index %s to table %s.", index_name, table_name)
+        self._execute_ddl(CreateIndex(index))
+        return True
+
+    def drop_index(self, table_name, index_name):
+        """Drop an index unless the table doesn't have it."""
+        if not self.has_table(table_name) or not self.has_index(table_name, index_name):
+            return False
+        logger.info("Dropping index %s from table %s.", index_name, table_name)
+        preparer = self.dialect.identifier_preparer
+        if self.dialect.name == 'mysql':
+            self._execute_ddl('ALTER TABLE %s DROP INDEX %s'
+                              % (preparer.quote(table_name), preparer.quote(index_name)))
+        else:
+            self._execute_ddl('DROP INDEX %s' % preparer.quote(index_name), online_options=False)
+        return True
+
+    def add_column(self, table_name, column):
+        """
+        Add a column unless the table doesn't exist or already has it.
+
+        To be online-safe the column must be nullable or have a server default.
+
+        Args:
+            table_name (str): The table to add the column to
+            column (Column): The column to add, not attached to a table
+        """
+        if not column.nullable and column.server_default is None:
+            raise MigrationError("Column %s.%s must be nullable or have a server default to "
+                                 "be added online" % (table_name, column.name))
+        if not self.has_table(table_name) or self.has_column(table_name, column.name):
+            return False
+        Table(table_name, MetaData(), column)  # The DDL compiler needs it to have a table.
+        preparer = self.dialect.identifier_preparer
+        logger.info("Adding column %s to table %s.", column.name, table_name)
+        self._execute_ddl('ALTER TABLE %s ADD COLUMN %s'
+                          % (preparer.quote(table_name),
+                             CreateColumn(column).compile(dialect=self.dialect)))
+        return True
+
+    def drop_column(self, table_name, column_name):
+        """
+        Drop a column unless the table doesn't have it.
+
+        The column must not be indexed or constrained. Code still reading or
+        writing the column must be gone before this is applied.
+        """
+        if not self.has_table(table_name) or not self.has_column(table_name, column_name):
+            return False
+        preparer = self.dialect.identifier_preparer
+        logger.info("Dropping column %s from table %s.", column_name, table_name)
+        self._execute_ddl('ALTER TABLE %s DROP COLUMN %s'
+                          % (preparer.quote(table_name), preparer.quote(column_name)))
+        return True
+
+    def table(self, table_name):
+        """Return the table as it is in the DB, for data migrations."""
+        return Table(table_name, MetaData(), autoload_with=self.connection)
+
+    def execute(self, statement, parameters=None):
+        """Execute a data migration statement."""
+        return self.connection.execute(statement, parameters)
+
+
+@contextmanager
+def _migration_lock(connection):
+    """Hold the migration lock for the connection's DB, if it supports it."""
+    if connection.dialect.name != 'mysql':
+        yield
+        return
+    with connection.begin():
+        acquired = connection.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                                      {'name': LOCK_NAME, 'timeout': LOCK_TIMEOUT}).scalar()
+    if not acquired:
+        raise MigrationError("Timed out waiting for another process to finish migrating the DB")
+    try:
+        yield
+    finally:
+        with connection.begin():
+            connection.execute(text("SELECT RELEASE_LOCK(:name)"), {'name': LOCK_NAME})
+
+
+def current_version(connection):
+    """Return the schema version of the DB."""
+    if not inspect(connection).has_table(schema_version.name):
+        return 0
+    return connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def pending(connection, target=None):
+    """Return the migrations to apply to reach the target version (by default the latest)."""
+    version = current_version(connection)
+    target = head() if target is None else target
+    return [item for item in MIGRATIONS if version < item.version <= target]
+
+
+def upgrade(engine, target=None):
+    """
+    Create any missing tables and apply the pending migrations.
+
+    Args:
+        engine (Engine): The DB engine
+        target (int): The version to upgrade to, by default the latest
+
+    Returns:
+        list: The migrations applied
+    """
+    with engine.connect() as connection:
+        with _migration_lock(connection):
+            with connection.begin():
+                SQLTableBase.metadata.create_all(bind=connection)
+                schema_version.create(bind=connection, checkfirst=True)
+                version = current_version(connection)
+                applied = pending(connection, target)
+            if version > head():
+                logger.warning("DB schema version %d is newer than this code's %d.",
+                               version, head())
+            for item in applied:
+                logger.info("Applying migration %d: %s", item.version, item.description)
+                with connection.begin():
+                    item.upgrade(SchemaOperations(connection))
+                    connection.execute(schema_version.insert(),
+                                       {'version': item.version,
+                                        'description': item.description,
+                                        'applied': datetime.utcnow()})
+    return applied
+
+
+@migration(1, "Add the monitoring and API query indexes")
+def add_query_indexes(ops):
+    """Add the indexes used by the monitoring and API queries."""
+    ops.add_index('requests', 'ix_requests_status', 'status')
+    ops.add_index('requests', 'ix_requests_requester_id_status', 'requester_id', 'status')
+    ops.add_index('parametricjobs', 'ix_parametricjobs_reschedule_request_id',
+                  'reschedule', 'request_id')
+    ops.add_index('diracjobs', 'ix_diracjobs_request_id_parametricjob_id_status',
+                  'request_id', 'parametricjob_id', 'status')
+
+
+LOG_LINE = re.compile(r'^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] (.*)$')
+
+
+def _local_to_utc(local_time):
+    """Convert a naive local time, in the time zone of this host, to naive UTC."""
+    return datetime.utcfromtimestamp(time.mktime(local_time.timetuple()))
+
+
+def _split_log(log, default_timestamp):
+    """
+    Split a TEXT log into its (timestamp, message) entries, keeping multi-line messages.
+
+    The TEXT log timestamps were written in local time (utils.timestamp) so are
+    converted to UTC, as used by logentries. This assumes the migration runs in
+    the same time zone as the code that wrote the logs. The default timestamp,
+    taken from the row's own timestamp column, is already UTC.
+    """
+    entries = []
+    for line in log.splitlines():
+        match = LOG_LINE.match(line)
+        if match is not None:
+            local_time = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S')
+            entries.append([_local_to_utc(local_time), match.group(2)])
+        elif entries:
+            entries[-1][1] += '\n' + line
+        elif line:
+            entries.append([default_timestamp, line])
+    return entries
+
+
+@migration(2, "Copy the request and parametric job logs into the logentries table")
+def copy_logs_to_table(ops):
+    """
+    Copy the TEXT logs into logentries.
+
+    The log columns are left in place, as code older than logentries still
+    reads and appends to them. They are to be dropped by a later migration,
+    once nothing still running uses them.
+    """
+    for table_name in ('requests', 'parametricjobs'):
+        if not ops.has_column(table_name, 'log'):
+            continue
+        table = ops.table(table_name)
+        logentries = ops.table('logentries')
+        if table_name == 'requests':
+            ids = (table.c.id, null())
+        else:
+            ids = (table.c.request_id, table.c.id)
+        query = select(*(ids + (table.c.timestamp, table.c.log))).where(table.c.log != '')
+        batch = []
+        for row in ops.execute(query):
+            for timestamp, message in _split_log(row[3], row[2]):
+                batch.append({'request_id': row[0], 'parametricjob_id': row[1],
+                              'timestamp': timestamp, 'message': message})
+            if len(batch) >= BATCH_SIZE:
+                ops.execute(logentries.insert(), batch)
+                batch = []
+        if batch:
+            ops.execute(logentries.insert(), batch)
+
+
+@migration(3, "Add the count of failed request removal attempts")
+def add_removal_attempts(ops):
+    """Add the column counting a request's failed removal attempts."""
+    ops.add_column('requests', Column('removal_attempts', Integer, nullable=False,
+                                      server_default='0'))
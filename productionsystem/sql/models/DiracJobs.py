@@ -6,17 +6,23 @@ from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-impor
 
 import logging
 import json
+from collections import defaultdict, Counter
 
 from future.utils import native
 import cherrypy
-from sqlalchemy import Column, TEXT, Integer, Enum, ForeignKey, ForeignKeyConstraint
+from sqlalchemy import (Column, TEXT, Integer, Enum, ForeignKey, ForeignKeyConstraint, Index,
+                        bindparam, func)
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
-from productionsystem.sql.registry import managed_session
+from productionsystem.utils import igroup
+from productionsystem.sql.registry import managed_session, release
 from ..enums import DiracStatus
 from ..SQLTableBase import SQLTableBase
 
+# Keep the number of bound parameters in "IN" clauses within the SQLite limit.
+IN_CLAUSE_CHUNK_SIZE = 500
+
 
 @cherrypy.expose
 @cherrypy.popargs('diracjob_id')
@@ -28,8 +34,11 @@ class DiracJobs(SQLTableBase):
     __mapper_args__ = {'polymorphic_on': classtype,
                        'polymorphic_identity': 'diracjobs',
                        'with_polymorphic': '*'}
+    # Jobs are looked up by parametric job, and by request when monitoring, filtered on status.
     __table_args__ = (ForeignKeyConstraint(['request_id', 'parametricjob_id'],
-                                           ['parametricjobs.request_id', 'parametricjobs.id']),)
+                                           ['parametricjobs.request_id', 'parametricjobs.id']),
+                      Index('ix_diracjobs_request_id_parametricjob_id_status',
+                            'request_id', 'parametricjob_id', 'status'))
     id = Column(Integer, primary_key=True)  # pylint: disable=invalid-name
     requester_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     request_id = Column(Integer, nullable=False)
@@ -39,8 +48,9 @@ class DiracJobs(SQLTableBase):
     logger = logging.getLogger(__name__).getChild(__qualname__)
 
     @classmethod
-    def get(cls, diracjob_id=None, request_id=None, parametricjob_id=None, user_id=None):
-        """Get dirac jobs."""
+    def get(cls, diracjob_id=None, request_id=None, parametricjob_id=None, user_id=None,
+            session=None):
+        """Get dirac jobs, left attached if session is a unit of work session."""
         if diracjob_id is not None:
             try:
                 diracjob_id = native(int(diracjob_id))
@@ -73,7 +83,7 @@ class DiracJobs(SQLTableBase):
                                  "(or convertable to int)", user_id)
                 raise
 
-        with managed_session() as session:
+        with managed_session(read_only=True, session=session) as session:
             query = session.query(cls)
             if diracjob_id is not None:
                 query = query.filter_by(id=diracjob_id)
@@ -86,7 +96,7 @@ class DiracJobs(SQLTableBase):
 
             if diracjob_id is None:
                 requests = query.all()
-                session.expunge_all()
+                release(session)
                 return requests
 
             try:
@@ -98,5 +108,125 @@ class DiracJobs(SQLTableBase):
                 cls.logger.error("Multiple results found for dirac job id: %d",
                                  parametricjob_id)
                 raise
-            session.expunge(diracjob)
+            release(session, diracjob)
             return diracjob
+
+    @classmethod
+    def get_states(cls, request_id, parametricjob_id, statuses=None, session=None):
+        """
+        Get the state of the dirac jobs belonging to a parametric job.
+
+        This is a lightweight alternative to loading the full DiracJobs objects.
+
+        Args:
+            request_id (int): The id of the request the jobs belong to
+            parametricjob_id (int): The id of the parametric job the jobs belong to
+            statuses (Iterable): Only get the jobs in these DiracStatus, by default all of them
+            session (Session): The session to query in, by default a new managed_session
+
+        Returns:
+            list: (id, status, reschedules) row tuples
+        """
+        with managed_session(read_only=True, session=session) as session:
+            query = session.query(cls.id, cls.status, cls.reschedules)\
+                           .filter_by(request_id=request_id, parametricjob_id=parametricjob_id)
+            if statuses is not None:
+                query = query.filter(cls.status.in_(sorted(statuses, key=lambda s: s.name)))
+            return query.all()
+
+    @classmethod
+    def status_counts(cls, request_ids, session=None):
+        """
+        Count the dirac jobs of many requests' parametric jobs in each status.
+
+        The counting is done DB side with a GROUP BY request_id, parametricjob_id,
+        status per chunk of request ids, which is covered by the request_id,
+        parametricjob_id, status index.
+
+        Args:
+            request_ids (Iterable): The ids of the requests the jobs belong to
+            session (Session): The session to query in, by default a new managed_session
+
+        Returns:
+            defaultdict: Counters of the number of jobs keyed by DiracStatus,
+                         keyed by (request_id, parametricjob_id)
+        """
+        counts = defaultdict(Counter)
+        with managed_session(read_only=True, session=session) as session:
+            for chunk in igroup(sorted(request_ids), IN_CLAUSE_CHUNK_SIZE):
+                rows = session.query(cls.request_id, cls.parametricjob_id,
+                                     cls.status, func.count(cls.id))\
+                              .filter(cls.request_id.in_(chunk))\
+                              .group_by(cls.request_id, cls.parametricjob_id, cls.status)\
+                              .all()
+                for request_id, parametricjob_id, status, count in rows:
+                    counts[(request_id, parametricjob_id)][status] = count
+        return counts
+
+    @classmethod
+    def bulk_update(cls, session, changes):
+        """
+        Bulk write back changes to the state of many dirac jobs.
+
+        The changes are applied as a single executemany UPDATE within the given
+        session's transaction rather than by merging each DiracJobs object.
+
+        Args:
+            session (Session): The session whose transaction to make the update in
+            changes (list): (id, status, reschedules) tuples of the new job states
+
+        Returns:
+            int: The number of rows updated
+        """
+        if not changes:
+            return 0
+        table = cls.__table__
+        statement = table.update()\
+                         .where(table.c.id == bindparam('job_id'))\
+                         .values(status=bindparam('job_status'),
+                                 reschedules=bindparam('job_reschedules'))
+        result = session.execute(statement, [{'job_id': job_id,
+                                              'job_status': status,
+                                              'job_reschedules': reschedules}
+                                             for job_id, status, reschedules in changes])
+        return result.rowcount
+
+    @classmethod
+    def add_submitted(cls, request_id, parametricjob_id, requester_id, ids):
+        """
+        Record newly submitted dirac jobs straight away, in their own transaction.
+
+        Args:
+            request_id (int): The id of the request the jobs belong to
+            parametricjob_id (int): The id of the parametric job the jobs belong to
+            requester_id (int): The id of the user who made the request
+            ids (Iterable): The DIRAC ids of the submitted jobs
+
+        Returns:
+            int: The number of rows inserted
+        """
+        rows = [{'id': job_id,
+                 'classtype': cls.__mapper__.polymorphic_identity,
+                 'requester_id': requester_id,
+                 'request_id': request_id,
+                 'parametricjob_id': parametricjob_id,
+                 'status': DiracStatus.RECEIVED,
+                 'reschedules': 0} for job_id in ids]
+        if not rows:
+            return 0
+        with managed_session() as session:
+            session.execute(cls.__table__.insert(), rows)
+        return len(rows)
+
+    @classmethod
+    def delete_ids(cls, ids, session=None):
+        """
+        Delete dirac jobs from the DB.
+
+        Args:
+            ids (Iterable): The DIRAC ids of the jobs to delete
+            session (Session): The session to delete in, by default a new managed_session
+        """
+        with managed_session(session=session) as session:
+            for chunk in igroup(sorted(ids), IN_CLAUSE_CHUNK_SIZE):
+                session.query(cls).filter(cls.id.in_(chunk)).delete(synchronize_session=False)
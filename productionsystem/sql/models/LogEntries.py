@@ -0,0 +1,142 @@
+"""Log Entries Table."""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import Column, Integer, TIMESTAMP, TEXT, Index, and_, func, or_
+from ..registry import managed_session, release
+from ..SQLTableBase import SQLTableBase
+
+INSERT_CHUNK_SIZE = 500
+
+
+class LogEntries(SQLTableBase):
+    """
+    Log Entries SQL Table.
+
+    The client facing log of the requests and their parametric jobs, one row
+    per entry. Request level entries have no parametricjob_id. The models
+    buffer their entries until they are next written to the DB, when the
+    entries are appended in bulk.
+    """
+
+    __tablename__ = 'logentries'
+    # Reading a request's or parametric job's log in order.
+    __table_args__ = (Index('ix_logentries_request_id_parametricjob_id_timestamp',
+                            'request_id', 'parametricjob_id', 'timestamp'),)
+    id = Column(Integer, primary_key=True)  # pylint: disable=invalid-name
+    request_id = Column(Integer, nullable=False)
+    parametricjob_id = Column(Integer, nullable=True)
+    timestamp = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+    message = Column(TEXT, nullable=False)
+    logger = logging.getLogger(__name__).getChild(__qualname__)
+
+    @staticmethod
+    def entry(message, request_id=None, parametricjob_id=None):
+        """Return a new entry, to be appended by bulk_add once its ids are known."""
+        return {'request_id': request_id, 'parametricjob_id': parametricjob_id,
+                'timestamp': datetime.utcnow(), 'message': message}
+
+    @classmethod
+    def bulk_add(cls, session, entries):
+        """
+        Append log entries in batched inserts.
+
+        Args:
+            session (Session): The session to insert in
+            entries (list): The entries, as returned by entry
+        """
+        entries = list(entries)
+        for i in range(0, len(entries), INSERT_CHUNK_SIZE):
+            session.execute(cls.__table__.insert(), entries[i:i + INSERT_CHUNK_SIZE])
+        return len(entries)
+
+    @classmethod
+    def _log_filter(cls, request_id, parametricjob_id):
+        if parametricjob_id is None:
+            return and_(cls.request_id == request_id, cls.parametricjob_id.is_(None))
+        return and_(cls.request_id == request_id, cls.parametricjob_id == parametricjob_id)
+
+    @classmethod
+    def get(cls, request_id, parametricjob_id=None, offset=0, limit=100, session=None):
+        """
+        Get a page of the log of a request or parametric job, oldest first.
+
+        Args:
+            request_id (int): The request id
+            parametricjob_id (int): The parametric job id, None for the request's own log
+            offset (int): The number of entries to skip
+            limit (int): The maximum number of entries to return, None for all
+            session (Session): The session to query in, by default a new managed_session
+        """
+        with managed_session(read_only=True, session=session) as session:
+            query = session.query(cls)\
+                           .filter(cls._log_filter(request_id, parametricjob_id))\
+                           .order_by(cls.timestamp, cls.id)\
+                           .offset(offset)\
+                           .limit(limit)
+            entries = query.all()
+            release(session)
+            return entries
+
+    @classmethod
+    def delete(cls, request_id, session=None):
+        """Delete all the log entries of a request and its parametric jobs."""
+        with managed_session(session=session) as session:
+            return session.query(cls)\
+                          .filter_by(request_id=request_id)\
+                          .delete(synchronize_session=False)
+
+    @classmethod
+    def compact(cls, max_age=None, max_entries=None):
+        """
+        Apply the log retention policy.
+
+        Args:
+            max_age (float): Delete the entries older than this (in days)
+            max_entries (int): Keep at most this many of the latest entries of each log,
+                               replacing those removed by a single entry saying so
+
+        Returns:
+            int: The number of entries deleted
+        """
+        deleted = 0
+        with managed_session() as session:
+            if max_age:
+                deleted += session.query(cls)\
+                                  .filter(cls.timestamp < datetime.utcnow()
+                                          - timedelta(days=max_age))\
+                                  .delete(synchronize_session=False)
+            if not max_entries:
+                return deleted
+
+            # Leave room for the entry recording the compaction.
+            keep = max(max_entries - 1, 0)
+            oversized = session.query(cls.request_id, cls.parametricjob_id)\
+                               .group_by(cls.request_id, cls.parametricjob_id)\
+                               .having(func.count(cls.id) > max_entries)\
+                               .all()
+            for request_id, parametricjob_id in oversized:
+                log_filter = cls._log_filter(request_id, parametricjob_id)
+                last_timestamp, last_id = session.query(cls.timestamp, cls.id)\
+                                                 .filter(log_filter)\
+                                                 .order_by(cls.timestamp.desc(), cls.id.desc())\
+                                                 .offset(keep)\
+                                                 .limit(1)\
+                                                 .one()
+                removed = session.query(cls)\
+                                 .filter(log_filter,
+                                         or_(cls.timestamp < last_timestamp,
+                                             and_(cls.timestamp == last_timestamp,
+                                                  cls.id <= last_id)))\
+                                 .delete(synchronize_session=False)
+                message = "%d earlier log entries removed" % removed
+                cls.bulk_add(session, [dict(cls.entry(message, request_id, parametricjob_id),
+                                            timestamp=last_timestamp)])
+                deleted += removed
+        if deleted:
+            cls.logger.info("Removed %d log entries.", deleted)
+        return deleted
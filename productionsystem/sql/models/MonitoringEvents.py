@@ -0,0 +1,63 @@
+"""Monitoring Events Table."""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+
+import logging
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, TIMESTAMP, func
+from ..registry import managed_session
+from ..SQLTableBase import SQLTableBase
+
+
+class MonitoringEvents(SQLTableBase):
+    """
+    Monitoring Events SQL Table.
+
+    A queue of the requests the web app wants the monitoring daemon to look
+    at straight away (e.g. on approval, reschedule or deletion) rather than
+    waiting for its next full monitoring cycle.
+    """
+
+    __tablename__ = 'monitoringevents'
+    id = Column(Integer, primary_key=True)  # pylint: disable=invalid-name
+    request_id = Column(Integer, nullable=False)
+    reason = Column(String(30), nullable=False, default="")
+    timestamp = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+    logger = logging.getLogger(__name__).getChild(__qualname__)
+
+    @classmethod
+    def notify(cls, request_id, reason=""):
+        """
+        Signal the monitoring daemon to wake up and monitor a request.
+
+        Args:
+            request_id (int): The id of the request to monitor
+            reason (str): Why the request needs monitoring (for logging)
+        """
+        with managed_session() as session:
+            session.add(cls(request_id=request_id, reason=reason))
+        cls.logger.debug("Monitoring daemon notified of request %d (%s)", request_id, reason)
+
+    @classmethod
+    def consume(cls):
+        """
+        Pop all outstanding events.
+
+        This is cheap enough to poll frequently as the table only ever
+        holds the events signalled since it was last consumed.
+
+        Returns:
+            set: The ids of the requests to monitor
+        """
+        with managed_session() as session:
+            last_id = session.query(func.max(cls.id)).scalar()
+            if last_id is None:
+                return set()
+            events = session.query(cls.request_id, cls.reason).filter(cls.id <= last_id).all()
+            session.query(cls).filter(cls.id <= last_id).delete(synchronize_session=False)
+
+        for request_id, reason in events:
+            cls.logger.debug("Consumed monitoring event for request %d (%s)", request_id, reason)
+        return {request_id for request_id, _ in events}
@@ -0,0 +1,82 @@
+"""Monitoring Schedule Table."""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+
+import logging
+from datetime import datetime
+from sqlalchemy import Column, Integer, TIMESTAMP
+from productionsystem.utils import igroup
+from ..registry import managed_session, release
+from ..SQLTableBase import SQLTableBase
+from .DiracJobs import IN_CLAUSE_CHUNK_SIZE
+
+
+class MonitoringSchedule(SQLTableBase):
+    """
+    Monitoring Schedule SQL Table.
+
+    Records when each active request is next due to be monitored. This is
+    persisted so that a restarted monitoring daemon carries on with the same
+    schedule rather than polling every request at once.
+    """
+
+    __tablename__ = 'monitoringschedule'
+    request_id = Column(Integer, primary_key=True)
+    interval = Column(Integer, nullable=False)  # seconds
+    next_due = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+    last_change = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+    logger = logging.getLogger(__name__).getChild(__qualname__)
+
+    @classmethod
+    def get(cls, request_ids, session=None):
+        """
+        Get the schedule of requests.
+
+        Args:
+            request_ids (Iterable): The ids of the requests to get the schedule of
+            session (Session): The session to query in, by default a new managed_session
+
+        Returns:
+            dict: The MonitoringSchedule keyed by request id. Requests that
+                  have never been scheduled are missing.
+        """
+        schedules = {}
+        for chunk in igroup(sorted(request_ids), IN_CLAUSE_CHUNK_SIZE):
+            with managed_session(session=session) as chunk_session:
+                rows = chunk_session.query(cls).filter(cls.request_id.in_(chunk)).all()
+                release(chunk_session)
+            schedules.update((row.request_id, row) for row in rows)
+        return schedules
+
+    @classmethod
+    def update_all(cls, schedules, session=None):
+        """
+        Update the DB with many schedules in a single transaction.
+
+        Args:
+            schedules (Iterable): The MonitoringSchedule objects to add or update
+            session (Session): The session to update in, by default a new managed_session
+        """
+        with managed_session(session=session) as session:
+            for schedule in schedules:
+                session.merge(schedule)
+
+    @classmethod
+    def prune(cls, request_ids):
+        """
+        Remove the schedule of all requests other than those given.
+
+        Args:
+            request_ids (Iterable): The ids of the requests to keep the schedule of
+        """
+        request_ids = set(request_ids)
+        with managed_session() as session:
+            stale_ids = [request_id for request_id, in session.query(cls.request_id)
+                         if request_id not in request_ids]
+            for chunk in igroup(stale_ids, IN_CLAUSE_CHUNK_SIZE):
+                session.query(cls).filter(cls.request_id.in_(chunk))\
+                                  .delete(synchronize_session=False)
+        if stale_ids:
+            cls.logger.debug("Removed the monitoring schedule of %d request(s)", len(stale_ids))
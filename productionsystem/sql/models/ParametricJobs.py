@@ -5,6 +5,7 @@ from __future__ import (absolute_import, division,
 from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin, bad-option-value # noqa: F401, F403, E501
 
 import os
+import time
 import logging
 from datetime import datetime
 from collections import defaultdict, Counter
@@ -12,26 +13,48 @@ try:
     from collections import Iterable
 except ImportError:
     from collections.abc import Iterable
-from copy import deepcopy
 from operator import attrgetter
+from multiprocessing.pool import ThreadPool
 
-from future.utils import native
+from future.utils import native, viewitems
 import cherrypy
 from sqlalchemy import (Column, SmallInteger, Integer, Boolean, TEXT, TIMESTAMP,
-                        ForeignKey, Enum, CheckConstraint, event, inspect)
+                        ForeignKey, Enum, CheckConstraint, Index, event, inspect, and_, or_)
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, make_transient_to_detached, deferred
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 from productionsystem.config import getConfig
-from productionsystem.utils import TemporyFileManagerContext, igroup, timestamp
-from productionsystem.monitoring.diracrpc.DiracRPCClient import (dirac_api_client,
-                                                                 dirac_api_job_client)
+from productionsystem.utils import TemporyFileManagerContext, igroup
+from productionsystem.monitoring.diracrpc.DiracRPCClient import (dirac_api_job_client,
+                                                                 bulk_status,
+                                                                 bulk_reschedule,
+                                                                 bulk_kill_delete,
+                                                                 submit_jdls)
+from productionsystem.monitoring.diracrpc.metrics import call_context, current_context
 # from lzproduction.rpc.DiracRPCClient import dirac_api_client, ParametricDiracJobClient
 from ..enums import LocalStatus, DiracStatus
-from ..registry import managed_session, SessionRegistry
+from ..registry import managed_session, release, SessionRegistry
 from ..SQLTableBase import SQLTableBase, SmartColumn
-from ..models import DiracJobs
+from ..models import DiracJobs, LogEntries
+from .DiracJobs import IN_CLAUSE_CHUNK_SIZE
+
+MONITORED_STATUSES = frozenset((LocalStatus.APPROVED,
+                                LocalStatus.REQUESTED,
+                                LocalStatus.SUBMITTED,
+                                LocalStatus.SUBMITTING,
+                                LocalStatus.RUNNING,
+                                LocalStatus.REMOVING))
+MONITORED_DIRAC_STATUSES = frozenset((DiracStatus.RUNNING,
+                                      DiracStatus.RECEIVED,
+                                      DiracStatus.QUEUED,
+                                      DiracStatus.WAITING,
+                                      DiracStatus.CHECKING,
+                                      DiracStatus.MATCHED,
+                                      DiracStatus.UNKNOWN,
+                                      DiracStatus.COMPLETED,
+                                      DiracStatus.COMPLETING))
 
 
 def subdict(dct, keys, **kwargs):
@@ -51,6 +74,8 @@ class ParametricJobs(SQLTableBase):
     __mapper_args__ = {'polymorphic_on': classtype,
                        'polymorphic_identity': 'parametricjobs',
                        'with_polymorphic': '*'}
+    # Finding the parametric jobs to reschedule, joined to their requests.
+    __table_args__ = (Index('ix_parametricjobs_reschedule_request_id', 'reschedule', 'request_id'),)
     request_id = SmartColumn(Integer, ForeignKey('requests.id'), primary_key=True, required=True)
     id = SmartColumn(Integer, primary_key=True, required=True)  # pylint: disable=invalid-name
     requester_id = SmartColumn(Integer, ForeignKey('users.id'), required=True, nullable=False)
@@ -65,8 +90,13 @@ class ParametricJobs(SQLTableBase):
     num_failed = Column(Integer, nullable=False, default=0)
     num_submitted = Column(Integer, nullable=False, default=0)
     num_running = Column(Integer, nullable=False, default=0)
-    log = Column(TEXT, nullable=False, default="")
-    dirac_jobs = relationship("DiracJobs", cascade="all, delete-orphan",
+    # Superseded by LogEntries. Never loaded, only filled in on insert so that code older than
+    # LogEntries sharing the DB keeps working, until a later migration drops the column.
+    log = deferred(Column(TEXT, nullable=False, default=""))
+    # Not merged, as the DIRAC job rows are written in bulk (see DiracJobs.add_submitted and
+    # bulk_update), so that merging a parametric job doesn't load every one of them.
+    dirac_jobs = relationship("DiracJobs",
+                              cascade="save-update, refresh-expire, expunge, delete, delete-orphan",
                               primaryjoin="and_(ParametricJobs.request_id==DiracJobs.request_id, "
                                           "ParametricJobs.id==DiracJobs.parametricjob_id)")
     logger = logging.getLogger(__name__).getChild(__qualname__)
@@ -87,30 +117,134 @@ class ParametricJobs(SQLTableBase):
         # pylint: disable=no-member
         super(ParametricJobs, self).__init__(**subdict(kwargs, self.allowed_columns))
 
-    def update(self):
-        """Update DB with current values."""
-        with managed_session() as session:
-            session.merge(self)
+    @property
+    def awaiting_submission(self):
+        """Return True if this parametric job has not been submitted to DIRAC yet."""
+        return self.status == LocalStatus.REQUESTED and not self.num_jobs and not self.reschedule
+
+    def update(self, session=None):
+        """
+        Update DB with current values.
+
+        Any DIRAC job state changes recorded by monitor are bulk written
+        back in the same transaction, as are any new log entries.
+
+        Args:
+            session (Session): The session to update in, by default a new managed_session
+
+        Returns:
+            int: The number of DIRAC job rows updated
+        """
+        entries = self.pop_log_entries()
+        with managed_session(session=session) as session:
+            merged = session.merge(self)
+            if merged is not self:
+                # Status transitions merged into the persistent copy are logged there.
+                entries.extend(merged.pop_log_entries())
+            LogEntries.bulk_add(session, entries)
+            return DiracJobs.bulk_update(session, self.pop_dirac_job_changes())
+
+    def pop_dirac_job_changes(self):
+        """
+        Pop the DIRAC job state changes recorded by monitor.
+
+        Returns:
+            list: (id, status, reschedules) tuples of the new job states
+        """
+        return self.__dict__.pop('_dirac_job_changes', [])
+
+    def pop_log_entries(self):
+        """
+        Pop the log entries recorded since this parametric job was last written to the DB.
+
+        Returns:
+            list: The new LogEntries rows
+        """
+        entries = self.__dict__.pop('_log_entries', [])
+        for entry in entries:
+            entry.update(request_id=self.request_id, parametricjob_id=self.id)
+        return entries
 
     def _clientlog(self, log):
-        self.log += "%s %s\n" % (timestamp(), log)
+        self.__dict__.setdefault('_log_entries', []).append(LogEntries.entry(log))
 
-    def _remove_dirac_jobs(self):
-        """Remove dirac_jobs from the DIRAC system."""
-        if not self.dirac_jobs:
-            return
+    @classmethod
+    def kill_delete_dirac_jobs(cls, dirac_ids):
+        """
+        Kill and delete DIRAC jobs.
+
+        The jobs are removed in chunks, several of which can be in flight at once.
+        Failed chunks are retried with exponential backoff. All are set from the
+        parametricjobs config section (removal_chunk_size, removal_chunks_in_flight,
+        removal_attempts and removal_backoff).
+
+        Args:
+            dirac_ids (Iterable): The DIRAC job ids to remove
 
-        dirac_ids = [job.id for job in self.dirac_jobs]
-        for ids in igroup(dirac_ids, 1000):
+        Returns:
+            set: The ids of the DIRAC jobs that could not be removed
+        """
+        config = getConfig("parametricjobs")
+        chunk_size = config.get("removal_chunk_size", 1000)
+        chunks_in_flight = config.get("removal_chunks_in_flight", 4)
+        attempts = config.get("removal_attempts", 3)
+        backoff = config.get("removal_backoff", 5)
+        context = current_context()
+
+        def remove_chunk(ids):
+            """Kill and delete a single chunk of jobs, retrying on failure."""
+            for attempt in range(1, attempts + 1):
+                try:
+                    with call_context(**context):  # May be running in a pool thread
+                        result = bulk_kill_delete(ids)
+                except Exception as err:
+                    message = repr(err)
+                else:
+                    if result['OK']:
+                        return True
+                    message = result['Message']
+                cls.logger.warning("Attempt %d/%d to kill/delete %d DIRAC job(s) failed: %s",
+                                   attempt, attempts, len(ids), message)
+                if attempt < attempts:
+                    time.sleep(backoff * 2 ** (attempt - 1))
+            return False
+
+        chunks = list(igroup(sorted(dirac_ids), chunk_size))
+        if not chunks:
+            return set()
+        cls.logger.info("Killing/deleting %d DIRAC job(s) in %d chunk(s).",
+                        sum(len(chunk) for chunk in chunks), len(chunks))
+        if chunks_in_flight > 1 and len(chunks) > 1:
+            pool = ThreadPool(min(chunks_in_flight, len(chunks)))
             try:
-                with dirac_api_client() as dirac:
-                    self.logger.info("Killing/deleting %d DIRAC job(s).", len(ids))
-                    dirac.killJob(ids)
-                    dirac.deleteJob(ids)
-            except BaseException:
-                self.logger.exception("Error doing DIRAC tidy up of %d job(s). Cleaning up local "
-                                      "system and forgetting about the (possibly) orphaned jobs "
-                                      "on DIRAC system", len(ids))
+                results = pool.map(remove_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [remove_chunk(chunk) for chunk in chunks]
+
+        failed_ids = set()
+        for chunk, removed in zip(chunks, results):
+            if not removed:
+                failed_ids.update(chunk)
+        if failed_ids:
+            cls.logger.error("Failed to kill/delete %d DIRAC job(s).", len(failed_ids))
+        return failed_ids
+
+    def _remove_dirac_jobs(self, dirac_ids=None):
+        """
+        Remove dirac_jobs from the DIRAC system.
+
+        Args:
+            dirac_ids (Iterable): The DIRAC job ids to remove. Defaults to those of dirac_jobs
+        """
+        if dirac_ids is None:
+            dirac_ids = [job.id for job in self.dirac_jobs]
+        if self.kill_delete_dirac_jobs(dirac_ids):
+            self.logger.error("Error doing DIRAC tidy up for parametric job %d.%d. Cleaning up "
+                              "local system and forgetting about the (possibly) orphaned jobs "
+                              "on DIRAC system", self.request_id, self.id)
 
 #    @abstractmethod
     def _setup_dirac_job(self, DiracJob, tmp_runscript, tmp_filemanager):
@@ -122,9 +256,116 @@ class ParametricJobs(SQLTableBase):
         job.setExecutable(os.path.basename(tmp_runscript.name))
         return [job]
 
-    def submit(self):
-        """Submit parametric job."""
-        with dirac_api_job_client() as (dirac, dirac_job_class), \
+    def _chunk_result(self, result, start):
+        """
+        Interpret the DIRAC result of submitting a chunk of DIRAC jobs.
+
+        Args:
+            result (dict): The DIRAC submission result
+            start (float): When the submission of the chunk started
+
+        Returns:
+            tuple: The ids of the DIRAC jobs created, the client log error
+                   message (None on success) and the wall time taken (in seconds)
+        """
+        if not result['OK']:
+            self.logger.error("DIRAC error submitting parametricjob %d.%d: %s",
+                              self.request_id, self.id, result['Message'])
+            return [], ("DIRAC error submitting parametricjob %d.%d"
+                        % (self.request_id, self.id)), time.time() - start
+
+        created_ids = result['Value']
+        if isinstance(created_ids, int):  # non-parametric submission
+            created_ids = [created_ids]
+        return list(created_ids), None, time.time() - start
+
+    def _chunk_error(self, err, start):
+        """Return the chunk result of an error calling DIRAC to submit (see _chunk_result)."""
+        self.logger.error("Error submitting parametric job %d.%d: %s",
+                          self.request_id, self.id, err, exc_info=True)
+        return [], ("Error submitting parametric job %d.%d using DIRAC API"
+                    % (self.request_id, self.id)), time.time() - start
+
+    def _submit_chunk(self, jdl):
+        """
+        Submit a single chunk of DIRAC jobs.
+
+        The server may submit a big parametric chunk in parts (see
+        submit_jdls), whose results are combined.
+
+        Args:
+            jdl (str): The JDL of the DIRAC job to submit
+
+        Returns:
+            tuple: see _chunk_result
+        """
+        start = time.time()
+        created_ids = []
+        try:
+            with call_context(request_id=self.request_id, parametricjob_id=self.id):
+                for result in submit_jdls([jdl]):
+                    part_ids, error, _ = self._chunk_result(result, start)
+                    created_ids.extend(part_ids)
+                    if error is not None:
+                        return created_ids, error, time.time() - start
+        except Exception as err:
+            _, error, wall_time = self._chunk_error(err, start)
+            return created_ids, error, wall_time
+        return created_ids, None, time.time() - start
+
+    def _stream_chunks(self, jdls):
+        """
+        Submit chunks of DIRAC jobs one after the other.
+
+        All the chunks are sent in a single streaming call to the server,
+        which stops at the first failure.
+
+        Args:
+            jdls (list): The JDL of each DIRAC job to submit
+
+        Yields:
+            tuple: The result of each chunk (see _chunk_result) as soon as it is submitted
+        """
+        start = time.time()
+        try:
+            for result in submit_jdls(jdls):
+                yield self._chunk_result(result, start)
+                start = time.time()
+        except Exception as err:
+            yield self._chunk_error(err, start)
+
+    def _remove_leftover_dirac_jobs(self):
+        """Remove any DIRAC jobs recorded by an earlier, interrupted, submission."""
+        leftover_ids = [job_id for job_id, _, _ in DiracJobs.get_states(self.request_id, self.id)]
+        if not leftover_ids:
+            return
+        self._clientlog("Removing %d DIRAC job(s) left over from an interrupted submission"
+                        % len(leftover_ids))
+        self.logger.warning("Removing %d DIRAC job(s) left over from an interrupted submission "
+                            "of parametric job %d.%d", len(leftover_ids), self.request_id, self.id)
+        self._remove_dirac_jobs(leftover_ids)
+        DiracJobs.delete_ids(leftover_ids)
+
+    def submit(self, resume=False):
+        """
+        Submit parametric job.
+
+        The DIRAC jobs returned by _setup_dirac_job are submitted one after the
+        other unless submit_chunks_in_flight is set in the parametricjobs config
+        section, in which case up to that many are submitted concurrently. The
+        jobs created by each chunk are recorded in the DB as soon as it is
+        submitted, so that they are known even if the submission is interrupted.
+        If any chunk fails, or no DIRAC jobs are created at all, the parametric
+        job is marked FAILED and all the jobs created are removed again.
+
+        Args:
+            resume (bool): Resume an interrupted submission, removing any DIRAC
+                           jobs recorded by it first
+        """
+        if resume:
+            self._remove_leftover_dirac_jobs()
+        with call_context(request_id=self.request_id, parametricjob_id=self.id), \
+                dirac_api_job_client() as (_, dirac_job_class), \
                 TemporyFileManagerContext() as tmp_filemanager, \
                 open(os.path.join(tmp_filemanager.new_dir(), "runscript.sh"), "w") as tmp_runscript:
             os.chmod(tmp_runscript.name, 0o755)
@@ -132,6 +373,10 @@ class ParametricJobs(SQLTableBase):
                 dirac_jobs = self._setup_dirac_job(dirac_job_class,
                                                    tmp_runscript,
                                                    tmp_filemanager)
+                if not isinstance(dirac_jobs, Iterable):
+                    dirac_jobs = [dirac_jobs]
+                # Submitted as JDL so that no calls need to be made back to the client.
+                jdls = [dirac_job.toJDL() for dirac_job in dirac_jobs]
             except Exception as err:
                 self._clientlog("Error setting up DIRAC jobs for parametric job %d.%d"
                                 % (self.request_id, self.id))
@@ -140,77 +385,266 @@ class ParametricJobs(SQLTableBase):
                 self.status = LocalStatus.FAILED
                 return
 
-            if not isinstance(dirac_jobs, Iterable):
-                dirac_jobs = [dirac_jobs]
-
             # If the parametricjob has large number of subjobs then submission could timeout
             # waiting for DIRAC to create all the subjobs, this allows you to split it into
             # a few parametricjobs.
             dirac_job_ids = set()
 
-            if not dirac_jobs:
+            if not jdls:
                 self._clientlog("No DIRAC jobs were created so none to submit.")
                 self.logger.warning("No DIRAC jobs were created so none to submit.")
 
-            for dirac_job in dirac_jobs:
-                try:
-                    result = dirac.submitJob(dirac_job)
-                except Exception as err:
-                    self._clientlog("Error submitting parametric job %d.%d using DIRAC API"
-                                    % (self.request_id, self.id))
-                    self.logger.exception("Error submitting parametric job %d.%d: %s",
-                                          self.request_id, self.id, err)
-                    self.status = LocalStatus.FAILED
-                    self._remove_dirac_jobs()  # Clean up Dirac jobs that may have been created
-                    return
+            chunks_in_flight = getConfig("parametricjobs").get("submit_chunks_in_flight", 1)
+            pool = None
+            if chunks_in_flight > 1 and len(jdls) > 1:
+                # Each chunk is sent over its own pooled connection.
+                pool = ThreadPool(min(chunks_in_flight, len(jdls)))
+                results = pool.imap(self._submit_chunk, jdls)
+            else:
+                results = self._stream_chunks(jdls)
 
-                if not result['OK']:
-                    self._clientlog("DIRAC error submitting parametricjob %d.%d"
-                                    % (self.request_id, self.id))
-                    self.logger.error("DIRAC error submitting parametricjob %d.%d: %s",
-                                      self.request_id, self.id, result['Message'])
-                    self.status = LocalStatus.FAILED
-                    self._remove_dirac_jobs()  # Clean up Dirac jobs that may have been created
-                    return
-
-                created_ids = result['Value']
-                if isinstance(created_ids, int):  # non-parametric submission
-                    created_ids = [created_ids]
-                dirac_job_ids.update(created_ids)
+            failed = False
+            try:
+                for chunk_num, (created_ids, error, wall_time) in enumerate(results, 1):
+                    dirac_job_ids.update(created_ids)
+                    DiracJobs.add_submitted(self.request_id, self.id, self.requester_id,
+                                            created_ids)
+                    if error is not None:
+                        self._clientlog(error)
+                        failed = True
+                        continue
+                    # Big chunks may be submitted in parts, each with its own result.
+                    self._clientlog("Submitted DIRAC job chunk %d (%d job(s)) in %.1fs"
+                                    % (chunk_num, len(created_ids), wall_time))
+            except Exception as err:
+                self._clientlog("Error recording the submitted DIRAC jobs for parametric job %d.%d"
+                                % (self.request_id, self.id))
+                self.logger.exception("Error recording the submitted DIRAC jobs for parametric "
+                                      "job %d.%d: %s", self.request_id, self.id, err)
+                failed = True
+                if pool is None:
+                    results.close()  # Don't submit any more chunks
+                else:
+                    for created_ids, _, _ in results:  # Chunks already queued still need removing
+                        dirac_job_ids.update(created_ids)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+            if failed:
+                self.status = LocalStatus.FAILED
+                # Clean up Dirac jobs that may have been created
+                self._remove_dirac_jobs(dirac_job_ids)
+                DiracJobs.delete_ids(dirac_job_ids)
+                return
 
             if not dirac_job_ids:
-                self._clientlog("DIRAC job submit API returned not job ids.")
-                self.logger.warning("DIRAC job submit API returned not job ids.")
+                self._clientlog("DIRAC job submit API returned no job ids, "
+                                "marking parametric job %d.%d as failed."
+                                % (self.request_id, self.id))
+                self.logger.error("DIRAC job submit API returned no job ids for parametric "
+                                  "job %d.%d, marking it as failed.", self.request_id, self.id)
+                self.status = LocalStatus.FAILED
+                return
 
-            self.dirac_jobs = [DiracJobs(id=i, parametricjob_id=self.id, request_id=self.request_id,
-                                         requester_id=self.requester_id,
-                                         status=DiracStatus.RECEIVED) for i in dirac_job_ids]
+            # The DIRAC jobs are already in the DB so are set without history, which
+            # also stops delete-orphan removing them if a stale collection was loaded.
+            # They are marked as persistent so they aren't inserted again if self is
+            # added to a unit of work. Merging self (e.g. Requests.update) skips them.
+            dirac_jobs = [DiracJobs(id=i, parametricjob_id=self.id,
+                                    request_id=self.request_id,
+                                    requester_id=self.requester_id,
+                                    status=DiracStatus.RECEIVED, reschedules=0)
+                          for i in sorted(dirac_job_ids)]
+            for dirac_job in dirac_jobs:
+                make_transient_to_detached(dirac_job)
+            set_committed_value(self, 'dirac_jobs', dirac_jobs)
             self.num_jobs = len(self.dirac_jobs)
-            if self.num_jobs:
-                self._clientlog("Successfully submitted %d Dirac jobs for %d.%d"
-                                % (self.num_jobs, self.request_id, self.id))
-                self.logger.info("Successfully submitted %d Dirac jobs for %d.%d",
-                                 self.num_jobs, self.request_id, self.id)
+            self._clientlog("Successfully submitted %d Dirac jobs for %d.%d"
+                            % (self.num_jobs, self.request_id, self.id))
+            self.logger.info("Successfully submitted %d Dirac jobs for %d.%d",
+                             self.num_jobs, self.request_id, self.id)
+
+    @classmethod
+    def monitored_dirac_ids(cls, request_ids):
+        """
+        Get the ids of the DIRAC jobs whose status is polled by monitor.
+
+        Args:
+            request_ids (Iterable): The ids of the requests to get the DIRAC jobs of
+
+        Returns:
+            dict: The set of DIRAC job ids keyed by request id
+        """
+        dirac_ids = defaultdict(set)
+        for chunk in igroup(sorted(request_ids), IN_CLAUSE_CHUNK_SIZE):
+            with managed_session() as session:
+                rows = session.query(DiracJobs.request_id, DiracJobs.id)\
+                              .join(cls, and_(cls.request_id == DiracJobs.request_id,
+                                              cls.id == DiracJobs.parametricjob_id))\
+                              .filter(DiracJobs.request_id.in_(chunk),
+                                      DiracJobs.status.in_(MONITORED_DIRAC_STATUSES),
+                                      cls.status.in_(MONITORED_STATUSES))\
+                              .all()
+            for request_id, dirac_id in rows:
+                dirac_ids[request_id].add(dirac_id)
+        return dict(dirac_ids)
+
+    @classmethod
+    def dirac_job_rollups(cls, parametric_jobs):
+        """
+        Gather the DIRAC job counts and states that monitor needs for many parametric jobs.
+
+        Rather than two queries per parametric job, the DIRAC jobs of all their
+        requests are counted by status in one grouped query and only the jobs
+        whose status can change this cycle are fetched in one more (per chunk of
+        request ids). Failed and stalled jobs are only fetched for the parametric
+        jobs that may reschedule them.
+
+        Args:
+            parametric_jobs (Iterable): The parametric jobs to be monitored
+
+        Returns:
+            dict: The (status counts, (id, status, reschedules) rows) to pass to
+                  monitor, keyed by (request_id, parametricjob_id)
+        """
+        jobs = [job for job in parametric_jobs if job.status in MONITORED_STATUSES]
+        if not jobs:
+            return {}
+        counts = DiracJobs.status_counts(set(job.request_id for job in jobs))
+        rollups = {}
+        rescheduling = set()
+        for job in jobs:
+            key = (job.request_id, job.id)
+            rollups[key] = (counts.get(key, Counter()), [])
+            if job.reschedule or rollups[key][0][DiracStatus.DONE]:
+                rescheduling.add(key)
+
+        rescheduling_request_ids = set(request_id for request_id, _ in rescheduling)
+        for chunk in igroup(sorted(set(request_id for request_id, _ in rollups)),
+                            IN_CLAUSE_CHUNK_SIZE):
+            condition = DiracJobs.status.in_(MONITORED_DIRAC_STATUSES)
+            rescheduling_chunk = rescheduling_request_ids.intersection(chunk)
+            if rescheduling_chunk:
+                condition = or_(condition,
+                                and_(DiracJobs.request_id.in_(sorted(rescheduling_chunk)),
+                                     DiracJobs.status.in_((DiracStatus.FAILED,
+                                                           DiracStatus.STALLED))))
+            with managed_session(read_only=True) as session:
+                rows = session.query(DiracJobs.request_id, DiracJobs.parametricjob_id,
+                                     DiracJobs.id, DiracJobs.status, DiracJobs.reschedules)\
+                              .filter(DiracJobs.request_id.in_(chunk), condition)\
+                              .all()
+            for request_id, parametricjob_id, job_id, status, reschedules in rows:
+                key = (request_id, parametricjob_id)
+                if key in rescheduling or (key in rollups and
+                                           status in MONITORED_DIRAC_STATUSES):
+                    rollups[key][1].append((job_id, status, reschedules))
+        return rollups
+
+    @classmethod
+    def get_dirac_statuses(cls, dirac_ids, since=None):
+        """
+        Bulk query DIRAC for the status of many jobs.
+
+        The jobs are queried in fixed size chunks, several of which can be in
+        flight at once. Both are set from the parametricjobs config section
+        (status_chunk_size and status_chunks_in_flight). If status_async is set
+        the chunks are queried with the asyncio client rather than a thread each.
+
+        Args:
+            dirac_ids (Iterable): The DIRAC job ids to query
+            since (datetime): If given, only return the status of jobs that have
+                              changed since this (UTC) time
+
+        Returns:
+            tuple: The DiracStatus of each job keyed by job id and the set of
+                   job ids in chunks that could not be queried
+        """
+        config = getConfig("parametricjobs")
+        chunk_size = config.get("status_chunk_size", 10000)
+        chunks_in_flight = config.get("status_chunks_in_flight", 1)
+        since_str = None if since is None else since.strftime("%Y-%m-%d %H:%M:%S")
+
+        def check_answer(ids, dirac_answer):
+            """Return the statuses from a DIRAC answer, or None if it failed."""
+            if isinstance(dirac_answer, Exception):
+                cls.logger.error("Error calling DIRAC to monitor %d job(s): %r",
+                                 len(ids), dirac_answer)
+                return None
+            if not dirac_answer['OK']:
+                cls.logger.error("DIRAC failed to get statuses for %d job(s): %s",
+                                 len(ids), dirac_answer['Message'])
+                return None
+            return dirac_answer['Value']
+
+        def query_chunk(ids):
+            """Query the status of a single chunk of jobs."""
+            try:
+                dirac_answer = bulk_status(ids, since=since_str)
+            except Exception as err:
+                cls.logger.exception("Error calling DIRAC to monitor %d job(s): %s", len(ids), err)
+                return None
+            return check_answer(ids, dirac_answer)
+
+        dirac_ids = sorted(dirac_ids)
+        chunks = list(igroup(dirac_ids, chunk_size))
+        if config.get("status_async", False) and len(chunks) > 1:
+            # Imported here as the asyncio client is Python 3 only.
+            from productionsystem.monitoring.diracrpc.AsyncDiracRPCClient import run_bulk_status
+            answers = run_bulk_status(chunks, since_str, max_in_flight=chunks_in_flight)
+            results = [check_answer(chunk, answer) for chunk, answer in zip(chunks, answers)]
+        elif chunks_in_flight > 1 and len(chunks) > 1:
+            pool = ThreadPool(min(chunks_in_flight, len(chunks)))
+            try:
+                results = pool.map(query_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [query_chunk(chunk) for chunk in chunks]
+
+        statuses = {}
+        failed_ids = set()
+        for chunk, result in zip(chunks, results):
+            if result is None:
+                failed_ids.update(chunk)
+            else:
+                statuses.update(result)
+        cls.logger.info("Got the status of %d/%d %sDIRAC job(s) in %d call(s).",
+                        len(statuses), len(dirac_ids),
+                        '' if since is None else 'changed ', len(chunks))
+        return statuses, failed_ids
 
-    def monitor(self):
+    def monitor(self, dirac_statuses=None, dirac_jobs=None):
         """
         Bulk update status.
 
         This method updates all DIRAC jobs which belong to the given
-        parametricjob.
+        parametricjob. The jobs are counted by status DB side and only those
+        that can change state this cycle are fetched (see dirac_job_rollups).
+        The changed DIRAC job states are only recorded here, to be bulk written
+        back by update (or the owning request's update).
+
+        Args:
+            dirac_statuses (dict): The DiracStatus of jobs already gathered for
+                                   this cycle, keyed by job id. If given, DIRAC is only
+                                   queried for jobs rescheduled here and jobs missing
+                                   from it are treated as unchanged.
+            dirac_jobs (tuple): This parametric job's entry from dirac_job_rollups,
+                                gathered here if not given
         """
         # Group jobs by status
 
-        if self.status not in (LocalStatus.APPROVED,
-                               LocalStatus.REQUESTED,
-                               LocalStatus.SUBMITTED,
-                               LocalStatus.SUBMITTING,
-                               LocalStatus.RUNNING,
-                               LocalStatus.REMOVING):
+        if self.status not in MONITORED_STATUSES:
             self.logger.debug("Not monitoring parametric job %d.%d as state %r", self.request_id, self.id, self.status)
             return
 
-        if not self.dirac_jobs:
+        if dirac_jobs is None:
+            dirac_jobs = self.dirac_job_rollups([self])[(self.request_id, self.id)]
+        dirac_counts, dirac_job_states = dirac_jobs
+        if not dirac_counts:
             self._clientlog("No dirac jobs associated with this parametricjob. returning status UNKNOWN")
             self.logger.warning("No dirac jobs associated with parametricjob: "
                                 "%d.%d. returning status UNKNOWN",
@@ -225,23 +659,17 @@ class ParametricJobs(SQLTableBase):
 
         num_reschedules = getConfig("parametricjobs").get("reschedules", 2)
         job_types = defaultdict(set)
-        for job in self.dirac_jobs:
-            job_types[job.status].add(job.id)
+        job_states = {}
+        for job_id, job_status, job_reschedules in dirac_job_states:
+            job_states[job_id] = [job_status, job_reschedules]
+            job_types[job_status].add(job_id)
             # add auto-reschedule jobs
-            if job.status in (DiracStatus.FAILED, DiracStatus.STALLED) and\
-                    job.reschedules < num_reschedules:
-                job_types['Reschedule'].add(job.id)
-
-        reschedule_jobs = job_types['Reschedule'] if job_types[DiracStatus.DONE] else set()
-        monitor_jobs = job_types[DiracStatus.RUNNING] | \
-            job_types[DiracStatus.RECEIVED] | \
-            job_types[DiracStatus.QUEUED] | \
-            job_types[DiracStatus.WAITING] | \
-            job_types[DiracStatus.CHECKING] | \
-            job_types[DiracStatus.MATCHED] | \
-            job_types[DiracStatus.UNKNOWN] | \
-            job_types[DiracStatus.COMPLETED] | \
-            job_types[DiracStatus.COMPLETING]
+            if job_status in (DiracStatus.FAILED, DiracStatus.STALLED) and\
+                    job_reschedules < num_reschedules:
+                job_types['Reschedule'].add(job_id)
+
+        reschedule_jobs = job_types['Reschedule'] if dirac_counts[DiracStatus.DONE] else set()
+        monitor_jobs = set().union(*(job_types[status] for status in MONITORED_DIRAC_STATUSES))
 
         if self.reschedule:  # Manually triggered reschedule of all failed/stalled from Web app
             reschedule_jobs = job_types[DiracStatus.FAILED] | job_types[DiracStatus.STALLED]
@@ -251,33 +679,40 @@ class ParametricJobs(SQLTableBase):
         if reschedule_jobs:
             self._clientlog("Rescheduling DIRAC jobs: %s" % list(reschedule_jobs))
             self.logger.info("Rescheduling DIRAC jobs: %s", list(reschedule_jobs))
-            with dirac_api_client() as dirac:
-                try:
-                    result = dirac.rescheduleJob(reschedule_jobs)
-                except Exception as err:
-                    self._clientlog("Error calling DIRAC to reschedule jobs: %s" % err)
-                    self.logger.exception("Error calling DIRAC to reschedule jobs: %s", err)
+            try:
+                with call_context(request_id=self.request_id, parametricjob_id=self.id):
+                    result = bulk_reschedule(reschedule_jobs)
+            except Exception as err:
+                self._clientlog("Error calling DIRAC to reschedule jobs: %s" % err)
+                self.logger.exception("Error calling DIRAC to reschedule jobs: %s", err)
+            else:
+                if not result['OK']:
+                    self._clientlog("DIRAC failed to reschedule jobs: %s" % result['Message'])
+                    self.logger.error("DIRAC failed to reschedule jobs: %s", result['Message'])
                 else:
-                    if not result['OK']:
-                        self._clientlog("DIRAC failed to reschedule jobs: %s" % result['Message'])
-                        self.logger.error("DIRAC failed to reschedule jobs: %s", result['Message'])
-                    else:
-                        rescheduled_jobs.update(result['Value'])
-                        self._clientlog("Rescheduled jobs: %s" % list(rescheduled_jobs))
-                        self.logger.info("Rescheduled jobs: %s", list(rescheduled_jobs))
-                        skipped_jobs = reschedule_jobs.difference(rescheduled_jobs)
-                        if skipped_jobs:
-                            self._clientlog("Failed to reschedule jobs: %s" % list(skipped_jobs))
-                            self.logger.warning("Failed to reschedule jobs: %s", list(skipped_jobs))
-                        monitor_jobs.update(rescheduled_jobs)
+                    rescheduled_jobs.update(result['Value'])
+                    self._clientlog("Rescheduled jobs: %s" % list(rescheduled_jobs))
+                    self.logger.info("Rescheduled jobs: %s", list(rescheduled_jobs))
+                    skipped_jobs = reschedule_jobs.difference(rescheduled_jobs)
+                    if skipped_jobs:
+                        self._clientlog("Failed to reschedule jobs: %s" % list(skipped_jobs))
+                        self.logger.warning("Failed to reschedule jobs: %s", list(skipped_jobs))
+                    monitor_jobs.update(rescheduled_jobs)
 
         # Update status
         monitored_jobs = {}
-        self.logger.debug("Monitoring DIRAC jobs: %s", list(monitor_jobs))
-        if monitor_jobs:
+        poll_jobs = monitor_jobs
+        if dirac_statuses is not None:
+            # Rescheduled jobs must still be polled as their gathered status is now stale.
+            poll_jobs = rescheduled_jobs
+            monitored_jobs = {job_id: dirac_statuses[job_id]
+                              for job_id in monitor_jobs.difference(rescheduled_jobs)
+                              if job_id in dirac_statuses}
+        self.logger.debug("Monitoring DIRAC jobs: %s", list(poll_jobs))
+        if poll_jobs:
             try:
-                with dirac_api_client() as dirac:
-                    dirac_answer = deepcopy(dirac.getJobStatus(monitor_jobs))
+                with call_context(request_id=self.request_id, parametricjob_id=self.id):
+                    dirac_answer = bulk_status(poll_jobs)
             except Exception as err:
                 self._clientlog("Error calling DIRAC to monitor jobs: %s" % err)
                 self.logger.exception("Error calling DIRAC to monitor jobs: %s", err)
@@ -290,35 +725,34 @@ class ParametricJobs(SQLTableBase):
                                       self.request_id, self.id, dirac_answer['Message'])
                     self.reschedule = False
                 else:
-                    monitored_jobs = dirac_answer['Value']
-                    skipped_jobs = monitor_jobs.difference(monitored_jobs)
+                    monitored_jobs.update(dirac_answer['Value'])
+                    skipped_jobs = poll_jobs.difference(dirac_answer['Value'])
                     if skipped_jobs:
                         self._clientlog("Couldn't check the status of jobs: %s" % list(skipped_jobs))
                         self.logger.warning("Couldn't check the status of jobs: %s",
                                             list(skipped_jobs))
 
+        for job_id in rescheduled_jobs:
+            job_states[job_id][1] += 1
+        for job_id, job_status in viewitems(monitored_jobs):
+            if job_id in job_states:
+                job_states[job_id][0] = job_status
+
+        # Only the jobs whose state has changed are written back, by update.
+        self._dirac_job_changes = [(job_id,) + tuple(job_states[job_id])
+                                   for job_id, job_status, job_reschedules in dirac_job_states
+                                   if job_states[job_id] != [job_status, job_reschedules]]
+        self.logger.debug("%d DIRAC job(s) changed state for parametric job %d.%d",
+                          len(self._dirac_job_changes), self.request_id, self.id)
+
+        for job_id, job_status, _ in dirac_job_states:
+            if job_states[job_id][0] != job_status:
+                dirac_counts[job_status] -= 1
+                dirac_counts[job_states[job_id][0]] += 1
         statuses = Counter()
-        for job in self.dirac_jobs:
-            if job.id in rescheduled_jobs:
-                job.reschedules += 1
-            if job.id in monitored_jobs:
-                try:
-                    # pylint: disable=unsubscriptable-object
-                    job.status = DiracStatus[monitored_jobs[job.id]['Status'].upper()]
-                except KeyError:
-                    self._clientlog("Unknown DiracStatus: %s. Setting to UNKNOWN"
-                                    % monitored_jobs[job.id]['Status'].upper())
-                    self.logger.warning("Unknown DiracStatus: %s. Setting to UNKNOWN",
-                                        monitored_jobs[job.id]['Status'].upper())
-                    job.status = DiracStatus.UNKNOWN
-            if not isinstance(job.status, DiracStatus):
-                self._clientlog("Dirac job %r status %r is invalid type %r"
-                                % (str(job.id), job.status, type(job.status)))
-                self.logger.error("Dirac job %r status %r is invalid type %r",
-                                  str(job.id), job.status, type(job.status))
-                job.status = DiracStatus.RUNNING
-            statuses.update((job.status.local_status,))
-
+        for dirac_status, count in viewitems(dirac_counts):
+            if count > 0:
+                statuses[dirac_status.local_status] += count
         status = max(statuses)
         if status != self.status:
             self.status = status
@@ -330,8 +764,8 @@ class ParametricJobs(SQLTableBase):
         self.reschedule = False
 
     @classmethod
-    def get(cls, request_id=None, parametricjob_id=None, user_id=None):
-        """Get parametric jobs."""
+    def get(cls, request_id=None, parametricjob_id=None, user_id=None, session=None):
+        """Get parametric jobs, left attached if session is a unit of work session."""
         if request_id is not None:
             try:
                 request_id = native(int(request_id))
@@ -356,7 +790,7 @@ class ParametricJobs(SQLTableBase):
                                  "(or convertable to int)", user_id)
                 raise
 
-        with managed_session() as session:
+        with managed_session(read_only=True, session=session) as session:
             query = session.query(cls)
             if request_id is not None:
                 query = query.filter_by(request_id=request_id)
@@ -367,7 +801,7 @@ class ParametricJobs(SQLTableBase):
 
             if request_id is None or parametricjob_id is None:
                 parametricjobs = query.all()
-                session.expunge_all()
+                release(session)
                 parametricjobs.sort(key=attrgetter("id"))
                 return parametricjobs
 
@@ -380,7 +814,7 @@ class ParametricJobs(SQLTableBase):
                 cls.logger.error("Multiple results found for parametric job id: %d",
                                  parametricjob_id)
                 raise
-            session.expunge(parametricjob)
+            release(session, parametricjob)
             return parametricjob
 
 
@@ -397,13 +831,22 @@ def intercept_status_set(target, newvalue, oldvalue, _):
 
 @event.listens_for(SessionRegistry, "persistent_to_deleted")
 def intercept_persistent_to_deleted(session, object_):
-    """Intercept deletion of object and remove DIRAC jobs."""
-    if isinstance(object_, DiracJobs):
-        DiracJobs.logger.debug("Local DB Dirac job %d from parametric job %d.%d is being removed.",
-                               object_.id, object_.request_id, object_.parametricjob_id)
-
+    """Intercept deletion of object."""
     if isinstance(object_, ParametricJobs):
-        ParametricJobs.logger.info("Parametric job %d.%d is being removed, triggering bulk tidy up "
-                                   "of DIRAC job(s).",
+        ParametricJobs.logger.info("Parametric job %d.%d is being removed.",
                                    object_.request_id, object_.id)
-        object_._remove_dirac_jobs()
+
+
+@event.listens_for(DiracJobs, "before_delete")
+def forbid_dirac_job_delete(mapper, connection, target):
+    """
+    Forbid deleting DIRAC job rows through the ORM, e.g. by the delete cascade.
+
+    That would leave the jobs running in DIRAC with nothing tracking them.
+    Requests.remove kills/deletes the jobs in DIRAC first and then deletes the
+    rows of those removed in bulk.
+    """
+    # pylint: disable=unused-argument
+    raise RuntimeError("DIRAC job %d of parametric job %d.%d can't be deleted from the local DB "
+                       "while it may still exist in DIRAC, remove its request instead"
+                       % (target.id, target.request_id, target.parametricjob_id))
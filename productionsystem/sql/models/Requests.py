@@ -10,17 +10,19 @@ from operator import attrgetter
 
 from future.utils import native
 import cherrypy
-from sqlalchemy import Column, Integer, TIMESTAMP, TEXT, ForeignKey, Enum, event, inspect
+from sqlalchemy import (Column, Integer, TIMESTAMP, TEXT, ForeignKey, Enum, Index, event,
+                        inspect)
 # from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import relationship, joinedload
+from sqlalchemy.orm import relationship, joinedload, deferred
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
-from productionsystem.utils import timestamp
+from productionsystem.config import getConfig
+from productionsystem.monitoring.diracrpc.metrics import call_context
 
 from ..enums import LocalStatus
-from ..registry import managed_session
+from ..registry import managed_session, release
 from ..SQLTableBase import SQLTableBase, SmartColumn
-from ..models import ParametricJobs
+from ..models import ParametricJobs, DiracJobs, LogEntries
 
 
 def subdict(dct, keys, **kwargs):
@@ -40,13 +42,20 @@ class Requests(SQLTableBase):
     __mapper_args__ = {'polymorphic_on': classtype,
                        'polymorphic_identity': 'requests',
                        'with_polymorphic': '*'}
+    # Monitoring selects requests by status, the API a non-admin user's requests.
+    __table_args__ = (Index('ix_requests_status', 'status'),
+                      Index('ix_requests_requester_id_status', 'requester_id', 'status'))
     id = Column(Integer, primary_key=True)  # pylint: disable=invalid-name
     description = SmartColumn(TEXT, nullable=True, allowed=True)
     requester_id = SmartColumn(Integer, ForeignKey('users.id'), nullable=False, required=True)
     request_date = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
     status = Column(Enum(LocalStatus), nullable=False, default=LocalStatus.REQUESTED)
     timestamp = Column(TIMESTAMP, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
-    log = Column(TEXT, nullable=False, default="")
+    # Superseded by LogEntries. Never loaded, only filled in on insert so that code older than
+    # LogEntries sharing the DB keeps working, until a later migration drops the column.
+    log = deferred(Column(TEXT, nullable=False, default=""))
+    # Failed attempts at removing the request's DIRAC jobs since it was marked for removal.
+    removal_attempts = Column(Integer, nullable=False, default=0, server_default='0')
     parametric_jobs = relationship("ParametricJobs", cascade="all, delete-orphan")
     requester = relationship("Users")
     logger = logging.getLogger(__name__).getChild(__qualname__)
@@ -76,40 +85,162 @@ class Requests(SQLTableBase):
                 raise
 
     def _clientlog(self, log):
-        self.log += "%s %s\n" % (timestamp(), log)
+        self.__dict__.setdefault('_log_entries', []).append(LogEntries.entry(log))
 
-    def add(self):
+    def pop_log_entries(self):
+        """
+        Pop the log entries recorded since this request was last written to the DB.
+
+        This includes those of its parametric jobs, if they are loaded.
+
+        Returns:
+            list: The new LogEntries rows
+        """
+        entries = self.__dict__.pop('_log_entries', [])
+        for entry in entries:
+            entry.update(request_id=self.id)
+        if 'parametric_jobs' not in inspect(self).unloaded:
+            for job in self.parametric_jobs:
+                entries.extend(job.pop_log_entries())
+        return entries
+
+    def add(self, session=None):
         """Add self to the DB."""
-        with managed_session() as session:
+        with managed_session(session=session) as session:
             session.add(self)
             session.flush()
+            LogEntries.bulk_add(session, self.pop_log_entries())
             session.refresh(self)
-            session.expunge(self)
+            release(session, self)
 
     def remove(self):
-        """Remove self from the DB."""
+        """
+        Remove self from the DB, killing and deleting the DIRAC jobs first.
+
+        No DB transaction is held open while the DIRAC jobs are removed. The
+        local rows of those removed are then dropped in bulk. If any could not
+        be removed the request is kept, along with the rows of those jobs, so
+        that their removal is retried the next time. After the number of
+        failed attempts set by the parametricjobs max_removal_attempts config
+        option the request is instead marked FAILED, with the DIRAC jobs still
+        to remove logged, and is no longer retried.
+
+        Returns:
+            bool: Whether the request was removed
+        """
         with managed_session() as session:
-            session.delete(self)
+            dirac_ids = [dirac_id for dirac_id, in session.query(DiracJobs.id)
+                         .filter_by(request_id=self.id)]
+        with call_context(request_id=self.id):
+            failed_ids = ParametricJobs.kill_delete_dirac_jobs(dirac_ids)
+        DiracJobs.delete_ids(set(dirac_ids).difference(failed_ids))
+        if failed_ids:
+            self._removal_failed(failed_ids)
+            return False
 
-    def update(self):
-        """Update the DB with current values."""
         with managed_session() as session:
-            session.merge(self)
+            # Delete the persistent instance rather than re-attaching self so that the delete
+            # cascade can load any relationships self doesn't have loaded.
+            session.delete(session.query(type(self)).filter_by(id=self.id).one())
+            LogEntries.delete(self.id, session=session)
+        self.logger.info("Request %d removed along with %d DIRAC job(s).", self.id, len(dirac_ids))
+        return True
+
+    def _removal_failed(self, failed_ids):
+        """Count a failed removal attempt, giving up on the removal after too many."""
+        max_attempts = getConfig("parametricjobs").get("max_removal_attempts", 10)
+        with managed_session() as session:
+            request = session.query(type(self)).filter_by(id=self.id).one()
+            request.removal_attempts += 1
+            self.removal_attempts = request.removal_attempts
+            if request.removal_attempts < max_attempts:
+                self.logger.warning("Failed to remove %d DIRAC job(s) of request %d (attempt "
+                                    "%d/%d), removal will be retried.", len(failed_ids), self.id,
+                                    request.removal_attempts, max_attempts)
+                return
+            request._clientlog("Giving up removing the request after %d attempts, failed to "
+                               "kill/delete DIRAC job(s): %s"
+                               % (request.removal_attempts,
+                                  ', '.join(str(dirac_id) for dirac_id in sorted(failed_ids))))
+            request.status = LocalStatus.FAILED
+            # Nor should its jobs be rescheduled.
+            session.query(ParametricJobs)\
+                   .filter_by(request_id=self.id)\
+                   .update({ParametricJobs.reschedule: False}, synchronize_session=False)
+            LogEntries.bulk_add(session, request.pop_log_entries())
+        self.status = LocalStatus.FAILED
+        self.logger.error("Giving up removing request %d after %d attempts, %d DIRAC job(s) "
+                          "could not be killed/deleted.", self.id, max_attempts, len(failed_ids))
+
+    def update(self, session=None):
+        """
+        Update the DB with current values.
+
+        The DIRAC job state changes recorded by the parametric jobs' monitor are
+        bulk written back in the same transaction. If self is already attached to
+        the session, e.g. within a unit of work, then the merge is a no-op and the
+        changes are flushed along with the rest of the session. New log entries
+        are appended in bulk.
+
+        Args:
+            session (Session): The session to update in, by default a new managed_session
+
+        Returns:
+            int: The number of DIRAC job rows updated
+        """
+        changes = []
+        if 'parametric_jobs' not in inspect(self).unloaded:
+            for job in self.parametric_jobs:
+                changes.extend(job.pop_dirac_job_changes())
+        entries = self.pop_log_entries()
+        with managed_session(session=session) as session:
+            merged = session.merge(self)
+            if merged is not self:
+                # Status transitions merged into the persistent copy are logged there.
+                entries.extend(merged.pop_log_entries())
+            LogEntries.bulk_add(session, entries)
+            return DiracJobs.bulk_update(session, changes)
+
+    def submit(self, resume=False, interrupted=False):
+        """
+        Submit Request.
 
-    def submit(self):
-        """Submit Request."""
+        Args:
+            resume (bool): Skip the parametric jobs that have already been submitted
+                           and record each parametric job in the DB as soon as it
+                           is submitted. This makes an interrupted submission resumable.
+            interrupted (bool): This resumes a submission that was interrupted (e.g. by a
+                                restart), so any DIRAC jobs it left over are removed
+                                before the parametric jobs are submitted again
+        """
         self._clientlog("Submitting request %s" % self.id)
         self.logger.info("Submitting request %s", self.id)
         try:
             for job in self.parametric_jobs:
-                job.submit()
+                if resume and not job.awaiting_submission:
+                    self.logger.info("Parametric job %d.%d already submitted, skipping.",
+                                     self.id, job.id)
+                    continue
+                job.submit(resume=interrupted)
+                if resume:
+                    job.update()
         except BaseException as err:
             self._clientlog("Unhandled exception while submitting request\n%s" % err)
             self.logger.exception("Unhandled exception while submitting request %s", self.id)
             self.status = LocalStatus.FAILED
 
-    def monitor(self):
-        """Update request status."""
+    def monitor(self, dirac_statuses=None, dirac_jobs=None):
+        """
+        Update request status.
+
+        Args:
+            dirac_statuses (dict): The DiracStatus of jobs already gathered for
+                                   this cycle, keyed by job id. This is passed on to
+                                   the parametric jobs.
+            dirac_jobs (dict): The ParametricJobs.dirac_job_rollups already gathered
+                               for this cycle, gathered here for all the parametric
+                               jobs at once if not given
+        """
         self.logger.info("Monitoring request %s", self.id)
         if not self.parametric_jobs:
             self._clientlog("No parametric jobs present to monitor, changing status to Unknown")
@@ -118,10 +249,12 @@ class Requests(SQLTableBase):
             self.status = LocalStatus.UNKNOWN
             return
 
+        if dirac_jobs is None:
+            dirac_jobs = ParametricJobs.dirac_job_rollups(self.parametric_jobs)
         status = LocalStatus.UNKNOWN
         for job in self.parametric_jobs:
             try:
-                job.monitor()
+                job.monitor(dirac_statuses, dirac_jobs.get((self.id, job.id)))
             # get rid of this if parametricjob catches everything. Only when sure as it's complex
             except BaseException as err:
                 self._clientlog("Unhandled exception monitoring ParametricJob %s\n%s" % (job.id, err))
@@ -134,7 +267,15 @@ class Requests(SQLTableBase):
 
     @classmethod
     def delete(cls, request_id):
-        """Delete a requests from the DB."""
+        """
+        Delete a request from the DB, killing and deleting its DIRAC jobs first.
+
+        See remove. Usually requests are instead marked REMOVING and left to
+        the monitoring daemon to remove.
+
+        Returns:
+            bool: Whether the request was removed
+        """
         try:
             request_id = native(int(request_id))
         except ValueError:
@@ -142,22 +283,22 @@ class Requests(SQLTableBase):
                              "(or convertable to int)", request_id)
             raise
 
-        with managed_session() as session:
-            try:
-                request = session.query(cls).filter_by(id=request_id).one()
-            except NoResultFound:
-                cls.logger.warning("No result found for request id: %d", request_id)
-                raise
-            except MultipleResultsFound:
-                cls.logger.error("Multiple results found for request id: %d", request_id)
-                raise
-            session.delete(request)
+        request = cls.get(request_id=request_id)
+        if request.remove():
             cls.logger.info("Request %d deleted.", request_id)
+            return True
+        return False
 
     @classmethod
-    def get(cls, request_id=None, user_id=None,
-            load_user=False, load_parametricjobs=False, status=None):
-        """Get requests."""
+    def get(cls, request_id=None, user_id=None, load_user=False,
+            load_parametricjobs=False, load_diracjobs=False, status=None, session=None):
+        """
+        Get requests.
+
+        Note that load_diracjobs (which implies load_parametricjobs) loads every
+        DIRAC job of every request returned so should be used sparingly. The
+        requests are left attached if session is a unit of work session.
+        """
         if request_id is not None:
             try:
                 if isinstance(request_id, (list, tuple)):
@@ -182,13 +323,15 @@ class Requests(SQLTableBase):
                 cls.logger.error("Status: %r should be of type list/tuple", status)
                 raise TypeError
 
-        with managed_session() as session:
+        with managed_session(read_only=True, session=session) as session:
             query = session.query(cls)
             if load_user:
                 query = query.options(joinedload(cls.requester, innerjoin=True))
-            if load_parametricjobs:
+            if load_diracjobs:
                 query = query.options(joinedload(cls.parametric_jobs)
                                       .joinedload(ParametricJobs.dirac_jobs))
+            elif load_parametricjobs:
+                query = query.options(joinedload(cls.parametric_jobs))
             if user_id is not None:
                 query = query.filter_by(requester_id=user_id)
             if status is not None:
@@ -196,13 +339,13 @@ class Requests(SQLTableBase):
 
             if request_id is None:
                 requests = query.all()
-                session.expunge_all()
+                release(session)
                 requests.sort(key=attrgetter('id'))
                 return requests
 
             if isinstance(request_id, (list, tuple)):
                 requests = query.filter(cls.id.in_(request_id)).all()
-                session.expunge_all()
+                release(session)
                 requests.sort(key=attrgetter('id'))
                 return requests
 
@@ -216,21 +359,28 @@ class Requests(SQLTableBase):
                 raise
             # Need the all if loading the user db object as well.
             # If not then doesn't hurt as only one object this session
-            session.expunge_all()
+            release(session)
             return request
 
     @classmethod
-    def get_reschedules(cls):
-        """Get Requests with ParametricJobs to reschedule."""
-        with managed_session() as session:
-            requests = session.query(cls)\
-                              .options(joinedload(cls.parametric_jobs)
-                                       .joinedload(ParametricJobs.dirac_jobs))\
-                              .filter_by(status=LocalStatus.FAILED)\
-                              .join(cls.parametric_jobs)\
-                              .filter_by(reschedule=True)\
-                              .all()
-            session.expunge_all()
+    def get_reschedules(cls, request_id=None, session=None):
+        """
+        Get Requests with ParametricJobs to reschedule.
+
+        Args:
+            request_id (list): Only consider the requests with these ids
+            session (Session): The session to query in, by default a new managed_session
+        """
+        with managed_session(session=session) as session:
+            query = session.query(cls)\
+                           .options(joinedload(cls.parametric_jobs))\
+                           .filter_by(status=LocalStatus.FAILED)
+            if request_id is not None:
+                query = query.filter(cls.id.in_(request_id))
+            requests = query.join(cls.parametric_jobs)\
+                            .filter_by(reschedule=True)\
+                            .all()
+            release(session)
             return requests
 
 
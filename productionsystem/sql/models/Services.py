@@ -11,7 +11,7 @@ from future.utils import native, native_str
 import cherrypy
 from sqlalchemy import Column, Integer, String, TIMESTAMP, Enum
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from ..registry import managed_session
+from ..registry import managed_session, release
 from ..enums import ServiceStatus
 from ..SQLTableBase import SQLTableBase
 
@@ -28,24 +28,24 @@ class Services(SQLTableBase):
     timestamp = Column(TIMESTAMP, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     logger = logging.getLogger(__name__).getChild(__qualname__)
 
-    def add(self):
+    def add(self, session=None):
         """Add self to the DB."""
-        with managed_session() as session:
+        with managed_session(session=session) as session:
             session.add(self)
             session.flush()
             session.refresh(self)
-            session.expunge(self)
+            release(session, self)
 
-    def update(self):
+    def update(self, session=None):
         """Update the DB with current values."""
-        with managed_session() as session:
+        with managed_session(session=session) as session:
             # Onupdate doesn't trigger if setting status field to same as current value as it's
             # no-op in some DBs.
             self.timestamp = datetime.utcnow()
             session.merge(self)
 
     @classmethod
-    def get_services(cls, service_id=None, service_name=None):
+    def get_services(cls, service_id=None, service_name=None, session=None):
         """
         Get service from database.
 
@@ -54,6 +54,8 @@ class Services(SQLTableBase):
         Args:
             service_id (int): Service id to extract
             service_name (string): Service name to extract
+            session (Session): The session to query in, by default a new managed_session.
+                               The services are left attached to a unit of work session.
 
         Returns:
             list/Services: The services/service pulled from the database
@@ -72,7 +74,7 @@ class Services(SQLTableBase):
                                  "(or convertable to int)", service_id)
                 raise
 
-        with managed_session() as session:
+        with managed_session(read_only=True, session=session) as session:
             query = session.query(cls)
             query_id = []
             if service_id is not None:
@@ -84,7 +86,7 @@ class Services(SQLTableBase):
 
             if service_id is None and service_name is None:
                 services = query.all()
-                session.expunge_all()
+                release(session)
                 return services
 
             try:
@@ -95,7 +97,7 @@ class Services(SQLTableBase):
             except MultipleResultsFound:
                 cls.logger.error("Multiple results found for service: (%s)", ', '.join(query_id))
                 raise
-            session.expunge(service)
+            release(session, service)
             return service
 
 
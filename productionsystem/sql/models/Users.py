@@ -10,7 +10,7 @@ import cherrypy
 from distutils.util import strtobool  # pylint: disable=import-error, no-name-in-module
 from sqlalchemy import Column, Integer, TEXT, Boolean
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from ..registry import managed_session
+from ..registry import managed_session, release
 from ..SQLTableBase import SQLTableBase
 
 
@@ -55,13 +55,13 @@ class Users(SQLTableBase):
         """Equality check."""
         return (self.dn, self.ca) == (other.dn, other.ca)
 
-    def update(self):
+    def update(self, session=None):
         """Update the DB record from this Users object."""
-        with managed_session() as session:
+        with managed_session(session=session) as session:
             session.merge(self)
 
     @classmethod
-    def get_users(cls, user_id=None):
+    def get_users(cls, user_id=None, session=None):
         """
         Get users from database.
 
@@ -69,6 +69,8 @@ class Users(SQLTableBase):
 
         Args:
             user_id (int): User id to extract
+            session (Session): The session to query in, by default a new managed_session.
+                               The users are left attached to a unit of work session.
 
         Returns:
             list/Users: The users/user pulled from the database
@@ -82,11 +84,11 @@ class Users(SQLTableBase):
                                  "(or convertable to int)", user_id)
                 raise
 
-        with managed_session() as session:
+        with managed_session(read_only=True, session=session) as session:
             query = session.query(cls)
             if user_id is None:
                 users = query.all()
-                session.expunge_all()
+                release(session)
                 return users
 
             try:
@@ -97,7 +99,7 @@ class Users(SQLTableBase):
             except MultipleResultsFound:
                 cls.logger.error("Multiple results found for user id: %d", user_id)
                 raise
-            session.expunge(user)
+            release(session, user)
             return user
 
 
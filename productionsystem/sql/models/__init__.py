@@ -4,6 +4,9 @@ import pkg_resources
 from productionsystem.config import ConfigSystem
 from .Users import Users
 from .Services import Services
+from .MonitoringEvents import MonitoringEvents
+from .MonitoringSchedule import MonitoringSchedule
+from .LogEntries import LogEntries
 # from DiracJobs import DiracJobs
 
 # pylint: disable=no-member
@@ -9,11 +9,22 @@ import pkg_resources
 import cherrypy
 from daemonize import Daemonize
 from productionsystem.sql.JSONTableEncoder import json_cherrypy_handler
-from productionsystem.sql.registry import SessionRegistry
+from productionsystem.sql.registry import POOL_METRICS, SessionRegistry, set_replica_reads
+from productionsystem.metrics import MetricsServer
 from .services import (HTMLPageServer, CVMFSDirectoryListing, GitDirectoryListing,
                        GitTagListing, GitSchema, RESTfulAPI)
 
 
+def _replica_reads():
+    """Route the read only DB sessions of GET requests to the read replica, if there is one."""
+    if cherrypy.request.method in ('GET', 'HEAD'):
+        previous = set_replica_reads(True)
+        cherrypy.request.hooks.attach('on_end_request', set_replica_reads, enabled=previous)
+
+
+cherrypy.tools.replica_reads = cherrypy.Tool('on_start_resource', _replica_reads)
+
+
 class WebApp(Daemonize):
     """LZ Production Web Server Daemon."""
 
@@ -27,8 +38,14 @@ class WebApp(Daemonize):
                  git_api_base_url="https://api.github.com/repos",
                  extra_jinja2_loader=None,
                  mock_mode=False,
+                 metrics_port=0,
                  **kwargs):
-        """Initialise."""
+        """
+        Initialise.
+
+        If metrics_port is given then the DB connection pool metrics are
+        served over HTTP on that port.
+        """
         super(WebApp, self).__init__(action=self.main, **kwargs)
         self._dburl = dburl
         self._socket_host = socket_host
@@ -36,6 +53,7 @@ class WebApp(Daemonize):
         self._thread_pool = thread_pool
         self._extra_jinja2_loader = extra_jinja2_loader
         self._mock_mode = mock_mode
+        self._metrics_port = metrics_port
         self._git_token = git_token
         self._git_api_base_url = git_api_base_url
         self._git_schema = git_schema
@@ -61,6 +79,7 @@ class WebApp(Daemonize):
                 native_str('tools.expires.on'): True,
                 native_str('tools.expires.secs'): 3,  # expire in an hour, 3 secs for debug
                 native_str('tools.encode.text_only'): False,
+                native_str('tools.replica_reads.on'): True,
                 # py2/3 compatibility layer issue, py2 breaks with unicode path dummy.html
                 native_str('checker.check_static_paths'): None
             }
@@ -97,7 +116,7 @@ class WebApp(Daemonize):
 
     def main(self):
         """Daemon main."""
-        SessionRegistry.setup(self._dburl)  # pylint: disable=no-member
+        SessionRegistry.setup(self._dburl, profile='webapp')  # pylint: disable=no-member
 
         # Setup testing entry for mock mode.
         ####################################
@@ -110,5 +129,14 @@ class WebApp(Daemonize):
 
         cherrypy.config.update(self._global_config())  # global vars need updating global config
         self._mount_points()
-        cherrypy.engine.start()
-        cherrypy.engine.block()
+        metrics_server = None
+        if self._metrics_port:
+            metrics_server = MetricsServer((self._socket_host, self._metrics_port),
+                                           [POOL_METRICS])
+            metrics_server.start()
+        try:
+            cherrypy.engine.start()
+            cherrypy.engine.block()
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
@@ -6,6 +6,7 @@ from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-impor
 from future.utils import native_str
 
 import logging
+import warnings
 # from collections import defaultdict
 from datetime import datetime
 import jinja2
@@ -50,7 +51,14 @@ def service_badge_url(service, service_name):
 
 @jinja2_filter
 def log_splitter(log):
-    """Split up the log string by line."""
+    """
+    Split up the log string by line.
+
+    Deprecated: the logs are now read page by page from the logentries API,
+    this is only kept for extension templates still using the TEXT logs.
+    """
+    warnings.warn("The log_splitter template filter is deprecated, read the log entries "
+                  "from the logentries API instead", DeprecationWarning, stacklevel=2)
     if log is None:
         return []
     return log.splitlines()
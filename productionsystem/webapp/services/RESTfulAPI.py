@@ -11,9 +11,26 @@ import cherrypy
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from productionsystem.apache_utils import check_credentials, admin_only
-from productionsystem.sql.models import Services, Users, Requests, ParametricJobs, DiracJobs
+from productionsystem.sql.models import (Services, Users, Requests, ParametricJobs, DiracJobs,
+                                         MonitoringEvents, LogEntries)
 from productionsystem.sql.enums import LocalStatus
 
+MAX_LOG_PAGE_SIZE = 1000
+
+
+def wake_monitoring(request_id, reason):
+    """
+    Wake the monitoring daemon up to act on a request straight away.
+
+    This is best effort, if it fails the request is still picked up by the
+    daemon's next full monitoring cycle.
+    """
+    try:
+        MonitoringEvents.notify(request_id, reason)
+    except SQLAlchemyError:
+        logging.getLogger(__name__).warning("Failed to wake up the monitoring daemon for "
+                                            "request %d", request_id)
+
 
 @cherrypy.expose
 @cherrypy.popargs('service_id')
@@ -231,6 +248,56 @@ class ParametricJobsAPI(object):
                                            % (request_id, parametricjob_id)):
                 parametricjob.update()
                 request.update()
+            wake_monitoring(request_id, "reschedule")
+
+
+@cherrypy.expose
+class LogEntriesAPI(object):
+    """Log Entries RESTful API."""
+
+    mount_point = 'logentries'
+    logger = logging.getLogger(__name__).getChild("LogEntriesAPI")
+
+    @classmethod
+    @cherrypy.tools.accept(media='application/json')
+    @cherrypy.tools.json_out()
+    @check_credentials
+    def GET(cls, request_id, parametricjob_id=None,  # pylint: disable=invalid-name
+            offset=0, limit=100):
+        """
+        REST Get method.
+
+        Returns a page of the log of a request, or of one of its parametric jobs, oldest first.
+        """
+        cls.logger.debug("In GET: reqid = %s, parametricjob_id = %s, offset = %s, limit = %s",
+                         request_id, parametricjob_id, offset, limit)
+        with cherrypy.HTTPError.handle(ValueError, 400, 'Bad request_id: %r' % request_id):
+            request_id = int(request_id)
+
+        if parametricjob_id is not None:
+            with cherrypy.HTTPError.handle(ValueError, 400,
+                                           'Bad parametricjob_id: %r' % parametricjob_id):
+                parametricjob_id = int(parametricjob_id)
+
+        with cherrypy.HTTPError.handle(ValueError, 400, 'Bad offset/limit: %r/%r'
+                                                        % (offset, limit)):
+            offset = int(offset)
+            limit = int(limit)
+            if offset < 0 or not 0 < limit <= MAX_LOG_PAGE_SIZE:
+                raise ValueError
+
+        requester = cherrypy.request.verified_user
+        user_id = requester.id
+        if requester.admin:
+            user_id = None
+
+        if user_id is not None:
+            with cherrypy.HTTPError.handle(NoResultFound, 404,
+                                           "No request with id %s" % request_id):
+                Requests.get(request_id=request_id, user_id=user_id)
+
+        return LogEntries.get(request_id, parametricjob_id=parametricjob_id,
+                              offset=offset, limit=limit)
 
 
 @cherrypy.expose
@@ -241,6 +308,7 @@ class RequestsAPI(object):
     mount_point = 'requests'
     logger = logging.getLogger(__name__).getChild("RequestsAPI")
     parametricjobs = ParametricJobsAPI()
+    logentries = LogEntriesAPI()
 
     @classmethod
     @cherrypy.tools.accept(media='application/json')
@@ -283,10 +351,12 @@ class RequestsAPI(object):
             raise cherrypy.HTTPError(400, "Request %s is already marked for deletion" % request_id)
 
         request.status = LocalStatus.REMOVING
+        request.removal_attempts = 0
         with cherrypy.HTTPError.handle(SQLAlchemyError, 500,
                                        "Error updating request with id %d" % request_id):
             request.update()
         cls.logger.info("Request %d changed to status REMOVING", request_id)
+        wake_monitoring(request_id, "delete")
 
     @classmethod
     @cherrypy.tools.json_in()
@@ -343,6 +413,8 @@ class RequestsAPI(object):
                                        "Error updating request with id %d" % request_id):
             request.update()
             cls.logger.info("Request %d changed to status %s", request_id, status.name)
+        if status == LocalStatus.APPROVED:
+            wake_monitoring(request_id, "approve")
 
 
 def mount(root):
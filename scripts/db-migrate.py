@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# pylint: disable=invalid-name
+"""Script to show or upgrade the schema version of the requests DB."""
+# Py2/3 compatibility layer
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *  # pylint: disable=wildcard-import, unused-wildcard-import, redefined-builtin
+
+import os
+import logging
+import argparse
+import importlib
+from pprint import pformat
+import pkg_resources
+
+from productionsystem.utils import expand_path
+
+if __name__ == '__main__':
+    current_dir = os.getcwd()
+    app_name = os.path.splitext(os.path.basename(__file__))[0]
+
+    parser = argparse.ArgumentParser(description='Show or upgrade the schema version of the '
+                                                 'requests DB.')
+    parser.add_argument('command', choices=('status', 'upgrade'),
+                        help="Show the schema version and pending migrations or apply them.")
+    parser.add_argument('--target', type=int,
+                        help="The version to upgrade to [default: the latest]")
+    parser.add_argument('-v', '--verbose', action='count',
+                        help="Increase the logged verbosite, can be used twice")
+    parser.add_argument('-d', '--dburl',
+                        default="sqlite:///" + os.path.join(current_dir, 'requests.db'),
+                        help="URL for the requests DB. Note can use the prefix 'mysql+pymysql://' "
+                             "if you have a problem with MySQLdb.py [default: %(default)s]")
+    parser.add_argument('-c', '--config',
+                        default='~/.config/productionsystem/productionsystem.conf',
+                        help="The config file [default: %(default)s]")
+    args = parser.parse_args()
+    cli_args = vars(args).copy()
+
+    # Config Setup
+    ###########################################################################
+    config_path = expand_path(args.config)
+    if not os.path.exists(config_path):
+        config_path = None
+    config = importlib.import_module('productionsystem.config')
+    config_instance = config.ConfigSystem.setup(config_path)
+
+    # Logging setup
+    ###########################################################################
+    # setup the root logger
+    logging.basicConfig(level=max(logging.INFO - 10 * (args.verbose or 0), logging.DEBUG),
+                        format="[%(asctime)s] %(name)15s : %(levelname)8s : %(message)s")
+
+    # setup the main app logger
+    logger = logging.getLogger(app_name)
+    logger.debug("Script called with args:\n%s", pformat(cli_args))
+    if config_path is None:
+        logger.warning("Config file '%s' does not exist", cli_args['config'])
+    logger.debug("Active config looks like:\n%s", pformat(config_instance.config))
+
+    # Entry Point Setup
+    ###########################################################################
+    entry_point_map = pkg_resources.get_entry_map('productionsystem')
+    config_instance.entry_point_map = entry_point_map
+    logger.debug("Starting with entry point map: %s", entry_point_map)
+
+    # Do work
+    ###########################################################################
+    importlib.import_module('productionsystem.sql.models')  # register the tables
+    migrations = importlib.import_module('productionsystem.sql.migrations')
+    registry = importlib.import_module('productionsystem.sql.registry')
+
+    engine = registry.make_engine(args.dburl, pool_size=1, max_overflow=0)
+    try:
+        if args.command == 'upgrade':
+            applied = migrations.upgrade(engine, target=args.target)
+            logger.info("Applied %d migration(s).", len(applied))
+        with engine.connect() as connection:
+            logger.info("DB schema version: %d (latest %d)",
+                        migrations.current_version(connection), migrations.head())
+            for migration in migrations.pending(connection, target=args.target):
+                logger.info("Pending migration %d: %s", migration.version, migration.description)
+    finally:
+        engine.dispose()
+    logging.shutdown()
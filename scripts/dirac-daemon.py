@@ -61,8 +61,47 @@ def stop(args):
     logging.shutdown()
 
 
+def daemon_kwargs(args):
+    """Return the daemon arguments shared by the DIRAC and stand-in servers."""
+    return dict(workers=args.workers,
+                queue_depth=args.queue_depth,
+                queue_timeout=args.queue_timeout,
+                max_worker_calls=args.max_worker_calls,
+                max_worker_memory_growth=args.max_worker_memory_growth,
+                worker_start_method=args.worker_start_method,
+                status_cache_ttl=args.status_cache_ttl,
+                status_cache_size=args.status_cache_size,
+                listing_cache_ttl=args.listing_cache_ttl,
+                listing_cache_size=args.listing_cache_size,
+                max_jdl_parameters=args.max_jdl_parameters,
+                metrics_port=args.metrics_port,
+                slow_call_threshold=args.slow_call_threshold,
+                app=app_name,
+                pid=args.pid_file,
+                logger=logger,
+                keep_fds=[fhandler.stream.fileno()],
+                foreground=args.debug_mode)
+
+
 def start(args):
     """Start the dirac daemon."""
+    if args.fake_mode:
+        FakeDiracDaemon = importlib.import_module('productionsystem.monitoring.diracrpc.'
+                                                  'FakeDiracRPCServer').FakeDiracDaemon
+        FakeDiracDaemon(address=(args.socket_host, args.socket_port),
+                        fake_latency=args.fake_latency,
+                        fake_job_latency=args.fake_job_latency,
+                        fake_failure_rate=args.fake_failure_rate,
+                        fake_job_failure_rate=args.fake_job_failure_rate,
+                        fake_schedule=args.fake_schedule,
+                        fake_jobs=args.fake_jobs,
+                        fake_seed=args.fake_seed,
+                        fake_catalogue_depth=args.fake_catalogue_depth,
+                        fake_catalogue_fanout=args.fake_catalogue_fanout,
+                        fake_catalogue_files=args.fake_catalogue_files,
+                        **daemon_kwargs(args)).start()
+        return
+
     if args.mock_mode:
         mock.patch.dict(sys.modules, {"DIRAC": mock.MagicMock(),
                                       "DIRAC.Core": mock.MagicMock(),
@@ -88,6 +127,8 @@ def start(args):
         sys.modules['DIRAC.Interfaces.API.Job'].Job = dirac_job_mock
         sys.modules['DIRAC.Interfaces.API.Dirac'].Dirac = dirac_class_mock
         sys.modules['DIRAC.Core.DISET.RPCClient'].RPCClient = dirac_rpc_mock
+        # The mocks are only patched into this process, gateway workers must inherit them
+        args.worker_start_method = 'fork'
 
     # DIRAC will parse our command line args unless we remove them
     sys.argv = sys.argv[:1]
@@ -103,12 +144,7 @@ def start(args):
 
     # Daemon setup
     ###########################################################################
-    DiracDaemon(address=(args.socket_host, args.socket_port),
-                app=app_name,
-                pid=args.pid_file,
-                logger=logger,
-                keep_fds=[fhandler.stream.fileno()],
-                foreground=args.debug_mode).start()
+    DiracDaemon(address=(args.socket_host, args.socket_port), **daemon_kwargs(args)).start()
 
 
 if __name__ == '__main__':
@@ -128,6 +164,47 @@ if __name__ == '__main__':
                               help="The dirac environment API host [default: %(default)s]")
     start_parser.add_argument('--socket-port', default=18861, type=int,
                               help="The dirac environment API port [default: %(default)s]")
+    start_parser.add_argument('--workers', default=0, type=int,
+                              help="Run a gateway in front of this many DIRAC worker processes "
+                                   "rather than serving from a single process "
+                                   "[default: %(default)s]")
+    start_parser.add_argument('--queue-depth', default=100, type=int,
+                              help="The number of calls that may wait for a free worker before "
+                                   "new ones are rejected [default: %(default)s]")
+    start_parser.add_argument('--queue-timeout', default=60, type=float,
+                              help="How long a call may wait for a free worker in seconds "
+                                   "[default: %(default)s]")
+    start_parser.add_argument('--max-worker-calls', default=1000, type=int,
+                              help="Recycle a worker after this many calls, 0 for never "
+                                   "[default: %(default)s]")
+    start_parser.add_argument('--max-worker-memory-growth', default=500, type=float,
+                              help="Recycle a worker once its memory has grown by this many MB, "
+                                   "0 for never [default: %(default)s]")
+    start_parser.add_argument('--worker-start-method', default='forkserver',
+                              choices=['forkserver', 'spawn', 'fork'],
+                              help="How gateway worker processes are started, Python 2 always "
+                                   "forks [default: %(default)s]")
+    start_parser.add_argument('--status-cache-ttl', default=10, type=float,
+                              help="How long DIRAC job statuses are cached for in seconds, "
+                                   "0 to disable [default: %(default)s]")
+    start_parser.add_argument('--status-cache-size', default=100000, type=int,
+                              help="The maximum number of DIRAC job statuses to cache "
+                                   "[default: %(default)s]")
+    start_parser.add_argument('--listing-cache-ttl', default=300, type=float,
+                              help="How long file catalogue directory listings are cached for "
+                                   "in seconds, 0 to disable [default: %(default)s]")
+    start_parser.add_argument('--listing-cache-size', default=10000, type=int,
+                              help="The maximum number of directory listings to cache "
+                                   "[default: %(default)s]")
+    start_parser.add_argument('--max-jdl-parameters', default=1000, type=int,
+                              help="Submit parametric jobs with more parameters than this in "
+                                   "parts, 0 for no limit [default: %(default)s]")
+    start_parser.add_argument('--metrics-port', default=0, type=int,
+                              help="The port to serve the DIRAC RPC call metrics on, "
+                                   "0 to disable [default: %(default)s]")
+    start_parser.add_argument('--slow-call-threshold', default=10, type=float,
+                              help="Log DIRAC calls slower than this many seconds, "
+                                   "0 to disable [default: %(default)s]")
     start_parser.add_argument('-p', '--pid-file',
                               default=os.path.join(current_dir, "%s.pid" % app_name),
                               help="The pid file used by the daemon [default: %(default)s]")
@@ -147,6 +224,36 @@ if __name__ == '__main__':
     stop_parser.add_argument('-c', '--config',
                              default='~/.config/productionsystem/productionsystem.conf',
                              help="The config file [default: %(default)s]")
+    start_parser.add_argument('--fake-mode', action='store_true', default=False,
+                              help="Serve an in-memory DIRAC stand-in rather than DIRAC, "
+                                   "for load and latency testing")
+    fake = start_parser.add_argument_group("DIRAC stand-in (--fake-mode)")
+    fake.add_argument('--fake-latency', default=0., type=float,
+                      help="How long each DIRAC call takes in seconds [default: %(default)s]")
+    fake.add_argument('--fake-job-latency', default=0., type=float,
+                      help="How much longer each DIRAC call takes per job in seconds "
+                           "[default: %(default)s]")
+    fake.add_argument('--fake-failure-rate', default=0., type=float,
+                      help="The fraction of DIRAC calls that fail [default: %(default)s]")
+    fake.add_argument('--fake-job-failure-rate', default=0., type=float,
+                      help="The fraction of jobs that end up Failed [default: %(default)s]")
+    fake.add_argument('--fake-schedule', default='Received:1,Waiting:5,Running:30,Done',
+                      help="The statuses jobs go through, as status:seconds pairs followed "
+                           "by the final status [default: %(default)s]")
+    fake.add_argument('--fake-jobs', default=0, type=int,
+                      help="The number of existing jobs to start with, with ids from 1 "
+                           "[default: %(default)s]")
+    fake.add_argument('--fake-seed', default=None, type=int,
+                      help="Seed making the failed calls and jobs reproducible")
+    fake.add_argument('--fake-catalogue-depth', default=0, type=int,
+                      help="How many levels of subdirectories the file catalogue has "
+                           "[default: %(default)s]")
+    fake.add_argument('--fake-catalogue-fanout', default=0, type=int,
+                      help="The number of subdirectories in each file catalogue directory "
+                           "[default: %(default)s]")
+    fake.add_argument('--fake-catalogue-files', default=0, type=int,
+                      help="The number of files in each file catalogue directory "
+                           "[default: %(default)s]")
     start_parser.add_argument('--debug-mode', action='store_true', default=False,
                               help="Run the daemon in a debug interactive monitoring mode. "
                                    "(debugging only)")
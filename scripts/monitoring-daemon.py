@@ -81,6 +81,20 @@ def start(args):
                      delay=args.frequency,
                      cert=(args.cert, args.key),
                      verify=args.verify,
+                     workers=args.workers,
+                     worker_type=args.worker_type,
+                     incremental=args.incremental,
+                     full_poll_interval=args.full_poll_interval,
+                     wakeup_interval=args.wakeup_interval,
+                     adaptive=args.adaptive,
+                     max_poll_interval=args.max_poll_interval,
+                     submit_workers=args.submit_workers,
+                     removal_workers=args.removal_workers,
+                     metrics_host=args.metrics_host,
+                     metrics_port=args.metrics_port,
+                     slow_call_threshold=args.slow_call_threshold,
+                     log_retention=args.log_retention,
+                     log_max_entries=args.log_max_entries,
                      app=args.app_name,
                      pid=args.pid_file,
                      logger=logger,
@@ -104,6 +118,49 @@ if __name__ == '__main__':
     start_parser.add_argument('-f', '--frequency', default=5, type=int,
                               help="The frequency that the daemon does it's main functionality "
                                    "(in mins) [default: %(default)s]")
+    start_parser.add_argument('-w', '--workers', default=1, type=int,
+                              help="The number of requests to monitor concurrently "
+                                   "[default: %(default)s]")
+    start_parser.add_argument('--worker-type', default='thread', choices=('thread', 'process'),
+                              help="The type of worker used when monitoring concurrently "
+                                   "[default: %(default)s]")
+    start_parser.add_argument('--incremental', action='store_true', default=False,
+                              help="Only ask DIRAC for the status of jobs that have changed "
+                                   "since the last poll")
+    start_parser.add_argument('--full-poll-interval', default=60, type=int,
+                              help="How often to check the status of every job when running "
+                                   "incrementally (in mins) [default: %(default)s]")
+    start_parser.add_argument('--wakeup-interval', default=5, type=float,
+                              help="How often to check for requests the web app wants monitored "
+                                   "straight away, 0 to disable (in secs) [default: %(default)s]")
+    start_parser.add_argument('--adaptive', action='store_true', default=False,
+                              help="Back off how often stable requests are monitored")
+    start_parser.add_argument('--max-poll-interval', default=60, type=int,
+                              help="The longest time between monitoring a stable request when "
+                                   "running adaptively (in mins) [default: %(default)s]")
+    start_parser.add_argument('--submit-workers', default=0, type=int,
+                              help="The number of requests to submit concurrently from a queue "
+                                   "separate to the monitoring, 0 to submit inline "
+                                   "[default: %(default)s]")
+    start_parser.add_argument('--removal-workers', default=0, type=int,
+                              help="The number of requests to remove concurrently in the "
+                                   "background, 0 to remove inline [default: %(default)s]")
+    start_parser.add_argument('--metrics-host', default='localhost',
+                              help="The host to serve the DIRAC RPC call and DB pool metrics on "
+                                   "[default: %(default)s]")
+    start_parser.add_argument('--metrics-port', default=0, type=int,
+                              help="The port to serve the DIRAC RPC call and DB pool metrics on, "
+                                   "0 to disable. The calls made by process workers are not "
+                                   "included [default: %(default)s]")
+    start_parser.add_argument('--slow-call-threshold', default=10, type=float,
+                              help="Log DIRAC RPC calls slower than this many seconds, "
+                                   "0 to disable [default: %(default)s]")
+    start_parser.add_argument('--log-retention', default=0, type=float,
+                              help="Remove request log entries older than this many days, "
+                                   "0 to keep them [default: %(default)s]")
+    start_parser.add_argument('--log-max-entries', default=0, type=int,
+                              help="Compact each request and parametric job log down to its "
+                                   "latest entries, 0 to keep them all [default: %(default)s]")
     start_parser.add_argument('-p', '--pid-file',
                               default=os.path.join(current_dir, "%s.pid" % app_name),
                               help="The pid file used by the daemon [default: %(default)s]")
@@ -97,6 +97,7 @@ def start(args):
            git_api_base_url=args.git_api_base_url,
            extra_jinja2_loader=extra_jinja2_loader,
            mock_mode=args.mock_mode,
+           metrics_port=args.metrics_port,
            app=args.app_name,
            pid=args.pid_file,
            logger=logger,
@@ -136,6 +137,9 @@ if __name__ == '__main__':
                               help="The host port to listen on [default: %(default)s]")
     start_parser.add_argument('--thread-pool', default=8, type=int,
                               help="The number of threads in the pool [default: %(default)s]")
+    start_parser.add_argument('--metrics-port', default=0, type=int,
+                              help="The port to serve the DB pool metrics on, "
+                                   "0 to disable [default: %(default)s]")
     start_parser.add_argument('--git-schema', default='GITHUB',
                               help="The git schema to use [default: %(default)s]")
     start_parser.add_argument('--git-api-base-url', default='https://api.github.com/repos',
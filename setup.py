@@ -51,6 +51,7 @@ setup(
              'scripts/monitoring-daemon.py',
              'scripts/dirac-daemon.py',
              'scripts/userdb-update.py',
+             'scripts/db-migrate.py',
              'scripts/service-status.sh',
              'scripts/stop-services.sh'],
     package_data={'productionsystem': ['webapp/static_resources/*', 'webapp/templates/*']},
@@ -0,0 +1,101 @@
+"""Test AsyncDiracRPCClient.py."""
+import asyncio
+import threading
+import time
+from unittest import TestCase
+import rpyc
+from rpyc.utils.server import ThreadedServer
+from productionsystem.monitoring.diracrpc import DiracRPCClient
+from productionsystem.monitoring.diracrpc.AsyncDiracRPCClient import (AsyncDiracClient,
+                                                                      run_bulk_status)
+from productionsystem.monitoring.diracrpc.encoding import encode_result, encode_statuses
+from productionsystem.sql.enums import DiracStatus
+
+
+class DummyService(rpyc.Service):
+    """Dummy DIRAC RPyC service, each call takes since (or 0.1) seconds."""
+
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def exposed_bulk_status(self, ids, since=None):  # pylint: disable=no-self-use
+        """Return encoded dummy statuses slowly, tracking the calls in flight."""
+        with DummyService.lock:
+            DummyService.in_flight += 1
+            DummyService.max_in_flight = max(DummyService.max_in_flight, DummyService.in_flight)
+        time.sleep(0.1 if since is None else float(since))
+        with DummyService.lock:
+            DummyService.in_flight -= 1
+        return encode_statuses({'OK': True, 'Value': {i: {'Status': 'Running'} for i in ids}})
+
+    def exposed_submit_jdl(self, jdl):  # pylint: disable=no-self-use
+        """Pretend to submit a JDL."""
+        return encode_result({'OK': True, 'Value': [len(jdl)]})
+
+
+class TestAsyncDiracClient(TestCase):
+    """Test case for the AsyncDiracClient class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Start a local RPC server."""
+        cls.server = ThreadedServer(DummyService, hostname="localhost", port=0,
+                                    protocol_config=DiracRPCClient.CONNECTION_CONFIG)
+        cls.thread = threading.Thread(target=cls.server.start)
+        cls.thread.daemon = True
+        cls.thread.start()
+        while not cls.server.active:
+            time.sleep(0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the local RPC server."""
+        cls.server.close()
+
+    def setUp(self):
+        """Reset the dummy service counters and set up an event loop."""
+        DummyService.max_in_flight = 0
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_concurrency(self):
+        """Test calls run concurrently but no more than max_in_flight at once."""
+        async def run():
+            async with AsyncDiracClient(port=self.server.port, max_connections=4,
+                                        max_in_flight=4) as client:
+                return await asyncio.gather(*(client.bulk_status([i]) for i in range(12)))
+
+        start = time.time()
+        results = self.loop.run_until_complete(run())
+        self.assertLess(time.time() - start, 1.)  # 12 serial calls would take 1.2s
+        self.assertEqual(DummyService.max_in_flight, 4)
+        self.assertEqual(results[3], {'OK': True, 'Value': {3: DiracStatus.RUNNING}})
+
+    def test_timeout(self):
+        """Test calls time out."""
+        async def run():
+            async with AsyncDiracClient(port=self.server.port, timeout=0.1) as client:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await client.bulk_status([1], since='1')
+                return await client.submit_jdl('[Executable = "run.sh";]', timeout=1)
+
+        self.assertEqual(self.loop.run_until_complete(run()), {'OK': True, 'Value': [24]})
+
+    def test_created_outside_loop(self):
+        """Test a client created outside of the event loop it is used in."""
+        client = AsyncDiracClient(port=self.server.port)
+
+        async def run():
+            async with client:
+                return await client.bulk_status([1])
+
+        self.assertEqual(self.loop.run_until_complete(run()),
+                         {'OK': True, 'Value': {1: DiracStatus.RUNNING}})
+
+    def test_run_bulk_status(self):
+        """Test querying many chunks from synchronous code."""
+        results = run_bulk_status([[1, 2], [3]], port=self.server.port)
+        self.assertEqual(results, [{'OK': True, 'Value': {1: DiracStatus.RUNNING,
+                                                          2: DiracStatus.RUNNING}},
+                                   {'OK': True, 'Value': {3: DiracStatus.RUNNING}}])
@@ -0,0 +1,105 @@
+"""Test gateway.py."""
+import os
+import threading
+import time
+from unittest import TestCase
+import rpyc
+from productionsystem.monitoring.diracrpc import DiracRPCClient
+from productionsystem.monitoring.diracrpc.encoding import encode_result, encode_statuses
+from productionsystem.monitoring.diracrpc.gateway import DiracGateway
+from productionsystem.sql.enums import DiracStatus
+
+
+class DummyDirac(object):
+    """Dummy DIRAC API class."""
+
+    def getJobStatus(self, ids):  # pylint: disable=invalid-name, no-self-use
+        """Return dummy statuses."""
+        return {'OK': True, 'Value': {i: {'Status': 'Done'} for i in ids}}
+
+
+class DummyService(rpyc.Service):
+    """Dummy DIRAC RPyC service."""
+
+    exposed_Dirac = DummyDirac
+    ballast = []
+
+    def exposed_bulk_status(self, ids, since=None):  # pylint: disable=no-self-use
+        """Return encoded dummy statuses, slowly if since is given."""
+        if since is not None:
+            time.sleep(float(since))
+        return encode_statuses(DummyDirac().getJobStatus(ids))
+
+    def exposed_bulk_reschedule(self, ids):  # pylint: disable=no-self-use
+        """Return the worker process id."""
+        return encode_result({'OK': True, 'Value': os.getpid()})
+
+    def exposed_bulk_kill_delete(self, ids):  # pylint: disable=no-self-use
+        """Grow the worker's memory by 50MB, returning the worker process id."""
+        self.ballast.append(bytearray(b'x') * (50 * 1024 * 1024))
+        return encode_result({'OK': True, 'Value': os.getpid()})
+
+
+class TestDiracGateway(TestCase):
+    """Test case for the DiracGateway class."""
+
+    def start_gateway(self, **kwargs):
+        """Start a gateway on a free port and return it."""
+        gateway = DiracGateway(DummyService, ("localhost", 0), **kwargs)
+        thread = threading.Thread(target=gateway.start)
+        thread.daemon = True
+        thread.start()
+        while gateway.server is None or not gateway.server.active:
+            time.sleep(0.01)
+        self.addCleanup(thread.join, 10)
+        self.addCleanup(gateway.close)
+        self.addCleanup(DiracRPCClient.close_pools)
+        return gateway
+
+    def test_routing(self):
+        """Test calls are forwarded to the workers."""
+        gateway = self.start_gateway(size=2)
+        result = DiracRPCClient.bulk_status([1, 2], port=gateway.server.port)
+        self.assertEqual(result, {'OK': True, 'Value': {1: DiracStatus.DONE,
+                                                        2: DiracStatus.DONE}})
+        with DiracRPCClient.dirac_api_client(port=gateway.server.port) as dirac:
+            self.assertTrue(dirac.getJobStatus([3])['OK'])
+
+    def test_recycling(self):
+        """Test workers are replaced after max_calls."""
+        gateway = self.start_gateway(size=1, max_calls=2, max_memory_growth=0)
+        pids = [DiracRPCClient.bulk_reschedule([1], port=gateway.server.port)['Value']
+                for _ in range(4)]
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(pids[2], pids[3])
+        self.assertNotEqual(pids[1], pids[2])
+        while gateway.pool.stats()['idle'] != 1:
+            time.sleep(0.01)
+        self.assertEqual(gateway.pool.stats()['workers'], 1)
+
+    def test_memory_recycling(self):
+        """Test the supervisor replaces workers whose memory has grown too much."""
+        gateway = self.start_gateway(size=1, max_calls=0, max_memory_growth=10,
+                                     memory_check_interval=0.1)
+        port = gateway.server.port
+        pid = DiracRPCClient.bulk_kill_delete([1], port=port)['Value']
+        deadline = time.time() + 10
+        while DiracRPCClient.bulk_reschedule([1], port=port)['Value'] == pid:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+        self.assertEqual(gateway.pool.stats()['workers'], 1)
+
+    def test_back_pressure(self):
+        """Test calls are rejected once the queue is full."""
+        gateway = self.start_gateway(size=1, queue_depth=0)
+        port = gateway.server.port
+        slow = threading.Thread(target=DiracRPCClient.bulk_status, args=([1],),
+                                kwargs={'since': '1', 'port': port})
+        slow.start()
+        while gateway.pool.stats()['idle']:
+            time.sleep(0.01)
+        result = DiracRPCClient.bulk_status([2], port=port)
+        slow.join()
+        self.assertFalse(result['OK'])
+        self.assertIn("queue is full", result['Message'])
+        self.assertTrue(DiracRPCClient.bulk_status([2], port=port)['OK'])
@@ -0,0 +1,198 @@
+"""Test DiracRPCClient.py."""
+import os
+import threading
+import time
+from copy import deepcopy
+from unittest import TestCase, skipUnless
+import rpyc
+from rpyc.utils.server import ThreadedServer
+from productionsystem.monitoring.diracrpc import DiracRPCClient
+from productionsystem.monitoring.diracrpc.encoding import encode_result, encode_statuses
+from productionsystem.sql.enums import DiracStatus
+
+STATUSES = ('Done', 'Running', 'Waiting')
+
+
+class DummyDirac(object):
+    """Dummy DIRAC API class."""
+
+    instances = 0
+
+    def __init__(self):
+        """Initialise."""
+        DummyDirac.instances += 1
+
+    def getJobStatus(self, ids):  # pylint: disable=invalid-name
+        """Return dummy statuses."""
+        return {'OK': True, 'Value': {i: {'Status': STATUSES[i % len(STATUSES)],
+                                          'MinorStatus': 'Dummy', 'Site': 'ANY'} for i in ids}}
+
+
+class DummyService(rpyc.Service):
+    """Dummy DIRAC RPyC service."""
+
+    exposed_Dirac = DummyDirac
+
+    def exposed_bulk_status(self, ids, since=None):  # pylint: disable=no-self-use
+        """Return encoded dummy statuses."""
+        if not isinstance(ids, tuple):
+            return encode_statuses({'OK': False, 'Message': 'ids not passed by value'})
+        return encode_statuses(DummyDirac().getJobStatus(ids))
+
+    def exposed_submit_jdls(self, jdls):  # pylint: disable=no-self-use
+        """Pretend to submit each JDL, failing on 'bad' ones."""
+        for job_id, jdl in enumerate(jdls):
+            if jdl == 'bad':
+                yield encode_result({'OK': False, 'Message': 'bad JDL'})
+                return
+            yield encode_result({'OK': True, 'Value': [job_id]})
+
+
+class DummyServerMixin(object):
+    """Run a local dummy DIRAC RPC server for the test case."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Start a local RPC server."""
+        cls.server = ThreadedServer(DummyService, hostname="localhost", port=0,
+                                    protocol_config=DiracRPCClient.CONNECTION_CONFIG)
+        cls.thread = threading.Thread(target=cls.server.start)
+        cls.thread.daemon = True
+        cls.thread.start()
+        while not cls.server.active:
+            time.sleep(0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the local RPC server."""
+        cls.server.close()
+
+
+class TestRPCConnectionPool(DummyServerMixin, TestCase):
+    """Test case for the RPCConnectionPool class."""
+
+    def setUp(self):
+        """Create a new pool."""
+        self.pool = DiracRPCClient.RPCConnectionPool("localhost", self.server.port, max_size=2)
+        self.addCleanup(self.pool.close)
+
+    def test_reuse(self):
+        """Test connections and the DIRAC API object are reused."""
+        DummyDirac.instances = 0
+        with self.pool.connection() as conn:
+            self.assertTrue(conn.dirac.getJobStatus([1])['OK'])
+        with self.pool.connection() as conn2:
+            conn2.dirac.getJobStatus([2])
+        self.assertIs(conn, conn2)
+        self.assertEqual(DummyDirac.instances, 1)
+
+    def test_max_size(self):
+        """Test surplus connections are closed on release."""
+        conns = [self.pool.acquire() for _ in range(3)]
+        for conn in conns:
+            self.pool.release(conn)
+        self.assertEqual([conn.closed for conn in conns], [False, False, True])
+
+    def test_idle_eviction(self):
+        """Test connections idle for too long are evicted."""
+        pool = DiracRPCClient.RPCConnectionPool("localhost", self.server.port, idle_timeout=0)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertTrue(conn.closed)
+
+    def test_reconnect(self):
+        """Test dead connections are replaced."""
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        conn.conn._closed = True  # pylint: disable=protected-access
+        new_conn = self.pool.acquire()
+        self.assertIsNot(new_conn, conn)
+        self.assertFalse(new_conn.closed)
+
+    def test_discard_on_eof(self):
+        """Test connections are not returned to the pool after an EOFError."""
+        with self.assertRaises(EOFError):
+            with self.pool.connection() as conn:
+                raise EOFError
+        self.assertTrue(conn.closed)
+        with self.pool.connection() as conn2:
+            self.assertIsNot(conn2, conn)
+
+    def test_retry_on_eof(self):
+        """Test idempotent calls are retried once on a fresh connection after an EOFError."""
+        conns = []
+
+        def call(conn):
+            """Fail on the first connection only."""
+            conns.append(conn)
+            if len(conns) == 1:
+                raise EOFError
+            return conn.root.bulk_status((1,))
+
+        self.assertTrue(self.pool.call(call))
+        self.assertTrue(conns[0].closed)
+        self.assertIsNot(conns[1], conns[0])
+
+        def fail(conn):
+            """Fail on every connection."""
+            conns.append(conn)
+            raise EOFError
+        del conns[:]
+        with self.assertRaises(EOFError):
+            self.pool.call(fail)
+        self.assertEqual(len(conns), 2)
+
+    def test_dirac_api_client(self):
+        """Test the client contexts borrow from the shared pool."""
+        with DiracRPCClient.dirac_api_client(port=self.server.port) as dirac:
+            self.assertEqual(dirac.getJobStatus([3])['Value'][3]['Status'], 'Done')
+        pool = DiracRPCClient.get_pool(port=self.server.port)
+        self.assertIs(pool, DiracRPCClient.get_pool(port=self.server.port))
+        self.assertEqual(len(pool._idle), 1)  # pylint: disable=protected-access
+        pool.close()
+
+    def test_bulk_status(self):
+        """Test the bulk status payload is decoded."""
+        result = DiracRPCClient.bulk_status({3, 4, 5}, port=self.server.port)
+        self.assertEqual(result, {'OK': True, 'Value': {3: DiracStatus.DONE,
+                                                        4: DiracStatus.RUNNING,
+                                                        5: DiracStatus.WAITING}})
+        self.assertEqual(DiracRPCClient.bulk_status([], port=self.server.port),
+                         {'OK': True, 'Value': {}})
+        DiracRPCClient.get_pool(port=self.server.port).close()
+
+    def test_submit_jdls(self):
+        """Test submission results are streamed back one at a time."""
+        results = DiracRPCClient.submit_jdls(['a', 'b', 'bad', 'c'], port=self.server.port)
+        self.assertEqual(next(results), {'OK': True, 'Value': [0]})
+        self.assertEqual(list(results), [{'OK': True, 'Value': [1]},
+                                         {'OK': False, 'Message': 'bad JDL'}])
+        DiracRPCClient.get_pool(port=self.server.port).close()
+
+
+@skipUnless(os.environ.get("PRODUCTIONSYSTEM_BENCHMARK"),
+            "set PRODUCTIONSYSTEM_BENCHMARK=1 to run the benchmarks")
+class TestStatusTransferBenchmark(DummyServerMixin, TestCase):
+    """Micro-benchmark the netref deepcopy and compact status transfers."""
+
+    def test_benchmark(self):
+        """Compare the two transfers at 1k, 10k and 100k jobs."""
+        pool = DiracRPCClient.get_pool(port=self.server.port)
+        self.addCleanup(pool.close)
+        for num_jobs in (1000, 10000, 100000):
+            ids = tuple(range(num_jobs))
+            start = time.time()
+            with pool.connection() as conn:
+                netref_result = deepcopy(conn.dirac.getJobStatus(ids))
+            netref_time = time.time() - start
+
+            start = time.time()
+            compact_result = DiracRPCClient.bulk_status(ids, port=self.server.port)
+            compact_time = time.time() - start
+
+            self.assertEqual(compact_result['Value'],
+                             {job_id: DiracStatus[info['Status'].upper()]
+                              for job_id, info in netref_result['Value'].items()})
+            print("%6d jobs: netref deepcopy %7.3fs, compact %7.3fs (x%.0f)"
+                  % (num_jobs, netref_time, compact_time, netref_time / compact_time))
@@ -0,0 +1,110 @@
+"""Test FakeDiracRPCServer.py."""
+import threading
+import time
+from unittest import TestCase
+import mock
+from rpyc.utils.server import ThreadedServer
+from productionsystem.monitoring.diracrpc import DiracRPCClient
+from productionsystem.monitoring.diracrpc.cache import TTLCache
+from productionsystem.monitoring.diracrpc.FakeDiracRPCServer import (FakeDirac, FakeDiracBackend,
+                                                                     FakeDiracService)
+from productionsystem.sql.enums import DiracStatus
+
+
+class TestFakeDiracBackend(TestCase):
+    """Test case for the FakeDiracBackend class."""
+
+    def test_schedule(self):
+        """Test jobs move through the schedule and changes are tracked."""
+        backend = FakeDiracBackend(schedule='Waiting:10,Running:20,Done', job_failure_rate=0.5,
+                                   seed=1)
+        with mock.patch('productionsystem.monitoring.diracrpc.FakeDiracRPCServer.time') as time_mock:
+            time_mock.time.return_value = 1000.
+            ids = backend.add_jobs(10)
+            time_mock.time.return_value = 1015.
+            self.assertEqual({info['Status'] for info in backend.statuses(ids).values()},
+                             {'Running'})
+            self.assertEqual(backend.statuses(ids, since=1010.), {})
+            time_mock.time.return_value = 1035.
+            statuses = backend.statuses(ids, since=1010.)
+            self.assertEqual({info['Status'] for info in statuses.values()}, {'Done', 'Failed'})
+
+            backend.set_status(ids[:2], 'Killed')
+            backend.reschedule(ids[1:])
+            statuses = backend.statuses(ids + [999])
+        self.assertEqual(statuses[ids[0]]['Status'], 'Killed')
+        self.assertEqual(statuses[ids[1]]['Status'], 'Waiting')
+        self.assertNotIn(999, statuses)
+
+    def test_failure_rate(self):
+        """Test calls fail at the given rate."""
+        dirac = FakeDirac(FakeDiracBackend(failure_rate=1.))
+        self.assertEqual(dirac.submitJob('[Executable = "run.sh";]'),
+                         {'OK': False, 'Message': 'Fake DIRAC failure'})
+        self.assertEqual(len(dirac.backend), 0)
+
+
+class TestFakeDiracService(TestCase):
+    """Test case for the FakeDiracService served over RPC."""
+
+    def setUp(self):
+        """Start a local stand-in server."""
+        self.backend = FakeDiracBackend(jobs=5, seed=1, catalogue_depth=3, catalogue_fanout=2,
+                                        catalogue_files=1)
+        for patcher in (mock.patch.object(FakeDirac, 'backend', self.backend),
+                        mock.patch.object(FakeDiracService, 'listing_cache', TTLCache())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server = ThreadedServer(FakeDiracService, hostname="localhost", port=0,
+                                     protocol_config=DiracRPCClient.CONNECTION_CONFIG)
+        thread = threading.Thread(target=self.server.start)
+        thread.daemon = True
+        thread.start()
+        while not self.server.active:
+            time.sleep(0.01)
+        self.addCleanup(self.server.close)
+        self.addCleanup(DiracRPCClient.close_pools)
+
+    def test_submit_monitor_remove(self):
+        """Test the whole job life cycle through the RPC client."""
+        port = self.server.port
+        with DiracRPCClient.dirac_api_job_client(port=port) as (_, job_class):
+            job = job_class()
+            job.setName("Test DIRAC Job")
+            job.setParameterSequence("args", ["a", "b", "c"])
+            jdl = job.toJDL()
+        self.assertEqual(list(DiracRPCClient.submit_jdls([jdl, '[Executable = "run.sh";]'],
+                                                         port=port)),
+                         [{'OK': True, 'Value': [6, 7, 8]}, {'OK': True, 'Value': 9}])
+
+        result = DiracRPCClient.bulk_status([1, 6, 9], port=port)
+        self.assertTrue(result['OK'])
+        self.assertEqual(result['Value'][6], DiracStatus.RECEIVED)
+
+        self.assertEqual(DiracRPCClient.bulk_kill_delete([6, 7], port=port),
+                         {'OK': True, 'Value': [6, 7]})
+        self.assertEqual(DiracRPCClient.bulk_status([6], port=port),
+                         {'OK': True, 'Value': {6: DiracStatus.DELETED}})
+
+    def test_submit_split(self):
+        """Test big parametric jobs are submitted in parts, with a result per part."""
+        jdl = '[Executable = "run.sh"; Parameters = {"a", "b", "c"};]'
+        with mock.patch.object(FakeDiracService, 'max_jdl_parameters', 2):
+            self.assertEqual(list(DiracRPCClient.submit_jdls([jdl], port=self.server.port)),
+                             [{'OK': True, 'Value': [6, 7]}, {'OK': True, 'Value': [8]}])
+
+    def test_list_directories(self):
+        """Test the file catalogue is listed recursively in batches, pages and from the cache."""
+        pages = list(DiracRPCClient.list_directories(['/lz'], depth=None, page_size=3,
+                                                     batch_size=2, port=self.server.port))
+        self.assertEqual([len(page['Value']['Successful']) for page in pages], [3, 3, 1])
+        self.assertEqual(self.backend.calls, 4)
+        listing = pages[0]['Value']['Successful']['/lz']
+        self.assertEqual(listing['Files'], {'/lz/file0': {'MetaData': {'Size': 1024}}})
+        self.assertEqual(sorted(listing['SubDirs']), ['/lz/dir0', '/lz/dir1'])
+
+        pages = list(DiracRPCClient.list_directories(['/lz'], depth=1, port=self.server.port))
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(sorted(pages[0]['Value']['Successful']),
+                         ['/lz', '/lz/dir0', '/lz/dir1'])
+        self.assertEqual(self.backend.calls, 4)  # all cached
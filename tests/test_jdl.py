@@ -0,0 +1,44 @@
+"""Test jdl.py."""
+from unittest import TestCase
+from productionsystem.monitoring.diracrpc.jdl import job_count, split_parametric_jdl
+
+
+class TestJDL(TestCase):
+    """Test case for the parametric JDL handling."""
+
+    def test_job_count(self):
+        """Test the jobs of plain and parametric JDLs are counted."""
+        self.assertEqual(job_count('[Executable = "run.sh";]'), 1)
+        self.assertEqual(job_count('[Parameters = 5;]'), 5)
+        self.assertEqual(job_count('[Parameters = {"a", "b,c", 3};]'), 3)
+
+    def test_split_list(self):
+        """Test a Parameters list is split."""
+        self.assertEqual(split_parametric_jdl('[Parameters = {"a", "b,c", "d"};]', 2),
+                         ['[Parameters = {"a", "b,c"};]', '[Parameters = {"d"};]'])
+
+    def test_split_sequences(self):
+        """Test a Parameters count is split along with its sequences and numeric values."""
+        jdl = ('[\n    Parameters.args = {"a", "b", "c"};\n    Parameters = 3;\n'
+               '    Parameters.more = {1, 2, 3};\n    ParameterStep = 2;\n]')
+        parts = split_parametric_jdl(jdl, 2)
+        self.assertEqual(parts,
+                         ['[\n    Parameters.args = {"a", "b"};\n    Parameters = 2;\n'
+                          '    Parameters.more = {1, 2};\n    ParameterStep = 2;\n'
+                          '    ParameterStart = 0;\n]',
+                          '[\n    Parameters.args = {"c"};\n    Parameters = 1;\n'
+                          '    Parameters.more = {3};\n    ParameterStep = 2;\n'
+                          '    ParameterStart = 4;\n]'])
+
+        parts = split_parametric_jdl('[Parameters = 5; ParameterStart = 1; ParameterFactor = 2;]',
+                                     2)
+        self.assertEqual(parts, ['[Parameters = 2; ParameterStart = 1; ParameterFactor = 2;]',
+                                 '[Parameters = 2; ParameterStart = 4; ParameterFactor = 2;]',
+                                 '[Parameters = 1; ParameterStart = 16; ParameterFactor = 2;]'])
+
+    def test_not_split(self):
+        """Test small, non parametric and %n using JDLs are left whole."""
+        for jdl in ('[Executable = "run.sh";]', '[Parameters = 2;]',
+                    '[Parameters = 3; Arguments = "%n";]'):
+            self.assertEqual(split_parametric_jdl(jdl, 2), [jdl])
+        self.assertEqual(split_parametric_jdl('[Parameters = 3;]', 0), ['[Parameters = 3;]'])
@@ -0,0 +1,63 @@
+"""Test metrics.py."""
+from unittest import TestCase
+from urllib.request import urlopen
+from productionsystem.metrics import MetricsServer
+from productionsystem.monitoring.diracrpc.metrics import MetricsRegistry, TimedProxy, call_context
+
+
+class TestMetricsRegistry(TestCase):
+    """Test case for the MetricsRegistry class."""
+
+    def test_render(self):
+        """Test calls are counted and rendered in the text exposition format."""
+        registry = MetricsRegistry('test')
+        registry.observe('bulk_status', 0.2, size=1000)
+        registry.observe('bulk_status', 20, error=True)
+        registry.connection_opened()
+        text = registry.render()
+        self.assertIn('test_calls_total{method="bulk_status"} 2\n', text)
+        self.assertIn('test_call_errors_total{method="bulk_status"} 1\n', text)
+        self.assertIn('test_call_seconds_bucket{method="bulk_status",le="0.25"} 1\n', text)
+        self.assertIn('test_call_seconds_bucket{method="bulk_status",le="+Inf"} 2\n', text)
+        self.assertIn('test_payload_bytes_count{method="bulk_status"} 1\n', text)
+        self.assertIn('test_connections_opened_total 1\n', text)
+        self.assertIn('test_connections_closed_total 0\n', text)
+
+    def test_slow_calls(self):
+        """Test slow calls are logged with their context."""
+        registry = MetricsRegistry('test', slow_call_threshold=1)
+        with self.assertLogs('productionsystem.monitoring.diracrpc.metrics', 'WARNING') as logs:
+            registry.observe('fast', 0.5)
+            with call_context(request_id=1), call_context(parametricjob_id=2):
+                registry.observe('slow', 5, size=10)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Slow DIRAC RPC call slow took 5.00s "
+                      "(parametricjob_id=2, request_id=1, payload=10B)", logs.output[0])
+
+    def test_instrument(self):
+        """Test instrumented methods, generators and proxies are timed."""
+        registry = MetricsRegistry('test')
+
+        @registry.instrument
+        def exposed_stream(count):
+            """Yield count payloads."""
+            for _ in range(count):
+                yield b'1234'
+
+        self.assertEqual(list(exposed_stream(3)), [b'1234'] * 3)
+        self.assertEqual(registry.calls('stream'), 3)
+
+        proxy = TimedProxy({}, registry, 'Dict')
+        with self.assertRaises(KeyError):
+            proxy.pop('missing')
+        self.assertIn('test_call_errors_total{method="Dict.pop"} 1', registry.render())
+
+    def test_server(self):
+        """Test the metrics are served over HTTP."""
+        registry = MetricsRegistry('test')
+        registry.observe('bulk_status', 0.1)
+        server = MetricsServer(('localhost', 0), [registry])
+        server.start()
+        self.addCleanup(server.close)
+        response = urlopen('http://localhost:%d/metrics' % server.port)
+        self.assertEqual(response.read().decode('utf-8'), registry.render())
@@ -0,0 +1,123 @@
+"""Test migrations.py."""
+import importlib
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from unittest import TestCase
+import mock
+from sqlalchemy import Column, Integer, String, create_engine, inspect, select
+from sqlalchemy.dialects import mysql
+from productionsystem.sql import migrations
+from productionsystem.sql.migrations import MigrationError, SchemaOperations
+
+
+def setUpModule():
+    """Import the models once the config entry point map has been set up."""
+    global models  # pylint: disable=global-statement, invalid-name
+    models = importlib.import_module("productionsystem.sql.models")
+
+
+class TestMigrations(TestCase):
+    """Test case for upgrading the DB schema."""
+
+    def setUp(self):
+        """Set up an SQLite DB."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.engine = create_engine('sqlite:///' + os.path.join(tmpdir, 'requests.db'))
+        self.addCleanup(self.engine.dispose)
+
+    def test_upgrade(self):
+        """Test migrations are applied once and bring existing tables up to date."""
+        self.assertEqual(len(migrations.upgrade(self.engine)), len(migrations.MIGRATIONS))
+        with self.engine.connect() as conn:
+            self.assertEqual(migrations.current_version(conn), migrations.head())
+        self.assertEqual(migrations.upgrade(self.engine), [])
+
+        # Roll back to a DB created before the indexes were added.
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql('DROP INDEX ix_requests_status')
+            conn.execute(migrations.schema_version.delete())
+        with self.assertLogs('productionsystem.sql.migrations', 'INFO') as logs:
+            applied = migrations.upgrade(self.engine)
+        self.assertEqual([migration.version for migration in applied],
+                         [migration.version for migration in migrations.MIGRATIONS])
+        self.assertEqual(logs.output[:2],
+                         ["INFO:productionsystem.sql.migrations:Applying migration 1: "
+                          "Add the monitoring and API query indexes",
+                          "INFO:productionsystem.sql.migrations:Adding index ix_requests_status "
+                          "to table requests."])
+        indexes = {index['name'] for index in inspect(self.engine).get_indexes('requests')}
+        self.assertIn('ix_requests_status', indexes)
+
+    def test_copy_logs(self):
+        """Test the TEXT logs are split into UTC log entries, leaving the columns for older code."""
+        # The TEXT log timestamps are local time, here UTC-5 in January.
+        self.addCleanup(time.tzset)
+        patcher = mock.patch.dict(os.environ, {'TZ': 'EST+05EDT,M3.2.0,M11.1.0'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        time.tzset()
+
+        migrations.upgrade(self.engine)
+        with self.engine.begin() as conn:
+            conn.execute(models.Requests.__table__.insert(), {'id': 1, 'requester_id': 1})
+            conn.execute(models.ParametricJobs.__table__.insert(),
+                         [{'request_id': 1, 'id': 1, 'requester_id': 1},
+                          {'request_id': 1, 'id': 2, 'requester_id': 1}])
+            conn.exec_driver_sql("UPDATE requests SET log = '[2020-01-02 03:04:05] Submitting\n"
+                                 "[2020-01-02 03:04:06] Unhandled exception\nValueError\n'")
+            conn.exec_driver_sql("UPDATE parametricjobs SET log = '[2020-01-02 03:04:05] Done\n' "
+                                 "WHERE id = 2")
+            conn.execute(migrations.schema_version.delete()
+                         .where(migrations.schema_version.c.version >= 2))
+
+        self.assertEqual([migration.version for migration in migrations.upgrade(self.engine)],
+                         [2, 3])
+        for table_name in ('requests', 'parametricjobs'):
+            columns = {column['name'] for column in inspect(self.engine).get_columns(table_name)}
+            self.assertIn('log', columns)
+        with self.engine.connect() as conn:
+            entries = conn.execute(select(models.LogEntries.__table__)
+                                   .order_by(models.LogEntries.id)).all()
+        self.assertEqual([entry[1:] for entry in entries],
+                         [(1, None, datetime(2020, 1, 2, 8, 4, 5), 'Submitting'),
+                          (1, None, datetime(2020, 1, 2, 8, 4, 6),
+                           'Unhandled exception\nValueError'),
+                          (1, 2, datetime(2020, 1, 2, 8, 4, 5), 'Done')])
+
+    def test_add_column(self):
+        """Test columns are only added once and must be safe to add online."""
+        migrations.upgrade(self.engine)
+        with self.engine.begin() as conn:
+            ops = SchemaOperations(conn)
+            self.assertTrue(ops.add_column('services', Column('note', String(50))))
+            self.assertFalse(ops.add_column('services', Column('note', String(50))))
+            self.assertFalse(ops.add_column('missing', Column('note', String(50))))
+            self.assertTrue(ops.add_column('services', Column('count', Integer, nullable=False,
+                                                              server_default='0')))
+            with self.assertRaises(MigrationError):
+                ops.add_column('services', Column('other', Integer, nullable=False))
+        columns = {column['name'] for column in inspect(self.engine).get_columns('services')}
+        self.assertTrue({'note', 'count'}.issubset(columns))
+
+    def test_mysql_online_ddl(self):
+        """Test MySQL DDL is run in place without locking the table."""
+        connection = mock.MagicMock(dialect=mysql.dialect())
+        ops = SchemaOperations(connection)
+        with mock.patch.object(ops, 'has_table', return_value=True), \
+                mock.patch.object(ops, 'has_column', return_value=False), \
+                mock.patch.object(ops, 'has_index', side_effect=[False, True]):
+            ops.add_index('requests', 'ix_requests_requester_id_status', 'requester_id', 'status')
+            ops.add_column('requests', Column('priority', Integer, nullable=False,
+                                              server_default='0'))
+            ops.drop_index('requests', 'ix_requests_status')
+        self.assertEqual([call[0][0] for call in connection.exec_driver_sql.call_args_list],
+                         ["CREATE INDEX ix_requests_requester_id_status ON requests "
+                          "(requester_id, status) ALGORITHM=INPLACE LOCK=NONE",
+                          "ALTER TABLE requests ADD COLUMN priority INTEGER NOT NULL DEFAULT '0'"
+                          ", ALGORITHM=INPLACE, LOCK=NONE",
+                          "ALTER TABLE requests DROP INDEX ix_requests_status"
+                          ", ALGORITHM=INPLACE, LOCK=NONE"])
@@ -0,0 +1,233 @@
+"""Test MonitoringDaemon.py."""
+import importlib
+from unittest import TestCase
+import mock
+from productionsystem.sql.enums import LocalStatus
+
+md = None  # pylint: disable=invalid-name
+
+
+def setUpModule():
+    """Import the module under test once the config entry point map has been set up."""
+    global md  # pylint: disable=global-statement, invalid-name
+    md = importlib.import_module("productionsystem.monitoring.MonitoringDaemon")
+
+
+class TestMonitorRequest(TestCase):
+    """Test case for the monitor_request function."""
+
+    def setUp(self):
+        """Stub out the DB unit of work."""
+        patcher = mock.patch.object(md, "unit_of_work")
+        self.session = patcher.start().return_value.__enter__.return_value
+        self.addCleanup(patcher.stop)
+
+    def test_monitor(self):
+        """Test monitoring a running request."""
+        request = mock.MagicMock(id=1, status=LocalStatus.RUNNING)
+        request.update.return_value = 7
+        result = md.monitor_request(request)
+        self.assertEqual(result.request_id, 1)
+        self.assertGreaterEqual(result.wall_time, 0.)
+        self.assertTrue(result.success)
+        self.assertEqual(result.rows_updated, 7)
+        self.session.add.assert_called_once_with(request)
+        request.monitor.assert_called_once_with(None, None)
+        request.update.assert_called_once_with(session=self.session)
+        request.submit.assert_not_called()
+
+    def test_submit(self):
+        """Test approved requests are submitted."""
+        request = mock.MagicMock(id=2, status=LocalStatus.APPROVED)
+        md.monitor_request(request)
+        request.submit.assert_called_once_with()
+        self.assertEqual(request.update.call_count, 3)
+
+    def test_remove(self):
+        """Test removing requests are removed and not monitored."""
+        request = mock.MagicMock(id=3, status=LocalStatus.REMOVING)
+        self.assertTrue(md.monitor_request(request).success)
+        request.remove.assert_called_once_with()
+        request.monitor.assert_not_called()
+
+    def test_error_isolation(self):
+        """Test exceptions are contained within the request."""
+        request = mock.MagicMock(id=4, status=LocalStatus.RUNNING)
+        request.monitor.side_effect = RuntimeError("boom")
+        result = md.monitor_request(request)
+        self.assertEqual((result.request_id, result.success), (4, False))
+
+
+class TestMonitoringDaemon(TestCase):
+    """Test case for the MonitoringDaemon class."""
+
+    def setUp(self):
+        """Stub out the DB unit of work."""
+        patcher = mock.patch.object(md, "unit_of_work")
+        self.session = patcher.start().return_value.__enter__.return_value
+        self.addCleanup(patcher.stop)
+
+    def test__init__(self):
+        """Test bad worker types are rejected."""
+        with self.assertRaisesRegex(ValueError, "Worker type"):
+            md.MonitoringDaemon(dburl="sqlite://", delay=1, cert=None,
+                                worker_type="fibre", app="test", pid="test.pid")
+
+    def test_monitor_requests_pool(self):
+        """Test requests are distributed over the worker pool."""
+        patcher = mock.patch.object(md, "Requests")
+        mock_requests = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(md, "ParametricJobs")
+        mock_parametricjobs = patcher.start()
+        self.addCleanup(patcher.stop)
+        mock_parametricjobs.monitored_dirac_ids.return_value = {}
+        mock_parametricjobs.dirac_job_rollups.return_value = {(2, 1): 'rollup'}
+        requests = [mock.MagicMock(id=i, status=LocalStatus.RUNNING) for i in range(5)]
+        mock_requests.get.return_value = list(requests)
+        mock_requests.get_reschedules.return_value = []
+        daemon = md.MonitoringDaemon(dburl="sqlite://", delay=1, cert=None, workers=3,
+                                     app="test", pid="test.pid", logger=mock.MagicMock())
+        daemon._pool = md.ThreadPool(3)
+        try:
+            daemon.monitor_requests()
+        finally:
+            daemon._pool.terminate()
+        self.assertEqual(mock_parametricjobs.dirac_job_rollups.call_count, 1)
+        for request in requests:
+            request.monitor.assert_called_once_with(
+                None, {(2, 1): 'rollup'} if request.id == 2 else {})
+        summary = daemon.logger.info.call_args[0]
+        self.assertEqual(summary[1:3], (5, 0))
+
+    def test_gather_dirac_statuses(self):
+        """Test DIRAC statuses are gathered in bulk and split by request."""
+        patcher = mock.patch.object(md, "ParametricJobs")
+        mock_parametricjobs = patcher.start()
+        self.addCleanup(patcher.stop)
+        mock_parametricjobs.monitored_dirac_ids.return_value = {1: {1, 2, 3}, 2: {4}}
+        mock_parametricjobs.get_dirac_statuses.side_effect = \
+            lambda ids, since: ({i: {'Status': 'Done'} for i in ids if i != 3}, set())
+        requests = [mock.MagicMock(id=1, status=LocalStatus.RUNNING),
+                    mock.MagicMock(id=2, status=LocalStatus.SUBMITTED),
+                    mock.MagicMock(id=3, status=LocalStatus.APPROVED),
+                    mock.MagicMock(id=4, status=LocalStatus.RUNNING)]
+        daemon = md.MonitoringDaemon(dburl="sqlite://", delay=1, cert=None,
+                                     app="test", pid="test.pid", logger=mock.MagicMock())
+        statuses = daemon.gather_dirac_statuses(requests)
+        mock_parametricjobs.monitored_dirac_ids.assert_called_once_with([1, 2, 4])
+        mock_parametricjobs.get_dirac_statuses.assert_called_once_with({1, 2, 3, 4}, since=None)
+        self.assertEqual(statuses, {1: {1: {'Status': 'Done'}, 2: {'Status': 'Done'}},
+                                    2: {4: {'Status': 'Done'}},
+                                    4: {}})
+
+    def test_gather_dirac_statuses_incremental(self):
+        """Test incremental polling and the periodic full reconciliation."""
+        patcher = mock.patch.object(md, "ParametricJobs")
+        mock_parametricjobs = patcher.start()
+        self.addCleanup(patcher.stop)
+        mock_parametricjobs.get_dirac_statuses.return_value = ({}, set())
+        mock_parametricjobs.monitored_dirac_ids.return_value = {1: {1}}
+        requests = [mock.MagicMock(id=1, status=LocalStatus.RUNNING)]
+        daemon = md.MonitoringDaemon(dburl="sqlite://", delay=1, cert=None, incremental=True,
+                                     app="test", pid="test.pid", logger=mock.MagicMock())
+
+        daemon.gather_dirac_statuses(requests)
+        self.assertIsNone(mock_parametricjobs.get_dirac_statuses.call_args[1]['since'])
+        last_poll = daemon._last_poll[1]  # pylint: disable=protected-access
+        daemon.gather_dirac_statuses(requests)
+        self.assertEqual(mock_parametricjobs.get_dirac_statuses.call_args[1]['since'],
+                         last_poll - md.INCREMENTAL_OVERLAP)
+
+        # failures don't move the high-water mark on
+        mock_parametricjobs.get_dirac_statuses.return_value = ({}, {1})
+        last_poll = daemon._last_poll[1]  # pylint: disable=protected-access
+        daemon.gather_dirac_statuses(requests)
+        self.assertEqual(daemon._last_poll[1], last_poll)  # pylint: disable=protected-access
+
+        # full reconciliation is due
+        daemon._full_poll_interval = md.timedelta(0)  # pylint: disable=protected-access
+        daemon.gather_dirac_statuses(requests)
+        self.assertIsNone(mock_parametricjobs.get_dirac_statuses.call_args[1]['since'])
+
+    def test_wait_for_wakeups(self):
+        """Test web app wake-ups trigger a targeted monitoring cycle."""
+        patcher = mock.patch.object(md, "MonitoringEvents")
+        mock_events = patcher.start()
+        self.addCleanup(patcher.stop)
+        mock_events.consume.side_effect = [set(), {3, 1}, set()]
+        daemon = md.MonitoringDaemon(dburl="sqlite://", delay=1, cert=None, wakeup_interval=0.01,
+                                     app="test", pid="test.pid", logger=mock.MagicMock())
+        daemon.monitor_requests = mock.MagicMock()
+        daemon.wait_for_wakeups(0.03)
+        daemon.monitor_requests.assert_called_once_with(request_ids={1, 3})
+        self.assertLessEqual(mock_events.consume.call_count, 3)
+
+    def test_adaptive_scheduling(self):
+        """Test stable requests are backed off and hot ones kept at the daemon's delay."""
+        daemon = md.MonitoringDaemon(dburl="sqlite://", delay=1, cert=None, adaptive=True,
+                                     max_poll_interval=3, app="test", pid="test.pid",
+                                     logger=mock.MagicMock())
+        now = md.datetime.utcnow()
+        requests = [mock.MagicMock(id=i, status=LocalStatus.RUNNING, parametric_jobs=[])
+                    for i in range(4)]
+        requests[3].status = LocalStatus.APPROVED
+        schedules = {i: mock.MagicMock(next_due=now + md.timedelta(minutes=1)) for i in range(4)}
+        schedules[1].next_due = now
+        del schedules[2]
+        self.assertEqual([request.id for request in daemon.due_requests(requests, schedules, now)],
+                         [1, 2, 3])
+
+        schedules = {i: md.MonitoringSchedule(request_id=i, interval=120) for i in range(3)}
+        results = [md.MonitorResult(0, 0., True, 0, LocalStatus.RUNNING, False),
+                   md.MonitorResult(1, 0., True, 5, LocalStatus.RUNNING, False),
+                   md.MonitorResult(2, 0., True, 0, LocalStatus.RUNNING, False)]
+        schedules[2].interval = 180
+        with mock.patch.object(md.MonitoringSchedule, "update_all") as update_all:
+            daemon.reschedule_requests(results, {i: LocalStatus.RUNNING for i in range(3)},
+                                       schedules, now)
+        self.assertEqual([schedule.interval for schedule in update_all.call_args[0][0]],
+                         [180, 60, 180])
+        self.assertEqual(schedules[1].next_due, now + md.timedelta(minutes=1))
+
+    def test_queue_submissions(self):
+        """Test approved and interrupted submissions are queued rather than monitored."""
+        daemon = md.MonitoringDaemon(dburl="sqlite://", delay=1, cert=None, submit_workers=2,
+                                     app="test", pid="test.pid", logger=mock.MagicMock())
+        daemon._submit_pool = mock.MagicMock()  # pylint: disable=protected-access
+        daemon._submit_pool.apply_async.side_effect = lambda *args: mock.MagicMock()
+        approved = mock.MagicMock(id=1, status=LocalStatus.APPROVED)
+        interrupted = mock.MagicMock(id=2, status=LocalStatus.SUBMITTING,
+                                parametric_jobs=[mock.MagicMock(awaiting_submission=True)])
+        rescheduling = mock.MagicMock(id=3, status=LocalStatus.SUBMITTING,
+                                 parametric_jobs=[mock.MagicMock(awaiting_submission=False)])
+        running = mock.MagicMock(id=4, status=LocalStatus.RUNNING)
+        requests = [approved, interrupted, rescheduling, running]
+        self.assertEqual(daemon.queue_submissions(requests), [rescheduling, running])
+        self.assertEqual(approved.status, LocalStatus.SUBMITTING)
+        approved.update.assert_called_once_with()
+        calls = daemon._submit_pool.apply_async.call_args_list  # pylint: disable=protected-access
+        self.assertEqual([call[0][1] for call in calls], [(approved, False), (interrupted, True)])
+
+        # queued requests are skipped and interrupted submissions only resumed after a restart
+        daemon._submitting[1].ready.return_value = False  # pylint: disable=protected-access
+        daemon._submitting[2].ready.return_value = True  # pylint: disable=protected-access
+        self.assertEqual(daemon.queue_submissions(requests), [interrupted, rescheduling, running])
+
+    def test_queue_removals(self):
+        """Test requests marked for removal are queued once rather than monitored."""
+        daemon = md.MonitoringDaemon(dburl="sqlite://", delay=1, cert=None, removal_workers=1,
+                                     app="test", pid="test.pid", logger=mock.MagicMock())
+        daemon._removal_pool = mock.MagicMock()  # pylint: disable=protected-access
+        daemon._removal_pool.apply_async.side_effect = lambda *args: mock.MagicMock()
+        removing = mock.MagicMock(id=1, status=LocalStatus.REMOVING)
+        running = mock.MagicMock(id=2, status=LocalStatus.RUNNING)
+        self.assertEqual(daemon.queue_removals([removing, running]), [running])
+        daemon._removing[1].ready.return_value = False  # pylint: disable=protected-access
+        self.assertEqual(daemon.queue_removals([removing, running]), [running])
+        self.assertEqual(daemon._removal_pool.apply_async.call_count, 1)  # pylint: disable=protected-access
+
+        # a failed removal is queued again once it has finished
+        daemon._removing[1].ready.return_value = True  # pylint: disable=protected-access
+        daemon.queue_removals([removing])
+        self.assertEqual(daemon._removal_pool.apply_async.call_count, 2)  # pylint: disable=protected-access
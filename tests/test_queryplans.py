@@ -0,0 +1,166 @@
+"""Test the monitoring and API queries use the model indexes."""
+import importlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import mock
+from sqlalchemy import event
+from productionsystem.sql.enums import DiracStatus, LocalStatus
+from productionsystem.sql.registry import SessionRegistry
+
+
+def setUpModule():
+    """Import the models once the config entry point map has been set up."""
+    global models  # pylint: disable=global-statement, invalid-name
+    models = importlib.import_module("productionsystem.sql.models")
+
+
+class TestQueryPlans(TestCase):
+    """Test case checking the SQLite query plans of the hot queries."""
+
+    def setUp(self):
+        """Set up an SQLite DB and record the queries made."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.url = 'sqlite:///' + os.path.join(tmpdir, 'requests.db')
+        self.registry = self.make_registry()
+        self.statements = []
+        event.listen(self.registry.engines[0], 'before_cursor_execute', self.record)
+
+    def make_registry(self):
+        """Create a registry, bypassing the singleton, and make it the current instance."""
+        registry = SessionRegistry.__new__(SessionRegistry)
+        registry.__init__(self.url)
+        self.addCleanup(registry.dispose)
+        patcher = mock.patch.object(SessionRegistry, 'get_instance', return_value=registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return registry
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        """Record the SELECT statements executed."""
+        # pylint: disable=unused-argument, too-many-arguments
+        if statement.lstrip().startswith('SELECT'):
+            self.statements.append((statement, parameters))
+
+    def query_plans(self, func, *args, **kwargs):
+        """Return the query plan details of the statements executed by calling func."""
+        self.statements = []
+        func(*args, **kwargs)
+        plans = []
+        with self.registry.engines[0].connect() as conn:
+            for statement, parameters in self.statements:
+                plans.append(' / '.join(row[-1] for row in
+                                        conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement,
+                                                             parameters)))
+        return plans
+
+    def test_monitoring_queries(self):
+        """Test the monitoring daemon's queries search the indexes rather than scan."""
+        plans = self.query_plans(models.Requests.get, status=(LocalStatus.APPROVED,
+                                                              LocalStatus.RUNNING),
+                                 load_parametricjobs=True)
+        self.assertIn('USING INDEX ix_requests_status', plans[0])
+
+        plans = self.query_plans(models.Requests.get_reschedules)
+        self.assertIn('INDEX ix_parametricjobs_reschedule_request_id (reschedule=?)', plans[0])
+        self.assertNotIn('SCAN', plans[0])
+
+        plans = self.query_plans(models.DiracJobs.get_states, 1, 1)
+        self.assertIn('INDEX ix_diracjobs_request_id_parametricjob_id_status '
+                      '(request_id=? AND parametricjob_id=?)', plans[0])
+
+        plans = self.query_plans(models.ParametricJobs.monitored_dirac_ids, [1, 2])
+        self.assertIn('INDEX ix_diracjobs_request_id_parametricjob_id_status (request_id=?)',
+                      plans[0])
+        self.assertNotIn('SCAN', plans[0])
+
+    def test_monitor_rollup(self):
+        """Test monitoring counts the DIRAC jobs DB side and only fetches those still live."""
+        request = models.Requests(requester_id=1, parametricjobs=[{}])
+        request.add()
+        models.DiracJobs.add_submitted(request.id, 1, 1, range(1, 101))
+        with self.registry() as session:
+            models.DiracJobs.bulk_update(session, [(job_id, DiracStatus.DONE, 0)
+                                                   for job_id in range(1, 99)])
+            session.commit()
+        job = models.ParametricJobs.get(request.id, 1)
+        job.status = LocalStatus.RUNNING
+
+        self.statements = []
+        job.monitor({99: DiracStatus.RUNNING, 100: DiracStatus.DONE})
+        self.assertIn('GROUP BY diracjobs.request_id, diracjobs.parametricjob_id, '
+                      'diracjobs.status', self.statements[0][0])
+        self.assertEqual(len(self.statements), 2)
+        self.assertIn('diracjobs.status IN', self.statements[1][0])
+        plans = self.query_plans(models.DiracJobs.status_counts, [request.id])
+        self.assertIn('COVERING INDEX ix_diracjobs_request_id_parametricjob_id_status', plans[0])
+        self.assertEqual(sorted(job.pop_dirac_job_changes()),
+                         [(99, DiracStatus.RUNNING, 0), (100, DiracStatus.DONE, 0)])
+        self.assertEqual((job.num_completed, job.num_running), (99, 1))
+        self.assertEqual(job.status, LocalStatus.RUNNING)
+
+    def test_monitor_rollup_cycle(self):
+        """Test the DIRAC jobs of all the monitored parametric jobs are gathered at once."""
+        requests = []
+        for request_id in (1, 2):
+            request = models.Requests(requester_id=1, parametricjobs=[{}, {}, {}])
+            request.add()
+            for parametricjob_id in (1, 2, 3):
+                first = 100 * request_id + 10 * parametricjob_id
+                models.DiracJobs.add_submitted(request.id, parametricjob_id, 1,
+                                               range(first, first + 5))
+            requests.append(models.Requests.get(request.id, load_parametricjobs=True))
+        with self.registry() as session:
+            models.DiracJobs.bulk_update(session, [(210, DiracStatus.DONE, 0),
+                                                   (211, DiracStatus.FAILED, 0),
+                                                   (121, DiracStatus.FAILED, 0)])
+            session.commit()
+        for request in requests:
+            for job in request.parametric_jobs:
+                job.status = LocalStatus.RUNNING
+
+        self.statements = []
+        rollups = models.ParametricJobs.dirac_job_rollups(job for request in requests
+                                                          for job in request.parametric_jobs)
+        self.assertEqual(len(self.statements), 2)
+        self.assertEqual(len(rollups), 6)
+        counts, states = rollups[(2, 1)]
+        self.assertEqual(counts, {DiracStatus.RECEIVED: 3, DiracStatus.DONE: 1,
+                                  DiracStatus.FAILED: 1})
+        self.assertEqual(sorted(job_id for job_id, _, _ in states), [211, 212, 213, 214])
+        # Failed jobs are only fetched for the parametric jobs that can reschedule them.
+        self.assertEqual(sorted(job_id for job_id, _, _ in rollups[(1, 2)][1]),
+                         [120, 122, 123, 124])
+
+        self.statements = []
+        for request in requests:
+            request.monitor({}, {key: rollup for key, rollup in rollups.items()
+                                 if key[0] == request.id})
+        self.assertEqual(self.statements, [])
+        self.assertEqual(requests[1].parametric_jobs[0].num_completed, 1)
+
+    def test_api_queries(self):
+        """Test a non-admin user's requests and jobs are found through the indexes."""
+        plans = self.query_plans(models.Requests.get, user_id=1)
+        self.assertIn('USING INDEX ix_requests_requester_id_status (requester_id=?)', plans[0])
+
+        plans = self.query_plans(models.DiracJobs.get, request_id=1, parametricjob_id=1,
+                                 user_id=1)
+        self.assertIn('INDEX ix_diracjobs_request_id_parametricjob_id_status', plans[0])
+
+    def test_log_queries(self):
+        """Test a log is paged through in order using its index."""
+        request = models.Requests(requester_id=1)
+        for i in range(5):
+            request._clientlog("Entry %d" % i)  # pylint: disable=protected-access
+        request.add()
+        entries = models.LogEntries.get(request.id, offset=1, limit=3)
+        # The first entry is the warning that the request has no parametric jobs.
+        self.assertEqual([entry.message for entry in entries], ["Entry 0", "Entry 1", "Entry 2"])
+
+        plans = self.query_plans(models.LogEntries.get, request.id, parametricjob_id=1)
+        self.assertIn('INDEX ix_logentries_request_id_parametricjob_id_timestamp '
+                      '(request_id=? AND parametricjob_id=?)', plans[0])
+        self.assertNotIn('TEMP B-TREE', plans[0])
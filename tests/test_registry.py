@@ -0,0 +1,112 @@
+"""Test registry.py."""
+import importlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import mock
+from sqlalchemy import inspect
+from productionsystem.sql.SQLTableBase import SQLTableBase
+from productionsystem.sql.enums import ServiceStatus
+from productionsystem.sql.registry import (POOL_METRICS, SessionRegistry, engine_config,
+                                           replica_reads, unit_of_work)
+
+
+def setUpModule():
+    """Import the models once the config entry point map has been set up."""
+    global Services  # pylint: disable=global-statement, invalid-name
+    Services = importlib.import_module("productionsystem.sql.models").Services
+
+
+class TestSessionRegistry(TestCase):
+    """Test case for the SessionRegistry class."""
+
+    def setUp(self):
+        """Set up primary and replica SQLite DBs."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.config = {'database': {'pool_size': 2, 'pool_timeout': 5},
+                       'database.webapp': {'pool_size': 3,
+                                           'read_url': 'sqlite:///' + os.path.join(tmpdir,
+                                                                                   'replica.db')}}
+        patcher = mock.patch('productionsystem.sql.registry.getConfig',
+                             side_effect=lambda section: dict(self.config.get(section, {})))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = 'sqlite:///' + os.path.join(tmpdir, 'primary.db')
+
+    def make_registry(self, *args, **kwargs):
+        """Create a registry, bypassing the singleton, and make it the current instance."""
+        registry = SessionRegistry.__new__(SessionRegistry)
+        registry.__init__(*args, **kwargs)
+        self.addCleanup(registry.dispose)
+        patcher = mock.patch.object(SessionRegistry, 'get_instance', return_value=registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return registry
+
+    def test_engine_config(self):
+        """Test the profile section and overrides take precedence over the database section."""
+        self.assertEqual(engine_config(), {'pool_size': 2, 'pool_timeout': 5})
+        config = engine_config('webapp', pool_timeout=None, max_overflow=0)
+        self.assertEqual(config['pool_size'], 3)
+        self.assertEqual(config['pool_timeout'], 5)
+        self.assertEqual(config['max_overflow'], 0)
+
+        registry = self.make_registry(self.url, profile='webapp', max_overflow=0)
+        primary, replica = registry.engines
+        self.assertEqual(primary.pool.size(), 3)
+        self.assertEqual(primary.pool.timeout(), 5)
+        self.assertEqual(replica.pool.size(), 3)
+
+    def test_replica_reads(self):
+        """Test read only sessions only go to the replica within replica_reads."""
+        registry = self.make_registry(self.url, profile='webapp')
+        SQLTableBase.metadata.create_all(bind=registry.engines[1])
+        Services(name='DIRAC', status=ServiceStatus.UP).add()
+        checkouts = {name: POOL_METRICS.checkouts(name) for name in ('primary', 'replica')}
+
+        self.assertEqual([service.name for service in Services.get_services()], ['DIRAC'])
+        self.assertEqual(POOL_METRICS.checkouts('primary'), checkouts['primary'] + 1)
+        with replica_reads():
+            self.assertEqual(Services.get_services(), [])
+            Services(name='monitoringd', status=ServiceStatus.UP).add()
+        self.assertEqual(len(Services.get_services()), 2)
+        self.assertEqual(POOL_METRICS.checkouts('replica'), checkouts['replica'] + 1)
+        self.assertIn('db_pool_checkout_wait_seconds_count{engine="replica"} %d\n'
+                      % (checkouts['replica'] + 1), POOL_METRICS.render())
+
+    def test_statement_timeout(self):
+        """Test unsupported statement timeouts are warned about."""
+        with self.assertLogs('productionsystem.sql.registry', 'WARNING') as logs:
+            self.make_registry(self.url, statement_timeout=30, pool_timeout=1, bad_option=1)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("Ignoring unknown primary database option(s): bad_option", logs.output[0])
+        self.assertIn("Statement timeouts are not supported for sqlite databases.",
+                      logs.output[1])
+
+    def test_unit_of_work(self):
+        """Test objects stay attached and the helpers join the unit of work until it ends."""
+        self.make_registry(self.url)
+        Services(name='DIRAC', status=ServiceStatus.UNKNOWN).add()
+        checkouts = POOL_METRICS.checkouts('primary')
+
+        with unit_of_work() as session:
+            service = Services.get_services(service_name='DIRAC')
+            self.assertIs(inspect(service).session, session)
+            service.status = ServiceStatus.UP
+            service.update()
+            Services(name='monitoringd', status=ServiceStatus.UP).add()
+            self.assertIs(Services.get_services(service_name='DIRAC', session=session), service)
+        self.assertTrue(inspect(service).detached)
+        self.assertEqual(service.status, ServiceStatus.UP)
+        self.assertEqual(POOL_METRICS.checkouts('primary'), checkouts + 1)
+        self.assertEqual({service.name: service.status for service in Services.get_services()},
+                         {'DIRAC': ServiceStatus.UP, 'monitoringd': ServiceStatus.UP})
+
+        with self.assertRaises(ValueError), unit_of_work() as session:
+            session.add(service)
+            service.status = ServiceStatus.DOWN
+            raise ValueError
+        self.assertTrue(inspect(service).detached)
+        self.assertEqual(service.status, ServiceStatus.UP)
@@ -0,0 +1,153 @@
+"""Test the Requests model."""
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+from unittest import TestCase
+import mock
+from sqlalchemy import event
+from productionsystem.sql.enums import LocalStatus
+from productionsystem.sql.registry import SessionRegistry
+
+
+def setUpModule():
+    """Import the models once the config entry point map has been set up."""
+    global models  # pylint: disable=global-statement, invalid-name
+    models = importlib.import_module("productionsystem.sql.models")
+
+
+class TestRequests(TestCase):
+    """Test case for the Requests model."""
+
+    def setUp(self):
+        """Set up an SQLite DB with a request and its DIRAC jobs."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.registry = SessionRegistry.__new__(SessionRegistry)
+        self.registry.__init__('sqlite:///' + os.path.join(tmpdir, 'requests.db'))
+        self.addCleanup(self.registry.dispose)
+        patcher = mock.patch.object(SessionRegistry, 'get_instance', return_value=self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.request = models.Requests(requester_id=1, parametricjobs=[{}])
+        self.request.add()
+        models.DiracJobs.add_submitted(self.request.id, 1, 1, range(1, 5))
+        self.request.status = LocalStatus.REMOVING
+        self.request.update()
+
+    def test_remove(self):
+        """Test a request is removed along with its DIRAC jobs and log."""
+        with mock.patch.object(models.ParametricJobs, 'kill_delete_dirac_jobs',
+                               return_value=set()) as kill_delete:
+            self.assertTrue(self.request.remove())
+        kill_delete.assert_called_once_with([1, 2, 3, 4])
+        self.assertEqual(models.Requests.get(), [])
+        self.assertEqual(models.DiracJobs.get(), [])
+        self.assertEqual(models.LogEntries.get(self.request.id), [])
+
+    def test_remove_gives_up(self):
+        """Test the removal of DIRAC jobs that keep failing is only retried so many times."""
+        config = mock.patch.object(sys.modules[models.Requests.__module__], 'getConfig',
+                                   return_value={'max_removal_attempts': 2})
+        with config, mock.patch.object(models.ParametricJobs, 'kill_delete_dirac_jobs',
+                                       return_value={3, 4}) as kill_delete:
+            self.assertFalse(self.request.remove())
+            request = models.Requests.get(self.request.id)
+            self.assertEqual((request.status, request.removal_attempts),
+                             (LocalStatus.REMOVING, 1))
+            self.assertEqual(sorted(job.id for job in models.DiracJobs.get()), [3, 4])
+
+            self.assertFalse(self.request.remove())
+        kill_delete.assert_called_with([3, 4])
+        self.assertEqual(self.request.status, LocalStatus.FAILED)
+        request = models.Requests.get(self.request.id)
+        self.assertEqual((request.status, request.removal_attempts), (LocalStatus.FAILED, 2))
+        self.assertEqual(models.Requests.get_reschedules(), [])
+        messages = [entry.message for entry in models.LogEntries.get(self.request.id)]
+        self.assertEqual(messages[-2:],
+                         ["Giving up removing the request after 2 attempts, failed to "
+                          "kill/delete DIRAC job(s): 3, 4",
+                          "Request 1 transitioned from status REMOVING to FAILED"])
+
+    def test_delete(self):
+        """Test deleting a request kills and deletes its DIRAC jobs rather than orphaning them."""
+        with mock.patch.object(models.ParametricJobs, 'kill_delete_dirac_jobs',
+                               return_value={4}) as kill_delete:
+            self.assertFalse(models.Requests.delete(self.request.id))
+        kill_delete.assert_called_once_with([1, 2, 3, 4])
+        self.assertEqual([job.id for job in models.DiracJobs.get()], [4])
+
+        with self.assertRaises(RuntimeError):
+            with self.registry() as session:
+                session.delete(session.query(models.Requests).one())
+                session.flush()
+        self.assertEqual([job.id for job in models.DiracJobs.get()], [4])
+        self.assertEqual(len(models.Requests.get()), 1)
+
+    def test_update_after_submit(self):
+        """Test writing back a submitted request doesn't look up each of its DIRAC jobs."""
+        module = sys.modules[models.ParametricJobs.__module__]
+        job_client = mock.MagicMock()
+        job_client.return_value.__enter__.return_value = (None, mock.MagicMock())
+        request = models.Requests.get(self.request.id, load_parametricjobs=True)
+        models.DiracJobs.delete_ids(range(1, 5))
+        with mock.patch.object(module, 'dirac_api_job_client', job_client), \
+                mock.patch.object(module, 'submit_jdls',
+                                  return_value=[{'OK': True, 'Value': list(range(1, 101))}]):
+            request.submit()
+        self.assertEqual(request.parametric_jobs[0].num_jobs, 100)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            """Record the SELECT statements executed."""
+            # pylint: disable=unused-argument
+            if statement.lstrip().startswith('SELECT'):
+                statements.append(statement)
+
+        engine = self.registry.engines[0]
+        event.listen(engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', record)
+        request.update()
+        self.assertEqual(len(statements), 2)
+        self.assertFalse(any('FROM diracjobs' in statement for statement in statements))
+        self.assertEqual(models.ParametricJobs.get(self.request.id, 1).num_jobs, 100)
+        self.assertEqual(len(models.DiracJobs.get(request_id=self.request.id)), 100)
+
+    def test_submit_without_ids(self):
+        """Test a parametric job whose submission created no DIRAC jobs is failed."""
+        module = sys.modules[models.ParametricJobs.__module__]
+        job_client = mock.MagicMock()
+        job_client.return_value.__enter__.return_value = (None, mock.MagicMock())
+        job = models.ParametricJobs.get(self.request.id, 1)
+        with mock.patch.object(module, 'dirac_api_job_client', job_client), \
+                mock.patch.object(module, 'submit_jdls',
+                                  return_value=[{'OK': True, 'Value': []}]), \
+                mock.patch.object(models.DiracJobs, 'get_states') as get_states:
+            job.submit()
+            get_states.assert_not_called()
+            job.update()
+        job = models.ParametricJobs.get(self.request.id, 1)
+        self.assertEqual((job.status, job.num_jobs), (LocalStatus.FAILED, 0))
+        self.assertFalse(job.awaiting_submission)
+        messages = [entry.message for entry in
+                    models.LogEntries.get(self.request.id, parametricjob_id=1)]
+        self.assertIn("DIRAC job submit API returned no job ids, "
+                      "marking parametric job 1.1 as failed.", messages)
+
+    def test_submit_resume(self):
+        """Test only a resumed submission removes the DIRAC jobs left over from before."""
+        module = sys.modules[models.ParametricJobs.__module__]
+        job_client = mock.MagicMock()
+        job_client.return_value.__enter__.return_value = (None, mock.MagicMock())
+        job = models.ParametricJobs.get(self.request.id, 1)
+        with mock.patch.object(module, 'dirac_api_job_client', job_client), \
+                mock.patch.object(module, 'submit_jdls',
+                                  return_value=[{'OK': True, 'Value': [11, 12]}]), \
+                mock.patch.object(models.ParametricJobs, 'kill_delete_dirac_jobs',
+                                  return_value=set()) as kill_delete:
+            job.submit(resume=True)
+        kill_delete.assert_called_once_with([1, 2, 3, 4])
+        self.assertEqual(sorted(job.id for job in models.DiracJobs.get()), [11, 12])
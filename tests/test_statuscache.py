@@ -0,0 +1,48 @@
+"""Test cache.py."""
+from unittest import TestCase
+import mock
+from productionsystem.monitoring.diracrpc.cache import StatusCache
+
+
+class TestStatusCache(TestCase):
+    """Test case for the StatusCache class."""
+
+    def test_hits_and_misses(self):
+        """Test cached statuses are returned and counted."""
+        cache = StatusCache(ttl=10)
+        cache.update({1: {'Status': 'Done', 'MinorStatus': 'Execution Complete', 'Site': 'ANY'}})
+        found, missing = cache.get_many([1, 2])
+        self.assertEqual(found, {1: {'Status': 'Done', 'MinorStatus': 'Execution Complete'}})
+        self.assertEqual(missing, [2])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1})
+
+    def test_ttl(self):
+        """Test statuses expire and that a ttl of 0 disables the cache."""
+        cache = StatusCache(ttl=10)
+        with mock.patch('productionsystem.monitoring.diracrpc.cache.time') as time_mock:
+            time_mock.time.return_value = 100.
+            cache.update({1: {'Status': 'Running'}})
+            time_mock.time.return_value = 109.
+            self.assertEqual(cache.get_many([1])[1], [])
+            time_mock.time.return_value = 111.
+            self.assertEqual(cache.get_many([1])[1], [1])
+
+        cache = StatusCache(ttl=0)
+        cache.update({1: {'Status': 'Running'}})
+        self.assertEqual(cache.get_many([1]), ({}, [1]))
+
+    def test_lru_eviction(self):
+        """Test the least recently used statuses are evicted."""
+        cache = StatusCache(max_entries=2)
+        cache.update({1: {'Status': 'Done'}, 2: {'Status': 'Done'}})
+        cache.get_many([1])
+        cache.update({3: {'Status': 'Done'}})
+        self.assertEqual(sorted(cache.get_many([1, 2, 3])[0]), [1, 3])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_invalidate(self):
+        """Test invalidated statuses are fetched again."""
+        cache = StatusCache()
+        cache.update({1: {'Status': 'Failed'}, 2: {'Status': 'Failed'}})
+        cache.invalidate([1, 3])
+        self.assertEqual(cache.get_many([1, 2])[1], [1])